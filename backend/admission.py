@@ -0,0 +1,354 @@
+# admission.py
+#
+# 请求准入控制与服务商限流
+#
+# 原来 /api/chat 和 /api/upload 的请求不受限制地同时打到 LLM、向量和 TTS 服务，
+# 一阵文档上传就可能耗尽服务商的速率限额，聊天跟着变慢。这里提供：
+# 1. AdmissionLane：一条准入通道，限制同时处理的请求数，超出的请求在有界队列中按到达顺序等待，
+#    队列已满或等待超时时立即拒绝（接口返回 429 和 Retry-After），不让请求无限堆积
+# 2. 交互通道（聊天）和批量通道（文档上传）各自有并发数和队列，上传再多也占不到聊天的名额
+# 3. TokenBucket：每个服务商一个令牌桶限制请求速率；PrioritySemaphore：按优先级分配并发名额（TTS 合成）。
+#    两者排队时交互请求先于批量请求，批量请求先于后台任务（预热等）
+# 4. AdmissionMiddleware：按路径把请求分到通道，在读取请求体之前完成准入，流式响应结束时才释放名额
+# 当前请求的优先级通过 contextvar 传递，服务调用处不需要额外参数。
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from fastapi.responses import JSONResponse
+
+from metrics import ADMISSION_REJECTED, ADMISSION_WAIT, RATE_LIMIT_WAIT
+
+# 优先级，数值越小越先拿到令牌和并发名额
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_BACKGROUND = 2
+
+# 当前请求的优先级，不在任何通道中（启动预热等后台任务）时为最低
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("admission_priority", default=PRIORITY_BACKGROUND)
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+class AdmissionRejected(Exception):
+    """通道的队列已满或排队超时，请求没有被处理"""
+
+    def __init__(self, lane: str, reason: str, retry_after: int):
+        super().__init__(f"{lane} 通道繁忙（{reason}）")
+        self.lane = lane
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionLane:
+    def __init__(
+        self,
+        name: str,
+        priority: int,
+        max_concurrency: int,
+        max_queue: int,
+        queue_timeout: float
+    ):
+        """
+        Args:
+            name (str): 通道名称，用于指标标签
+            priority (int): 通道中请求调用服务商时的优先级
+            max_concurrency (int): 同时处理的最大请求数
+            max_queue (int): 排队等待的最大请求数，超出时立即拒绝
+            queue_timeout (float): 最长排队时间（秒），超时拒绝
+        """
+        self.name = name
+        self.priority = priority
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self.active = 0
+        self._waiters: "deque[asyncio.Future]" = deque()
+        # 最近请求占用名额的平均时间（秒），用于估算 Retry-After
+        self._avg_hold = 1.0
+
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def _retry_after(self) -> int:
+        """按排在前面的请求数和平均处理时间估算多久后再试（秒）"""
+        rounds = (len(self._waiters) + 1) / self.max_concurrency
+        return max(1, math.ceil(self._avg_hold * rounds))
+
+    def _reject(self, reason: str) -> AdmissionRejected:
+        ADMISSION_REJECTED.inc(lane=self.name, reason=reason)
+        return AdmissionRejected(self.name, reason, self._retry_after())
+
+    async def acquire(self) -> None:
+        """
+        取得一个处理名额，需要时排队等待
+
+        Raises:
+            AdmissionRejected: 队列已满或排队超时
+        """
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            ADMISSION_WAIT.observe(0.0, lane=self.name)
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise self._reject("queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.queued += 1
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # 名额已经转交过来，放弃时交给下一个等待者
+                self.release(0.0)
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.timeouts += 1
+                raise self._reject("timeout") from None
+            raise
+        self.admitted += 1
+        ADMISSION_WAIT.observe(time.monotonic() - start, lane=self.name)
+
+    def release(self, held: float) -> None:
+        """
+        归还名额，有等待者时直接转交给最早的等待者
+
+        Args:
+            held (float): 本次占用名额的时间（秒）
+        """
+        if held > 0:
+            self._avg_hold += (held - self._avg_hold) * 0.2
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def get_stats(self) -> dict:
+        return {
+            "active": self.active,
+            "waiting": len(self._waiters),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "avg_hold": round(self._avg_hold, 3)
+        }
+
+
+class AdmissionController:
+    def __init__(self, lanes: List[AdmissionLane], routes: Dict[str, str]):
+        """
+        Args:
+            lanes (List[AdmissionLane]): 准入通道
+            routes (Dict[str, str]): 接口路径 -> 通道名称，其余路径不做准入控制
+        """
+        self.lanes = {lane.name: lane for lane in lanes}
+        self.routes = {path: self.lanes[name] for path, name in routes.items()}
+
+    def lane_for(self, path: str) -> Optional[AdmissionLane]:
+        return self.routes.get(path)
+
+    def get_stats(self) -> dict:
+        return {name: lane.get_stats() for name, lane in self.lanes.items()}
+
+
+class AdmissionMiddleware:
+    """
+    ASGI 中间件：按路径把请求分到准入通道
+
+    准入在读取请求体之前进行，被拒绝的上传不会先把整个文件传完；
+    名额在响应（包括流式响应）发送完毕后才释放，期间请求的优先级为通道的优先级
+    """
+
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        lane = None
+        if scope["type"] == "http" and scope["method"] != "OPTIONS":
+            lane = self.controller.lane_for(scope["path"])
+        if lane is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await lane.acquire()
+        except AdmissionRejected as e:
+            response = JSONResponse(
+                status_code=429,
+                content={"error": str(e)},
+                headers={"Retry-After": str(e.retry_after)}
+            )
+            await response(scope, receive, send)
+            return
+
+        token = _priority.set(lane.priority)
+        start = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _priority.reset(token)
+            lane.release(time.monotonic() - start)
+
+
+class _PriorityWaiters:
+    """按 (优先级, 到达顺序) 排队的等待者，每项为 [优先级, 序号, future]"""
+
+    def __init__(self):
+        self._heap: List[list] = []
+        self._seq = itertools.count()
+
+    def push(self) -> list:
+        entry = [current_priority(), next(self._seq), None]
+        heapq.heappush(self._heap, entry)
+        return entry
+
+    def pop(self) -> list:
+        return heapq.heappop(self._heap)
+
+    def head(self) -> Optional[list]:
+        return self._heap[0] if self._heap else None
+
+    def remove(self, entry: list) -> None:
+        if entry in self._heap:
+            self._heap.remove(entry)
+            heapq.heapify(self._heap)
+
+    def wake_head(self) -> None:
+        if self._heap:
+            future = self._heap[0][2]
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+
+class TokenBucket:
+    def __init__(self, name: str, rate: float, burst: int):
+        """
+        Args:
+            name (str): 服务商名称，用于指标标签
+            rate (float): 每秒产生的令牌数，即平均请求速率上限
+            burst (int): 令牌桶容量，允许的突发请求数
+        """
+        self.name = name
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._waiters = _PriorityWaiters()
+
+        self.acquired = 0
+        self.waited = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        """取得一个令牌，令牌不够时按当前请求的优先级排队"""
+        self._refill()
+        self.acquired += 1
+        if not len(self._waiters) and self._tokens >= 1:
+            self._tokens -= 1
+            RATE_LIMIT_WAIT.observe(0.0, provider=self.name)
+            return
+
+        self.waited += 1
+        loop = asyncio.get_running_loop()
+        entry = self._waiters.push()
+        start = time.monotonic()
+        try:
+            while True:
+                entry[2] = loop.create_future()
+                if self._waiters.head() is not entry:
+                    await entry[2]
+                    continue
+                self._refill()
+                if self._tokens >= 1:
+                    self._waiters.pop()
+                    self._tokens -= 1
+                    self._waiters.wake_head()
+                    break
+                # 队首等到下一个令牌产生
+                try:
+                    await asyncio.wait_for(entry[2], (1 - self._tokens) / self.rate)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self._waiters.remove(entry)
+            self._waiters.wake_head()
+            raise
+        RATE_LIMIT_WAIT.observe(time.monotonic() - start, provider=self.name)
+
+    def get_stats(self) -> dict:
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "waiting": len(self._waiters),
+            "acquired": self.acquired,
+            "waited": self.waited
+        }
+
+
+class PrioritySemaphore:
+    """与 asyncio.Semaphore 相同，但名额空出时先分配给优先级高的等待者，同一优先级按到达顺序"""
+
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters = _PriorityWaiters()
+
+    async def acquire(self) -> None:
+        if self._value > 0 and not len(self._waiters):
+            self._value -= 1
+            return
+        entry = self._waiters.push()
+        entry[2] = asyncio.get_running_loop().create_future()
+        try:
+            await entry[2]
+        except BaseException:
+            if entry[2].done() and not entry[2].cancelled():
+                self.release()
+            else:
+                self._waiters.remove(entry)
+            raise
+
+    def release(self) -> None:
+        while len(self._waiters):
+            future = self._waiters.pop()[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def __aenter__(self) -> None:
+        await self.acquire()
+
+    async def __aexit__(self, *exc) -> None:
+        self.release()
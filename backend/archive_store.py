@@ -0,0 +1,220 @@
+# archive_store.py
+#
+# 归档对话存储
+#
+# 移出上下文的对话原来放在一个只增不减的字典里：UUID 字符串作键、ISO 时间字符串作时间戳，
+# 每轮对话还会被写入两次，长时间运行的进程内存随对话线性增长。
+# ArchiveStore 改为：
+# 1. 每条记录是一个 __slots__ 对象，整数自增 ID、浮点时间戳 (epoch)，每轮对话只保存一次
+# 2. 内存中最多常驻 max_resident 条记录（按最近访问排序），超出的部分溢出到 SQLite 文件
+# 3. 检索命中已溢出的记录时再从 SQLite 按主键读回（懒加载），并重新放进常驻缓存，
+#    同时把最久未访问的记录移出，常驻记录数始终不超过上限
+# 4. 没有指定 SQLite 文件时，超出上限的最早记录直接丢弃，内存占用同样有界
+# 5. SQLite 中最多保留 max_stored 条，超出时删除最早的记录，空出的页面留给之后的写入复用，
+#    新建的文件还会增量回收空闲页面，磁盘占用同样有上限
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+
+class ArchivedTurn:
+    __slots__ = ("id", "timestamp", "ask", "answer")
+
+    def __init__(self, id: int, timestamp: float, ask: str, answer: str):
+        self.id = id
+        self.timestamp = timestamp
+        self.ask = ask
+        self.answer = answer
+
+    def __str__(self):
+        return f"user: {self.ask}\nassistant: {self.answer}"
+
+    def nbytes(self) -> int:
+        """记录本身和两段文本占用的字节数（近似值）"""
+        return sys.getsizeof(self) + sys.getsizeof(self.ask) + sys.getsizeof(self.answer)
+
+
+class ArchiveStore:
+    def __init__(self, db_path: Optional[str] = None, max_resident: int = 200, max_stored: int = 2000):
+        """
+        Args:
+            db_path (str): 溢出记录的 SQLite 文件，为 None 时超出上限的记录直接丢弃
+            max_resident (int): 内存中最多常驻的记录数
+            max_stored (int): SQLite 中最多保留的记录数，0 表示不限制
+        """
+        self.db_path = db_path
+        self.max_resident = max_resident
+        self.max_stored = max_stored
+
+        self._lock = threading.Lock()
+        # ID -> 记录，按最近访问时间从旧到新排列
+        self._resident: "OrderedDict[int, ArchivedTurn]" = OrderedDict()
+        self._resident_bytes = 0
+        self._next_id = 1
+        # ID 不超过该值的记录都已写入 SQLite
+        self._saved_id = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._stored = 0  # SQLite 中的记录数
+
+        self.page_ins = 0
+        self.dropped = 0
+        self.expired = 0  # 超出 max_stored 被删除的记录数
+
+        if db_path and os.path.exists(db_path):
+            with self._lock:
+                row = self._connect().execute("SELECT MAX(id), COUNT(*) FROM archive").fetchone()
+                if row[0] is not None:
+                    self._next_id = row[0] + 1
+                    self._saved_id = row[0]
+                self._stored = row[1]
+
+    def _connect(self) -> sqlite3.Connection:
+        """调用方需持有 _lock"""
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            # 只对新建的文件生效：删除记录后可以增量回收空闲页面
+            self._conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS archive ("
+                "id INTEGER PRIMARY KEY, timestamp REAL NOT NULL, ask TEXT NOT NULL, answer TEXT NOT NULL)"
+            )
+        return self._conn
+
+    def add(self, ask: str, answer: str, timestamp: Optional[float] = None) -> int:
+        """写入一条记录（只进内存，不访问磁盘），返回记录ID"""
+        with self._lock:
+            record = ArchivedTurn(self._next_id, timestamp or time.time(), ask, answer)
+            self._next_id += 1
+            self._resident[record.id] = record
+            self._resident_bytes += record.nbytes()
+            return record.id
+
+    def is_resident(self, ids: Iterable[int]) -> bool:
+        """这些记录是否都在内存中，是则 get 不会访问磁盘"""
+        with self._lock:
+            return all(record_id in self._resident for record_id in ids)
+
+    def get(self, ids: Iterable[int], cache: bool = True) -> List[ArchivedTurn]:
+        """
+        按 ID 读取记录，保持传入顺序；不在内存中的记录从 SQLite 读回，已丢弃的记录会被跳过
+
+        Args:
+            ids: 记录ID
+            cache (bool): 是否把从 SQLite 读回的记录放进常驻缓存
+        """
+        ids = list(ids)
+        with self._lock:
+            found: Dict[int, ArchivedTurn] = {}
+            missing = []
+            for record_id in ids:
+                record = self._resident.get(record_id)
+                if record is None:
+                    missing.append(record_id)
+                else:
+                    self._resident.move_to_end(record_id)
+                    found[record_id] = record
+
+            if missing and self.db_path:
+                placeholders = ",".join("?" * len(missing))
+                rows = self._connect().execute(
+                    f"SELECT id, timestamp, ask, answer FROM archive WHERE id IN ({placeholders})", missing
+                ).fetchall()
+                for row in rows:
+                    record = ArchivedTurn(*row)
+                    found[record.id] = record
+                    self.page_ins += 1
+                    if cache:
+                        self._resident[record.id] = record
+                        self._resident_bytes += record.nbytes()
+                if cache:
+                    # 读回的记录挤掉最久未访问的记录，常驻数不超过上限
+                    self._evict_overflow()
+        return [found[record_id] for record_id in ids if record_id in found]
+
+    def spill(self) -> int:
+        """
+        把超出常驻上限的最久未访问记录写入 SQLite 并移出内存（阻塞，适合放到线程中执行）
+
+        Returns:
+            int: 移出内存的记录数
+        """
+        with self._lock:
+            return self._evict_overflow()
+
+    def _evict_overflow(self) -> int:
+        """把超出常驻上限的最久未访问记录移出内存，还没写入 SQLite 的先写入，调用方需持有 _lock"""
+        overflow = len(self._resident) - self.max_resident
+        if overflow <= 0:
+            return 0
+        evicted = []
+        for _ in range(overflow):
+            _, record = self._resident.popitem(last=False)
+            self._resident_bytes -= record.nbytes()
+            evicted.append(record)
+
+        if self.db_path:
+            self._save([record for record in evicted if record.id > self._saved_id])
+        else:
+            self.dropped += len(evicted)
+        return len(evicted)
+
+    def flush(self) -> None:
+        """把内存中还没写入 SQLite 的记录全部写入（阻塞），保存会话状态时调用"""
+        if not self.db_path:
+            return
+        with self._lock:
+            self._save([record for record in self._resident.values() if record.id > self._saved_id])
+            self._saved_id = self._next_id - 1
+
+    def _save(self, records: List[ArchivedTurn]) -> None:
+        """调用方需持有 _lock"""
+        if not records:
+            return
+        conn = self._connect()
+        changes = conn.total_changes
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO archive (id, timestamp, ask, answer) VALUES (?, ?, ?, ?)",
+                [(r.id, r.timestamp, r.ask, r.answer) for r in records]
+            )
+        self._stored += conn.total_changes - changes
+        if self.max_stored and self._stored > self.max_stored:
+            self._expire(conn)
+
+    def _expire(self, conn: sqlite3.Connection) -> None:
+        """删除 SQLite 中超出 max_stored 的最早记录，调用方需持有 _lock"""
+        changes = conn.total_changes
+        with conn:
+            conn.execute(
+                "DELETE FROM archive WHERE id NOT IN (SELECT id FROM archive ORDER BY id DESC LIMIT ?)",
+                (self.max_stored,)
+            )
+        expired = conn.total_changes - changes
+        self._stored -= expired
+        self.expired += expired
+        conn.execute("PRAGMA incremental_vacuum")
+
+    def close(self) -> None:
+        """关闭 SQLite 连接，之后再访问会重新打开"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "resident": len(self._resident),
+                "resident_bytes": self._resident_bytes,
+                "max_resident": self.max_resident,
+                "stored": self._stored,
+                "max_stored": self.max_stored,
+                "page_ins": self.page_ins,
+                "dropped": self.dropped,
+                "expired": self.expired
+            }
@@ -0,0 +1,139 @@
+# audio_cache.py
+#
+# TTS 语音缓存
+#
+# 陪伴场景下的回复重复度很高（问候语、兜底回复、语气词），同一句话没有必要反复请求远程合成。
+# AudioCache 以 (reference_id, 归一化文本) 的哈希为键缓存合成结果，分两级：
+# 1. 内存 LRU：按字节数限制总大小，超出时淘汰最久未使用的条目
+# 2. 磁盘：save/ 下按哈希存放的音频文件，重启后仍然有效，命中后回填内存
+# TTSService 在线程池中调用，所有操作都加锁保证线程安全。
+import hashlib
+import logging
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """归一化待合成文本：统一全角/半角字符，合并空白"""
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class AudioCache:
+    def __init__(self, cache_dir: str = "save/tts_cache", max_memory_bytes: int = 32 * 1024 * 1024):
+        """
+        Args:
+            cache_dir (str): 磁盘缓存目录，为空时只使用内存缓存
+            max_memory_bytes (int): 内存缓存的最大字节数
+        """
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(reference_id: str, text: str) -> str:
+        """根据音色和归一化后的文本生成缓存键"""
+        raw = f"{reference_id}\0{normalize_text(text)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.mp3")
+
+    def get(self, reference_id: str, text: str) -> Optional[bytes]:
+        """查询缓存，未命中返回 None"""
+        key = self.make_key(reference_id, text)
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return audio
+
+        audio = self._read_disk(key)
+        with self._lock:
+            if audio is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._put_memory(key, audio)
+        return audio
+
+    def put(self, reference_id: str, text: str, audio: bytes) -> None:
+        """写入缓存，空音频不缓存"""
+        if not audio:
+            return
+        key = self.make_key(reference_id, text)
+        with self._lock:
+            self._put_memory(key, audio)
+        self._write_disk(key, audio)
+
+    def _put_memory(self, key: str, audio: bytes) -> None:
+        """写入内存层并按字节数淘汰，调用方需持有锁"""
+        if len(audio) > self.max_memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = audio
+        self._memory_bytes += len(audio)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read() or None
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning("读取语音缓存出错: %s", e)
+            return None
+
+    def _write_disk(self, key: str, audio: bytes) -> None:
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先写临时文件再原子替换，避免并发读到写了一半的文件
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(audio)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("写入语音缓存出错: %s", e)
+
+    def get_stats(self) -> dict:
+        """命中统计和内存占用"""
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / total, 4) if total else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "max_memory_bytes": self.max_memory_bytes
+            }
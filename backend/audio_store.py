@@ -0,0 +1,116 @@
+# audio_store.py
+#
+# 短期语音存储
+#
+# 回复和文档总结的语音原来以 base64 嵌在 JSON 里返回：体积增大三分之一，
+# 服务端编码时内存翻倍，前端也要把整个 JSON 解码完才能开始播放。
+# AudioStore 把合成好的语音按随机 ID 暂存在内存中，JSON 里只返回 /api/audio/<ID> 形式的地址，
+# 前端直接用地址播放，语音以二进制传输，支持 Range 请求（边下边播、拖动进度）。
+# 1. ID 是随机生成的，无法猜测，地址只在有效期 (ttl) 内可用
+# 2. 总字节数有上限，超出时淘汰最早存入的语音
+# 3. 语音数据是不可变的 bytes，与 TTS 缓存共享同一份对象，不额外复制
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+AUDIO_URL_PREFIX = "/api/audio/"
+
+
+class AudioStore:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 600.0):
+        """
+        Args:
+            max_bytes (int): 暂存语音的最大总字节数
+            ttl (float): 语音地址的有效期（秒）
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        # ID -> (过期时间, 语音)，按存入时间从旧到新排列
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._bytes = 0
+
+        self.puts = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def put(self, audio: bytes) -> str:
+        """暂存一段语音，返回访问地址；空音频返回空字符串"""
+        if not audio:
+            return ""
+        audio_id = secrets.token_urlsafe(16)
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            self._entries[audio_id] = (now + self.ttl, audio)
+            self._bytes += len(audio)
+            self.puts += 1
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, old) = self._entries.popitem(last=False)
+                self._bytes -= len(old)
+                self.evicted += 1
+        return AUDIO_URL_PREFIX + audio_id
+
+    def get(self, audio_id: str) -> Optional[bytes]:
+        """读取语音，不存在或已过期时返回 None"""
+        with self._lock:
+            self._expire(time.monotonic())
+            entry = self._entries.get(audio_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def _expire(self, now: float) -> None:
+        """删除过期的语音，调用方需持有 _lock；条目按存入顺序排列，过期时间也是递增的"""
+        while self._entries:
+            audio_id, (expires, audio) = next(iter(self._entries.items()))
+            if expires > now:
+                break
+            del self._entries[audio_id]
+            self._bytes -= len(audio)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "puts": self.puts,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evicted": self.evicted
+            }
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析 Range 请求头，只支持单个字节区间
+
+    按 RFC 9110，格式错误（如 bytes=5-3）的 Range 应当忽略；无法满足的区间也同样忽略，
+    返回完整内容，拖动进度越界的播放器仍能拿到可播放的数据。
+
+    Returns:
+        Optional[Tuple[int, int]]: 闭区间 (start, end)；没有、不支持、格式错误或无法满足的 Range 返回 None（返回完整内容）
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start_text, sep, end_text = header[len("bytes="):].strip().partition("-")
+    if not sep or not (start_text or end_text) or not all(t.isdigit() for t in (start_text, end_text) if t):
+        return None
+    if not start_text:
+        # bytes=-N：最后 N 个字节
+        length = int(end_text)
+        if length == 0 or size == 0:
+            return None
+        return max(size - length, 0), size - 1
+    start = int(start_text)
+    end = int(end_text) if end_text else size - 1
+    if start >= size or end < start:
+        return None
+    return start, min(end, size - 1)
@@ -0,0 +1,180 @@
+# background_writer.py
+#
+# 后台文件写入
+#
+# 对话日志和用户信息原来在请求路径上同步读写磁盘，每轮对话至少三次打开/写入/关闭文件，
+# 磁盘抖动会直接体现在聊天响应时间上。BackgroundWriter 把这些写入移到后台线程：
+# 1. 对话日志：请求路径只把记录放进队列，后台线程按时间间隔或攒够一批时统一写入，
+#    每条记录是一行 JSON (JSONL)，按天分文件，单个文件超过大小上限时滚动到新文件
+# 2. 用户信息：只保留每个文件最新的内容，随下一次刷新写入（防抖），
+#    先写临时文件再原子替换，不会留下写了一半的文件
+# 3. 队列已满时丢弃日志并计数，绝不阻塞请求
+import json
+import logging
+import os
+import queue
+import threading
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundWriter:
+    def __init__(
+        self,
+        flush_interval: float = 1.0,
+        max_batch: int = 256,
+        max_queue: int = 10000,
+        max_log_bytes: int = 10 * 1024 * 1024
+    ):
+        """
+        Args:
+            flush_interval (float): 刷新间隔（秒）
+            max_batch (int): 队列中积攒到这么多条日志时立即刷新
+            max_queue (int): 日志队列上限，超出时丢弃新日志
+            max_log_bytes (int): 单个日志文件的最大字节数，超出时滚动到新文件
+        """
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_log_bytes = max_log_bytes
+
+        self._queue: "queue.Queue[tuple]" = queue.Queue(maxsize=max_queue)
+        # 待写入的文本文件：路径 -> 最新内容
+        self._texts: Dict[str, str] = {}
+        self._texts_lock = threading.Lock()
+        # 后台线程和 flush() 的调用方不能同时写文件
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.records = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.text_writes = 0
+
+    def start(self) -> None:
+        """启动后台写入线程"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="background-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """停止后台线程，并把剩余内容全部写入磁盘"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("后台写入出错: %s", e)
+
+    def log(self, log_dir: str, record: dict) -> None:
+        """
+        追加一条日志记录，立即返回
+
+        Args:
+            log_dir (str): 日志目录，记录写入其中按天命名的 JSONL 文件
+            record (dict): 日志内容，会自动补上时间字段 time
+        """
+        now = datetime.now()
+        record = {"time": now.isoformat(timespec="milliseconds"), **record}
+        try:
+            self._queue.put_nowait((log_dir, now.strftime("%Y%m%d"), record))
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self._queue.qsize() >= self.max_batch:
+            self._wake.set()
+
+    def save_text(self, path: str, text: str) -> None:
+        """保存文本文件，短时间内的多次保存只写入最后一次的内容"""
+        with self._texts_lock:
+            self._texts[path] = text
+
+    def pending_text(self, path: str) -> Optional[str]:
+        """还没写入磁盘的文本内容，没有时返回 None"""
+        with self._texts_lock:
+            return self._texts.get(path)
+
+    def flush(self) -> None:
+        """把队列中的日志和待保存的文本立即写入磁盘（阻塞）"""
+        with self._write_lock:
+            records: Dict[tuple, List[dict]] = defaultdict(list)
+            while True:
+                try:
+                    log_dir, date, record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                records[(log_dir, date)].append(record)
+
+            with self._texts_lock:
+                texts, self._texts = self._texts, {}
+
+            for (log_dir, date), batch in records.items():
+                try:
+                    self._append_log(log_dir, date, batch)
+                    self.records += len(batch)
+                except OSError as e:
+                    logger.error("写入对话日志出错: %s", e)
+
+            for path, text in texts.items():
+                try:
+                    self._write_atomic(path, text)
+                    self.text_writes += 1
+                except OSError as e:
+                    logger.error("保存文件出错: %s", e)
+
+            if records or texts:
+                self.flushes += 1
+
+    def _log_path(self, log_dir: str, date: str) -> str:
+        """当天的日志文件，超过大小上限时依次滚动为 YYYYMMDD.1.jsonl、YYYYMMDD.2.jsonl ..."""
+        path = os.path.join(log_dir, f"{date}.jsonl")
+        try:
+            if os.path.getsize(path) < self.max_log_bytes:
+                return path
+        except OSError:
+            return path
+        index = 1
+        while True:
+            rotated = os.path.join(log_dir, f"{date}.{index}.jsonl")
+            if not os.path.exists(rotated):
+                os.replace(path, rotated)
+                return path
+            index += 1
+
+    def _append_log(self, log_dir: str, date: str, batch: List[dict]) -> None:
+        os.makedirs(log_dir, exist_ok=True)
+        lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in batch)
+        with open(self._log_path(log_dir, date), "a", encoding="utf-8") as f:
+            f.write(lines)
+
+    @staticmethod
+    def _write_atomic(path: str, text: str) -> None:
+        """先写临时文件再原子替换"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def get_stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "records": self.records,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "text_writes": self.text_writes
+        }
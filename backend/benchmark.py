@@ -0,0 +1,436 @@
+# benchmark.py
+#
+# 压测与延迟基准
+#
+# 启动本地模拟服务 (mock_providers.py) 和后端，通过环境变量 (Config.load_env_overrides)
+# 把 LLM、向量和 TTS 指向模拟服务，然后按指定的并发数压测接口，报告：
+# 1. 吞吐量 (请求/秒) 和错误数
+# 2. 请求延迟的 p50/p95/p99
+# 3. 首段语音延迟 (time to first audio)：从发出请求到第一段语音下载完成，
+#    /api/chat 和 /api/upload 为响应返回后再获取第一个语音地址，/api/chat/stream 为第一个带语音的句子事件
+# 4. 每个会话的内存：后端进程 RSS 的增量除以新建的会话数，以及 /api/stats 中的记忆占用
+# 5. 被准入控制拒绝 (429) 的请求数；--upload-load 在压测聊天的同时持续上传文档，观察上传高峰时聊天延迟是否稳定
+# 后端在临时目录中运行，不读写 save/ 下的会话、日志和缓存。
+# 结果可以保存为 JSON，并与之前保存的结果比较，p95 延迟或吞吐量退化超过阈值时以非零状态退出。
+#
+# 示例：
+#   python benchmark.py --concurrency 1,8,32 --requests 64 --json bench.json
+#   python benchmark.py --baseline bench.json --max-regression 0.2
+#   python benchmark.py --scenarios chat --llm-latency 0.8 --llm-tail-rate 0.05 --set LLM_HEDGE_ENABLED=false
+#   python benchmark.py --scenarios chat,stream --upload-load 8 --set LLM_RATE_LIMIT=50
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from config import ENV_PREFIX
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ("chat", "stream", "upload")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def read_rss(pid: int) -> Optional[int]:
+    """进程的常驻内存（字节），只支持 Linux，其他平台返回 None"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def wait_ready(url: str, process: subprocess.Popen, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"进程启动失败 (exit {process.returncode})，见日志")
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"等待 {url} 超时")
+
+
+class Result:
+    __slots__ = ("latency", "ttfa", "ok", "rejected")
+
+    def __init__(self, latency: float, ttfa: Optional[float], ok: bool, rejected: bool = False):
+        self.latency = latency
+        self.ttfa = ttfa
+        self.ok = ok
+        self.rejected = rejected  # 被准入控制拒绝 (429)
+
+
+class Benchmark:
+    def __init__(self, base_url: str, pid: int, upload_paragraphs: int = 20, upload_load: int = 0):
+        self.base_url = base_url
+        self.pid = pid
+        self.upload_paragraphs = upload_paragraphs
+        self.upload_load = upload_load  # 压测聊天时在后台持续上传文档的并发数
+        self.client: Optional[httpx.AsyncClient] = None
+        self.sequence = 0  # 所有档位共用的请求编号，保证每条消息和每份文档都不重复
+
+    async def fetch_audio(self, url: str) -> bool:
+        if not url:
+            return False
+        response = await self.client.get(self.base_url + url)
+        return response.status_code == 200 and bool(response.content)
+
+    async def first_audio(self, data: dict, start: float) -> Optional[float]:
+        urls = [url for url in data.get("audio_urls") or [data.get("audio_url")] if url]
+        if urls and await self.fetch_audio(urls[0]):
+            return time.monotonic() - start
+        return None
+
+    async def chat(self, session_id: str, index: int) -> Result:
+        start = time.monotonic()
+        response = await self.client.post(
+            f"{self.base_url}/api/chat",
+            json={"message": f"第{index}条消息：今天有点累，想和你聊聊", "session_id": session_id}
+        )
+        latency = time.monotonic() - start
+        if response.status_code != 200:
+            return Result(latency, None, False, rejected=response.status_code == 429)
+        return Result(latency, await self.first_audio(response.json(), start), True)
+
+    async def stream(self, session_id: str, index: int) -> Result:
+        start = time.monotonic()
+        ttfa = None
+        event = None
+        async with self.client.stream(
+            "POST",
+            f"{self.base_url}/api/chat/stream",
+            json={"message": f"第{index}条消息：给我讲讲你今天做了什么", "session_id": session_id}
+        ) as response:
+            if response.status_code != 200:
+                return Result(time.monotonic() - start, None, False, rejected=response.status_code == 429)
+            async for line in response.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:") and event == "sentence" and ttfa is None:
+                    data = json.loads(line[len("data:"):])
+                    if await self.fetch_audio(data.get("audio_url")):
+                        ttfa = time.monotonic() - start
+        return Result(time.monotonic() - start, ttfa, event == "done")
+
+    async def upload(self, session_id: str, index: int) -> Result:
+        # 每次上传的内容都不同，不命中上传缓存
+        text = "\n".join(
+            f"第{index}份文档的第{i}段：记录了一些日常的安排和想法，编号 {index * 1000 + i}。"
+            for i in range(self.upload_paragraphs)
+        )
+        start = time.monotonic()
+        response = await self.client.post(
+            f"{self.base_url}/api/upload",
+            files={"file": (f"bench_{index}.txt", text.encode("utf-8"), "text/plain")},
+            data={"session_id": session_id}
+        )
+        latency = time.monotonic() - start
+        if response.status_code != 200:
+            return Result(latency, None, False, rejected=response.status_code == 429)
+        return Result(latency, await self.first_audio(response.json(), start), True)
+
+    async def stats(self) -> dict:
+        return (await self.client.get(f"{self.base_url}/api/stats")).json()
+
+    async def run_level(self, scenario: str, concurrency: int, requests: int) -> dict:
+        """以固定并发数发出 requests 个请求，每个并发通道使用自己的会话"""
+        call = getattr(self, scenario)
+        stats_before = await self.stats()
+        rss_before = read_rss(self.pid)
+        results: List[Result] = []
+        counter = iter(range(self.sequence, self.sequence + requests))
+        self.sequence += requests
+
+        async def worker(lane: int):
+            session_id = f"bench-{scenario}-{concurrency}-{lane}"
+            for index in counter:
+                try:
+                    results.append(await call(session_id, index))
+                except httpx.HTTPError as e:
+                    print(f"请求出错: {e!r}")
+                    results.append(Result(0.0, None, False))
+
+        # 后台上传在本档位的请求全部完成后停止，它们的结果单独统计
+        background: List[Result] = []
+        stop = asyncio.Event()
+        load = [
+            asyncio.create_task(self.upload_loop(f"bench-load-{concurrency}-{lane}", stop, background))
+            for lane in range(self.upload_load if scenario != "upload" else 0)
+        ]
+
+        start = time.monotonic()
+        await asyncio.gather(*(worker(lane) for lane in range(concurrency)))
+        elapsed = time.monotonic() - start
+        stop.set()
+        await asyncio.gather(*load)
+
+        rss_after = read_rss(self.pid)
+        stats_after = await self.stats()
+        report = summarize(scenario, concurrency, results, elapsed, stats_before, stats_after, rss_before, rss_after)
+        if load:
+            report["background_uploads"] = {
+                "ok": sum(r.ok for r in background),
+                "rejected": sum(r.rejected for r in background)
+            }
+        return report
+
+    async def upload_loop(self, session_id: str, stop: asyncio.Event, results: List[Result]) -> None:
+        """持续上传文档直到 stop 被设置，被拒绝时按 1 秒后重试"""
+        while not stop.is_set():
+            index = self.sequence
+            self.sequence += 1
+            try:
+                result = await self.upload(session_id, index)
+            except httpx.HTTPError:
+                result = Result(0.0, None, False)
+            results.append(result)
+            if result.rejected:
+                try:
+                    await asyncio.wait_for(stop.wait(), 1.0)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def run(self, scenarios: List[str], levels: List[int], requests: int, warmup: int) -> List[dict]:
+        # 后台上传各占一个连接，不能和压测请求争抢连接池
+        connections = max(levels) * 2 + self.upload_load
+        limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+        async with httpx.AsyncClient(timeout=300.0, limits=limits) as client:
+            self.client = client
+            reports = []
+            for scenario in scenarios:
+                # 预热：建立连接、加载提示词和向量缓存，不计入结果
+                for index in range(warmup):
+                    await getattr(self, scenario)(f"bench-warmup-{scenario}", -1 - index)
+                for concurrency in levels:
+                    report = await self.run_level(scenario, concurrency, requests)
+                    print_report(report)
+                    reports.append(report)
+            return reports
+
+
+def summarize(
+    scenario: str,
+    concurrency: int,
+    results: List[Result],
+    elapsed: float,
+    stats_before: dict,
+    stats_after: dict,
+    rss_before: Optional[int],
+    rss_after: Optional[int]
+) -> dict:
+    ok = [r for r in results if r.ok]
+    latencies = [r.latency for r in ok]
+    ttfas = [r.ttfa for r in ok if r.ttfa is not None]
+    sessions_before = stats_before.get("sessions", {})
+    sessions_after = stats_after.get("sessions", {})
+    new_sessions = sessions_after.get("active_sessions", 0) - sessions_before.get("active_sessions", 0)
+    memory = sessions_after.get("memory", {})
+    active = sessions_after.get("active_sessions", 0)
+
+    def ms(value: Optional[float]) -> Optional[float]:
+        return round(value * 1000, 1) if value is not None else None
+
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "rejected": sum(r.rejected for r in results),
+        "throughput": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {"p50": ms(percentile(latencies, 0.5)), "p95": ms(percentile(latencies, 0.95)),
+                       "p99": ms(percentile(latencies, 0.99))},
+        "ttfa_ms": {"p50": ms(percentile(ttfas, 0.5)), "p95": ms(percentile(ttfas, 0.95)),
+                    "p99": ms(percentile(ttfas, 0.99))},
+        "rss_bytes": rss_after,
+        "rss_per_new_session": (
+            (rss_after - rss_before) // new_sessions
+            if rss_before is not None and rss_after is not None and new_sessions > 0 else None
+        ),
+        "memory_per_session": (
+            (memory.get("archive_bytes", 0) + memory.get("index_bytes", 0)) // active if active else None
+        )
+    }
+
+
+def print_report(report: dict) -> None:
+    def fmt(value) -> str:
+        return "-" if value is None else str(value)
+
+    latency, ttfa = report["latency_ms"], report["ttfa_ms"]
+    rss_session = report["rss_per_new_session"]
+    print(
+        f"{report['scenario']:<7} c={report['concurrency']:<4} n={report['requests']:<5} err={report['errors']:<3} "
+        f"rej={report.get('rejected', 0):<3} "
+        f"rps={report['throughput']:<7} "
+        f"latency p50/p95/p99={fmt(latency['p50'])}/{fmt(latency['p95'])}/{fmt(latency['p99'])}ms  "
+        f"ttfa p50/p95={fmt(ttfa['p50'])}/{fmt(ttfa['p95'])}ms  "
+        f"rss/session={fmt(rss_session // 1024 if rss_session is not None else None)}KB  "
+        f"memory/session={fmt(report['memory_per_session'])}B"
+    )
+    if "background_uploads" in report:
+        uploads = report["background_uploads"]
+        print(f"        后台上传: 完成 {uploads['ok']}，被拒绝 {uploads['rejected']}")
+
+
+def compare(reports: List[dict], baseline: List[dict], max_regression: float) -> List[str]:
+    """与基线比较，返回退化的项目；p95 延迟和首段语音 p95 变慢或吞吐量下降超过 max_regression 视为退化"""
+    previous: Dict[Tuple[str, int], dict] = {(r["scenario"], r["concurrency"]): r for r in baseline}
+    regressions = []
+    for report in reports:
+        old = previous.get((report["scenario"], report["concurrency"]))
+        if old is None:
+            continue
+        name = f"{report['scenario']} c={report['concurrency']}"
+        for metric in ("latency_ms", "ttfa_ms"):
+            new_p95, old_p95 = report[metric]["p95"], old[metric]["p95"]
+            if new_p95 is not None and old_p95 and new_p95 > old_p95 * (1 + max_regression):
+                regressions.append(f"{name} {metric} p95 {old_p95} -> {new_p95}")
+        if old["throughput"] and report["throughput"] < old["throughput"] * (1 - max_regression):
+            regressions.append(f"{name} throughput {old['throughput']} -> {report['throughput']}")
+        if report["errors"] > old["errors"]:
+            regressions.append(f"{name} errors {old['errors']} -> {report['errors']}")
+    return regressions
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="后端压测：本地模拟 LLM、向量和 TTS 服务，报告吞吐量、延迟和内存")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="要压测的接口：chat,stream,upload")
+    parser.add_argument("--concurrency", default="1,8,32", help="并发数，逗号分隔")
+    parser.add_argument("--requests", type=int, default=64, help="每个并发档位的请求数")
+    parser.add_argument("--warmup", type=int, default=2, help="每个接口的预热请求数")
+    parser.add_argument("--upload-paragraphs", type=int, default=20, help="上传文档的段落数")
+    parser.add_argument("--upload-load", type=int, default=0,
+                        help="压测 chat/stream 时在后台持续上传文档的并发数，用于观察上传高峰时的聊天延迟")
+    parser.add_argument("--no-tts", action="store_true", help="不启用 TTS")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="覆盖后端配置，例如 --set LLM_HEDGE_ENABLED=false，可重复")
+    parser.add_argument("--json", help="把结果保存到 JSON 文件")
+    parser.add_argument("--baseline", help="与之前保存的 JSON 结果比较")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="允许的退化比例")
+    parser.add_argument("--keep-workdir", action="store_true", help="保留后端的临时目录（日志、会话和缓存）")
+    # 模拟服务的延迟，参数含义见 mock_providers.py
+    for name, latency, jitter in (("llm", 0.3, 0.1), ("embedding", 0.05, 0.02), ("tts", 0.2, 0.1)):
+        parser.add_argument(f"--{name}-latency", type=float, default=latency)
+        parser.add_argument(f"--{name}-jitter", type=float, default=jitter)
+    for name in ("llm", "tts"):
+        parser.add_argument(f"--{name}-tail-rate", type=float, default=0.0)
+        parser.add_argument(f"--{name}-tail", type=float, default=2.0)
+    parser.add_argument("--reply-sentences", type=int, default=3)
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"不支持的接口: {', '.join(sorted(unknown))}")
+    levels = [int(c) for c in args.concurrency.split(",") if c]
+
+    workdir = tempfile.mkdtemp(prefix="llm2d-bench-")
+    mock_port, app_port = free_port(), free_port()
+    mock_url = f"http://127.0.0.1:{mock_port}"
+
+    overrides = {
+        "LLM_API_URL": f"{mock_url}/v1/chat/completions",
+        "LLM_API_KEY": "bench",
+        "LLM_MODEL": "deepseek-chat",
+        "LLM_FALLBACK_API_URL": "",
+        "EMBEDDING_API_URL": f"{mock_url}/v1/embeddings",
+        "EMBEDDING_API_KEY": "bench",
+        "FISH_API_URL": mock_url,
+        "FISH_API_KEY": "" if args.no_tts else "bench"
+    }
+    for item in args.set:
+        name, _, value = item.partition("=")
+        overrides[name.strip()] = value
+    env = dict(os.environ)
+    env.update({ENV_PREFIX + name: value for name, value in overrides.items()})
+
+    mock_cmd = [sys.executable, os.path.join(BACKEND_DIR, "mock_providers.py"), "--port", str(mock_port),
+                "--reply-sentences", str(args.reply_sentences)]
+    for name in ("llm", "embedding", "tts"):
+        mock_cmd += [f"--{name}-latency", str(getattr(args, f"{name}_latency")),
+                     f"--{name}-jitter", str(getattr(args, f"{name}_jitter"))]
+    for name in ("llm", "tts"):
+        mock_cmd += [f"--{name}-tail-rate", str(getattr(args, f"{name}_tail_rate")),
+                     f"--{name}-tail", str(getattr(args, f"{name}_tail"))]
+    app_cmd = [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR,
+               "--host", "127.0.0.1", "--port", str(app_port), "--log-level", "warning"]
+
+    processes = []
+    try:
+        with open(os.path.join(workdir, "mock.log"), "wb") as mock_log, \
+                open(os.path.join(workdir, "app.log"), "wb") as app_log:
+            mock = subprocess.Popen(mock_cmd, cwd=workdir, stdout=mock_log, stderr=subprocess.STDOUT)
+            processes.append(mock)
+            wait_ready(f"{mock_url}/stats", mock)
+            app = subprocess.Popen(app_cmd, cwd=workdir, env=env, stdout=app_log, stderr=subprocess.STDOUT)
+            processes.append(app)
+            base_url = f"http://127.0.0.1:{app_port}"
+            wait_ready(f"{base_url}/api/stats", app)
+
+            print(f"后端: {base_url}  模拟服务: {mock_url}  工作目录: {workdir}")
+            benchmark = Benchmark(
+                base_url, app.pid, upload_paragraphs=args.upload_paragraphs, upload_load=args.upload_load
+            )
+            reports = asyncio.run(benchmark.run(scenarios, levels, args.requests, args.warmup))
+            provider_calls = httpx.get(f"{mock_url}/stats").json()
+            print(f"模拟服务调用次数: {provider_calls}")
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if args.keep_workdir:
+            print(f"工作目录已保留: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "provider_calls": provider_calls, "results": reports},
+                      f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(reports, json.load(f)["results"], args.max_regression)
+        for regression in regressions:
+            print(f"退化: {regression}")
+        if regressions:
+            return 1
+        print("没有超过阈值的退化")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,47 +1,249 @@
-from typing import Optional, Tuple
+import asyncio
+import logging
+from typing import Optional, Tuple, AsyncIterator, Any
 from llm import LLMService
 from tts import TTSService
 from config import Config
-from main_agent import MainAgent
-from conversation import ConversationHistory
+from session_manager import SessionManager
+from embedding import EmbeddingService
+from embedding_cache import EmbeddingCache
+from background_writer import BackgroundWriter
+from response_cache import ResponseCache
+from main_agent import FALLBACK_EXPRESSION, FALLBACK_REPLY
+from persona_registry import PersonaRegistry
+from admission import TokenBucket
+from document_index import DocumentWriter
+
+logger = logging.getLogger(__name__)
 
 class ChatService:
-    def __init__(self):
+    def __init__(self, tts_service: Optional[TTSService] = None):
         # 初始化LLM服务，从配置中获取参数
         self.llm_service = LLMService(
             Config.LLM_API_KEY, 
             Config.LLM_API_URL,
-            Config.LLM_MODEL  # 传递模型名称
+            Config.LLM_MODEL,  # 传递模型名称
+            timeout=Config.LLM_TIMEOUT,
+            max_connections=Config.LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=Config.LLM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=Config.LLM_KEEPALIVE_EXPIRY,
+            http2=Config.LLM_HTTP2,
+            attempt_timeout=Config.LLM_ATTEMPT_TIMEOUT,
+            deadline=Config.LLM_DEADLINE,
+            hedge_enabled=Config.LLM_HEDGE_ENABLED,
+            breaker_failures=Config.BREAKER_FAILURES,
+            breaker_reset=Config.BREAKER_RESET,
+            rate_limiter=TokenBucket(
+                "llm", Config.LLM_RATE_LIMIT, Config.LLM_RATE_BURST
+            ) if Config.LLM_RATE_LIMIT > 0 else None,
+            # 备用服务，主服务失败或熔断时使用
+            fallback=LLMService(
+                Config.LLM_FALLBACK_API_KEY,
+                Config.LLM_FALLBACK_API_URL,
+                Config.LLM_FALLBACK_MODEL,
+                timeout=Config.LLM_TIMEOUT,
+                http2=Config.LLM_HTTP2,
+                attempt_timeout=Config.LLM_ATTEMPT_TIMEOUT,
+                deadline=Config.LLM_DEADLINE,
+                hedge_enabled=Config.LLM_HEDGE_ENABLED,
+                breaker_failures=Config.BREAKER_FAILURES,
+                breaker_reset=Config.BREAKER_RESET
+            ) if Config.LLM_FALLBACK_API_URL else None
         )
         
-        # 只在启用TTS时初始化TTS服务
-        self.tts_service = TTSService(Config.FISH_API_KEY, Config.FISH_REFERENCE_ID) if Config.is_tts_enabled() else None
+        # 只在启用TTS时初始化TTS服务，可以传入外部共享的实例（共用语音缓存）
+        if tts_service is None and Config.is_tts_enabled():
+            tts_service = TTSService(
+                Config.FISH_API_KEY,
+                Config.FISH_REFERENCE_ID,
+                base_url=Config.FISH_API_URL,
+                breaker_failures=Config.BREAKER_FAILURES,
+                breaker_reset=Config.BREAKER_RESET
+            )
+        self.tts_service = tts_service
          
-        # 初始化对话历史和主Agent
-        self.conversation_history = ConversationHistory(max_turns=Config.MAX_TURNS)
-        self.main_agent = MainAgent(self.llm_service, self.conversation_history)
+        # 只在配置了向量模型密钥时初始化向量服务，用于记忆检索
+        self.embedding_service = EmbeddingService(
+            Config.EMBEDDING_API_KEY,
+            Config.EMBEDDING_API_URL,
+            Config.EMBEDDING_MODEL,
+            Config.EMBEDDING_DIMENSION,
+            batch_size=Config.EMBEDDING_BATCH_SIZE,
+            coalesce_window=Config.EMBEDDING_COALESCE_WINDOW,
+            max_concurrency=Config.EMBEDDING_MAX_CONCURRENCY,
+            rate_limiter=TokenBucket(
+                "embedding", Config.EMBEDDING_RATE_LIMIT, Config.EMBEDDING_RATE_BURST
+            ) if Config.EMBEDDING_RATE_LIMIT > 0 else None,
+            cache=EmbeddingCache(
+                Config.EMBEDDING_CACHE_DIR,
+                Config.EMBEDDING_MODEL,
+                Config.EMBEDDING_DIMENSION,
+                dtype=Config.EMBEDDING_CACHE_DTYPE,
+                max_memory_items=Config.EMBEDDING_CACHE_MEMORY_ITEMS
+            ) if Config.EMBEDDING_CACHE_ENABLED else None
+        ) if Config.is_embedding_enabled() else None
+
+        # 对话日志和用户信息由后台线程批量写入，不在请求路径上写磁盘
+        self.writer = BackgroundWriter(
+            flush_interval=Config.LOG_FLUSH_INTERVAL,
+            max_batch=Config.LOG_FLUSH_BATCH,
+            max_queue=Config.LOG_QUEUE_SIZE,
+            max_log_bytes=Config.LOG_MAX_BYTES
+        )
+
+        # 可选的回复缓存，所有会话共享，按会话和人设隔离
+        self.response_cache = ResponseCache(
+            self.embedding_service,
+            ttl=Config.RESPONSE_CACHE_TTL,
+            max_entries=Config.RESPONSE_CACHE_MAX_ENTRIES,
+            max_scope_entries=Config.RESPONSE_CACHE_SCOPE_ENTRIES,
+            similarity=Config.RESPONSE_CACHE_SIMILARITY,
+            max_message_chars=Config.RESPONSE_CACHE_MAX_CHARS
+        ) if Config.RESPONSE_CACHE_ENABLED else None
+
+        # 人设提示词只加载一次，所有会话共享，文件修改后自动重新加载
+        self.personas = PersonaRegistry(
+            Config.PERSONA_DIR,
+            default=Config.PERSONA_DEFAULT,
+            check_interval=Config.PERSONA_RELOAD_INTERVAL
+        )
+
+        # 按会话管理对话历史和主Agent，每个会话的历史、记忆和用户信息相互独立
+        self.sessions = SessionManager(
+            self.llm_service,
+            self.embedding_service,
+            save_dir=Config.SESSION_DIR,
+            max_turns=Config.MAX_TURNS,
+            min_similarity=Config.MEMORY_MIN_SIMILARITY,
+            context_tokens=Config.CONTEXT_MAX_TOKENS,
+            summary_tokens=Config.SUMMARY_MAX_TOKENS,
+            max_resident=Config.MEMORY_MAX_RESIDENT,
+            max_indexed=Config.MEMORY_MAX_INDEXED,
+            max_stored=Config.MEMORY_MAX_STORED,
+            max_sessions=Config.SESSION_MAX_ACTIVE,
+            idle_ttl=Config.SESSION_IDLE_TTL,
+            sweep_interval=Config.SESSION_SWEEP_INTERVAL,
+            doc_chunk_tokens=Config.DOC_INDEX_CHUNK_TOKENS,
+            max_documents=Config.DOC_INDEX_MAX_DOCUMENTS,
+            doc_min_similarity=Config.DOC_MIN_SIMILARITY,
+            writer=self.writer,
+            response_cache=self.response_cache,
+            personas=self.personas
+        )
+
+    async def startup(self) -> None:
+        """应用启动时预先建立共享连接池，启动后台写入线程"""
+        self.writer.start()
+        await self.llm_service.startup()
+        if self.embedding_service:
+            await self.embedding_service.startup()
+        await self.sessions.startup()
+
+    async def shutdown(self) -> None:
+        """应用关闭时保存会话并释放连接池"""
+        await self.sessions.shutdown()
+        await asyncio.to_thread(self.writer.stop)
+        await self.llm_service.shutdown()
+        if self.embedding_service:
+            await self.embedding_service.shutdown()
+
+    def get_stats(self) -> dict:
+        """汇总各服务的运行统计"""
+        stats = {
+            "llm": self.llm_service.get_stats(),
+            "sessions": self.sessions.get_stats(),
+            "personas": self.personas.get_stats(),
+            "writer": self.writer.get_stats()
+        }
+        if self.embedding_service:
+            stats["embedding"] = self.embedding_service.get_stats()
+        if self.response_cache:
+            stats["response_cache"] = self.response_cache.get_stats()
+        if self.tts_service and self.tts_service.cache:
+            stats["tts_cache"] = self.tts_service.cache.get_stats()
+        return stats
+
+    def document_writer(self, name: str) -> DocumentWriter:
+        """创建上传文档的 DocumentWriter，读取文档时逐块 add，片段向量在后台计算"""
+        return DocumentWriter(name, self.embedding_service, Config.DOC_INDEX_CHUNK_TOKENS)
 
-    async def generate_reply(self, message: str, session_id: str) -> Tuple[str, Optional[bytes], str]:
+    async def index_document(self, session_id: str, writer: DocumentWriter) -> int:
+        """
+        把上传文档写入会话的文档索引，之后的聊天可以检索文档内容，返回写入的片段数
+
+        等待向量在会话锁之外进行，只有换入索引这一步持有锁，不阻塞同一会话的聊天
+        """
+        await writer.finish()
+        session = await self.sessions.get(session_id)
+        async with session.lock:
+            return session.document_index.commit(writer)
+
+    async def generate_reply(
+        self,
+        message: str,
+        session_id: str,
+        with_audio: bool = True,
+        persona: Optional[str] = None
+    ) -> Tuple[str, Optional[bytes], str]:
         """
         生成回复
         :param message: 用户消息
         :param session_id: 会话ID
+        :param with_audio: 是否为整段回复合成语音（调用方按句合成时可以关闭）
+        :param persona: 人设名称，指定时切换该会话的人设，之后的请求沿用
         :return: (回复文本, 语音数据, 表情)
         """
         try:
-            # 使用 MainAgent 生成回复和表情
-            reply, expression = await self.main_agent.reply(message)
+            # 使用会话的 MainAgent 生成回复和表情，同一会话的请求串行执行
+            session = await self.sessions.get(session_id)
+            async with session.lock:
+                if persona:
+                    session.main_agent.set_persona(persona)
+                reply, expression = await session.main_agent.reply(message)
             
             # 生成语音 (如果TTS服务已启用)
             audio_data = None   
-            if reply and self.tts_service:
+            if with_audio and reply and self.tts_service:
                 try:
-                    audio_data = self.tts_service.generate_audio(reply)
+                    # 在线程中合成，避免阻塞事件循环
+                    audio_data = await asyncio.to_thread(self.tts_service.generate_audio, reply)
                 except Exception as e:
-                    print(f"生成语音时出错了喵: {e}")
+                    logger.error("生成语音时出错了喵: %s", e)
             
             return reply, audio_data, expression
             
         except Exception as e:
-            print(f"生成回复时出错了喵: {e}")
-            return "对不起，我现在有点累了，能稍后再聊吗？", None, "生气"
\ No newline at end of file
+            logger.error("生成回复时出错了喵: %s", e)
+            return FALLBACK_REPLY, None, FALLBACK_EXPRESSION
+
+    async def stream_reply(
+        self,
+        message: str,
+        session_id: str,
+        persona: Optional[str] = None
+    ) -> AsyncIterator[Tuple[str, Any]]:
+        """
+        流式生成回复
+        :param message: 用户消息
+        :param session_id: 会话ID
+        :param persona: 人设名称，指定时切换该会话的人设，之后的请求沿用
+        :return: 依次产出 ("text", 文本增量)、("expression", 表情)、("done", 结果字典)
+        """
+        parts = []
+        try:
+            session = await self.sessions.get(session_id)
+            async with session.lock:
+                if persona:
+                    session.main_agent.set_persona(persona)
+                async for event, value in session.main_agent.stream_reply(message):
+                    if event == "text":
+                        parts.append(value)
+                    yield event, value
+        except Exception as e:
+            logger.error("流式生成回复时出错了喵: %s", e)
+            # 已经输出的内容无法撤回，只在什么都没输出时补一句兜底回复
+            if not parts:
+                parts.append(FALLBACK_REPLY)
+                yield "text", parts[0]
+            yield "expression", FALLBACK_EXPRESSION
+            yield "done", {"reply": "".join(parts), "expression": FALLBACK_EXPRESSION}
@@ -1,5 +1,9 @@
+import json
 import os
 
+# 环境变量覆盖配置时使用的前缀，见 Config.load_env_overrides
+ENV_PREFIX = "LLM2D_"
+
 class Config:
     # ''' LLM配置 ,deepseek示例 , openai格式''' 
     # LLM_API_URL = "https://api.deepseek.com/v1/chat/completions"
@@ -11,20 +15,182 @@ class Config:
     LLM_API_KEY = os.getenv("DASHSCOPE_API_KEY")
     LLM_MODEL = "qwen-plus"  # 新增LLM模型配置
 
+    ''' LLM连接池配置 '''
+    LLM_TIMEOUT = 120.0                 # 单次请求超时（秒）
+    LLM_MAX_CONNECTIONS = 20            # 连接池最大连接数
+    LLM_MAX_KEEPALIVE_CONNECTIONS = 10  # 最多保留的空闲长连接
+    LLM_KEEPALIVE_EXPIRY = 60.0         # 空闲长连接保留时间（秒）
+    LLM_HTTP2 = True                    # 启用HTTP/2（需要 pip install "httpx[http2]"）
+
+    ''' 超时、对冲与熔断配置 '''
+    LLM_ATTEMPT_TIMEOUT = 30.0  # 单次LLM请求的超时（秒），流式请求为首个片段和相邻片段之间的最长等待
+    LLM_DEADLINE = 60.0         # 一次生成（包括重试）的总时限（秒）
+    LLM_HEDGE_ENABLED = True    # 请求慢于最近的 p95 耗时时再发出一次相同的请求，取先返回的结果
+    BREAKER_FAILURES = 5        # LLM/TTS 连续失败多少次后熔断，熔断期间直接失败
+    BREAKER_RESET = 30.0        # 熔断多久（秒）后放行一次探测请求
+    # 备用LLM，主服务失败或熔断时使用，可以是另一种风格的模型；地址为空时不启用
+    LLM_FALLBACK_API_URL = ""   # 例如 "https://api.deepseek.com/v1/chat/completions"
+    LLM_FALLBACK_API_KEY = os.getenv("LLM_FALLBACK_API_KEY")
+    LLM_FALLBACK_MODEL = "deepseek-chat"
+
+    ''' 准入控制与限流配置 '''
+    ADMISSION_ENABLED = True          # 按通道限制同时处理的请求数，超出的请求排队，队列满或排队超时时返回 429
+    ADMISSION_CHAT_CONCURRENCY = 32   # 交互通道（/api/chat、/api/chat/stream）同时处理的最大请求数
+    ADMISSION_CHAT_QUEUE = 64         # 交互通道最多排队的请求数
+    ADMISSION_CHAT_TIMEOUT = 5.0      # 交互通道的最长排队时间（秒）
+    ADMISSION_UPLOAD_CONCURRENCY = 2  # 批量通道（/api/upload）同时处理的最大请求数
+    ADMISSION_UPLOAD_QUEUE = 8        # 批量通道最多排队的请求数
+    ADMISSION_UPLOAD_TIMEOUT = 60.0   # 批量通道的最长排队时间（秒）
+    # 各服务商的请求速率上限（每秒请求数，0 表示不限制）和允许的突发请求数，按服务商的速率限额设置；
+    # 令牌不够时聊天请求先于文档上传和后台任务拿到令牌
+    LLM_RATE_LIMIT = 0
+    LLM_RATE_BURST = 10
+    EMBEDDING_RATE_LIMIT = 0
+    EMBEDDING_RATE_BURST = 10
+    TTS_RATE_LIMIT = 0
+    TTS_RATE_BURST = 5
+
     ''' 向量模型配置 '''
     EMBEDDING_API_KEY = os.getenv("DASHSCOPE_API_KEY")
     EMBEDDING_API_URL = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-embeddings/embeddings"
     EMBEDDING_MODEL = "text-embedding-v3"
     EMBEDDING_DIMENSION = 1024
+    EMBEDDING_BATCH_SIZE = 10          # 单次请求的最大文本数（text-embedding-v3 上限为10）
+    EMBEDDING_COALESCE_WINDOW = 0.01   # 合并并发单条请求的等待窗口（秒）
+    EMBEDDING_MAX_CONCURRENCY = 4      # 同时进行的批量请求数，超出的批次排队（聊天先于上传）
+    EMBEDDING_CACHE_ENABLED = True     # 持久化缓存向量，重启后不再重复请求
+    EMBEDDING_CACHE_DIR = "save/embedding_cache"
+    EMBEDDING_CACHE_DTYPE = "float16"  # 磁盘存储精度，float16 或 float32
+    EMBEDDING_CACHE_MEMORY_ITEMS = 4096  # 内存中保留的最近使用向量数
     
+    ''' 回复缓存配置 '''
+    RESPONSE_CACHE_ENABLED = False       # 重复或几乎相同的短消息直接返回之前的回复（默认关闭）
+    RESPONSE_CACHE_TTL = 600.0           # 缓存回复的有效期（秒）
+    RESPONSE_CACHE_MAX_ENTRIES = 10000   # 缓存的最大总条数
+    RESPONSE_CACHE_SCOPE_ENTRIES = 64    # 每个会话（按人设区分）的最大条数
+    RESPONSE_CACHE_SIMILARITY = 0.95     # 近似匹配的最低余弦相似度，需要启用向量模型
+    RESPONSE_CACHE_MAX_CHARS = 32        # 只缓存不超过该长度的消息
+
     ''' TTS服务配置 '''
     FISH_API_KEY =""
+    FISH_API_URL = "https://api.fish.audio"  # TTS服务地址，压测时指向本地模拟服务
     
     FISH_REFERENCE_ID = "e70cc8ccf9fe41809e8e25c4de9ece78"
-    
+    TTS_MAX_CONCURRENCY = 4  # 按句合成时的最大并发数
+    TTS_TIMEOUT = 20.0       # 单句合成的总时限（秒，包括重试），超时的句子返回空音频
+    TTS_ATTEMPT_TIMEOUT = 8.0  # 单次合成请求的超时（秒）
+    TTS_MAX_ATTEMPTS = 3     # 单句最多尝试次数
+    TTS_HEDGE_ENABLED = True # 合成慢于最近的 p95 耗时时再发出一次相同的请求
+    TTS_CACHE_ENABLED = True                     # 缓存合成结果，重复的句子不再远程合成
+    TTS_CACHE_DIR = "save/tts_cache"             # 磁盘缓存目录
+    TTS_CACHE_MEMORY_BYTES = 32 * 1024 * 1024    # 内存缓存上限（字节）
+    AUDIO_STORE_MAX_BYTES = 64 * 1024 * 1024     # 暂存待前端获取的语音的最大字节数
+    AUDIO_STORE_TTL = 600.0                      # 语音地址的有效期（秒）
+    AUDIO_MEDIA_TYPE = "audio/mpeg"              # 返回语音的 Content-Type，与 TTS 输出格式一致
+
+    ''' 人设配置 '''
+    # 人设提示词目录，每个 .txt 文件是一个人设，名称为文件名（不含扩展名）；相对本文件所在目录，与启动时的工作目录无关
+    PERSONA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts")
+    PERSONA_DEFAULT = "reply"        # 会话和请求没有指定人设时使用的人设
+    PERSONA_RELOAD_INTERVAL = 2.0    # 检查提示词文件是否修改的间隔（秒），修改后自动重新加载，0 表示每次请求都检查
+
+    ''' 启动预热配置 '''
+    WARMUP_ENABLED = True     # 启动后在后台预先建立服务连接，并合成常用语句和兜底回复的语音
+    WARMUP_CONCURRENCY = 1    # 预热时同时合成的句数，尽量不占用用户请求的 TTS 并发
+    # 各人设预先合成的常用语句，不存在的人设跳过
+    WARMUP_PHRASES = {
+        "reply": [
+            "你好呀，今天过得怎么样？",
+            "我一直在这里陪着你。",
+            "别担心，慢慢来，一切都会好起来的。",
+            "谢谢你愿意和我分享。",
+            "晚安，做个好梦。"
+        ],
+        "suliyan": [
+            "你好，我是苏理言。",
+            "情绪就像宇宙中的星星，都有自己的运行轨迹。",
+            "我们一起慢慢梳理一下吧。",
+            "晚安，愿你的梦里有璀璨的星河。"
+        ],
+        "world_end_watcher": [
+            "你来了。",
+            "风会记得一切，我也会。",
+            "即使世界终结，我依然在这里守望。",
+            "去睡吧，黎明会再来的。"
+        ]
+    }
+
     ''' 对话历史配置 '''
     MAX_TURNS = 20
+    MEMORY_MIN_SIMILARITY = 0.3  # 记忆检索的最低余弦相似度，低于该值的归档对话不会被召回
+    CONTEXT_MAX_TOKENS = 2000    # 原样发送的历史对话的 token 预算，更早的对话合并进滚动摘要
+    SUMMARY_MAX_TOKENS = 300     # 滚动摘要的 token 上限
+    MEMORY_MAX_RESIDENT = 200    # 每个会话内存中最多常驻的归档对话数，其余的存放在会话目录的 archive.db 中
+    MEMORY_MAX_INDEXED = 1000    # 每个会话记忆索引最多保留的归档对话数，更早的对话只保留在滚动摘要里
+    MEMORY_MAX_STORED = 2000     # 每个会话 archive.db 最多保留的归档对话数，超出时删除最早的对话
+
+    ''' 文档总结配置 '''
+    DOC_CHUNK_TOKENS = 1500         # 文档切块的最大 token 数
+    DOC_SUMMARY_CONCURRENCY = 4     # 并行总结文档块的最大 LLM 调用数
+    DOC_REDUCE_TOKENS = 3000        # 最终总结提示词中要点部分的 token 预算
+    DOC_LLM_ATTEMPT_TIMEOUT = 120.0 # 文档总结提示词单次LLM请求的超时（秒），不做对冲
+    DOC_LLM_DEADLINE = 300.0        # 文档总结提示词每次生成（包括重试）的总时限（秒）
+    DOC_MIN_SUMMARY_RATIO = 0.5     # 总结成功的文档块低于这个比例时上传失败 (422)，不返回只覆盖一部分文档的总结
+    DOC_PARSE_WORKERS = 2           # 同时运行的 PDF/Word 解析进程数
+    DOC_PARSE_TIMEOUT = 120.0       # 单个文件的解析超时时间（秒）
+    DOC_PARSE_MEMORY_MB = 1024      # 每个解析进程可额外使用的内存（MB），0 表示不限制
+    DOC_PDF_PAGES_PER_TASK = 16     # 解析进程每批发回的 PDF 页数
+    DOC_INDEX_CHUNK_TOKENS = 300    # 文档检索片段的最大 token 数
+    DOC_INDEX_MAX_DOCUMENTS = 5     # 每个会话最多保留的上传文档数
+    DOC_MIN_SIMILARITY = 0.3        # 文档向量检索的最低余弦相似度
+    UPLOAD_CACHE_ENABLED = True     # 是否缓存上传文档的总结和语音
+    UPLOAD_CACHE_DIR = "save/upload_cache"
+    UPLOAD_CACHE_MAX_BYTES = 256 * 1024 * 1024  # 上传缓存的最大磁盘占用
+
+    ''' 会话管理配置 '''
+    SESSION_DIR = "save/sessions"   # 会话持久化目录，每个会话一个子目录
+    SESSION_MAX_ACTIVE = 100        # 内存中最多保留的会话数，超出时淘汰最久未访问的会话
+    SESSION_IDLE_TTL = 1800         # 会话空闲多久（秒）后写入磁盘并移出内存
+    SESSION_SWEEP_INTERVAL = 60     # 检查空闲会话的间隔（秒）
+
+    ''' 日志配置 '''
+    LOG_FLUSH_INTERVAL = 1.0        # 对话日志和用户信息的后台刷新间隔（秒）
+    LOG_FLUSH_BATCH = 256           # 积攒到这么多条日志时立即刷新
+    LOG_QUEUE_SIZE = 10000          # 日志队列上限，超出时丢弃
+    LOG_MAX_BYTES = 10 * 1024 * 1024  # 单个日志文件的最大字节数，超出时滚动
+    LOG_LEVEL = "INFO"              # 运行日志级别：DEBUG 会输出原始回复、相关记忆等调试信息
+    LOG_SAMPLE_RATE = 1.0           # WARNING 以下的运行日志的保留比例，高流量时可以调低
+
+    ''' 指标配置 '''
+    METRICS_ENABLED = True          # 提供 Prometheus 格式的 /metrics 接口
+    METRICS_TIMING_HEADER = False   # 在响应头 Server-Timing 中返回各阶段耗时
     
+    @classmethod
+    def load_env_overrides(cls, prefix: str = ENV_PREFIX) -> None:
+        """
+        用环境变量覆盖配置，变量名为前缀加配置名，例如 LLM2D_LLM_API_URL
+
+        值按配置默认值的类型转换（布尔值接受 1/true/yes/on，字典和列表为 JSON），
+        不需要改代码就能把服务指向其他地址，压测脚本用它把 LLM、向量和 TTS 指向本地模拟服务
+        """
+        for name, default in list(vars(cls).items()):
+            if not name.isupper() or prefix + name not in os.environ:
+                continue
+            value = os.environ[prefix + name]
+            if isinstance(default, bool):
+                value = value.strip().lower() in ("1", "true", "yes", "on")
+            elif isinstance(default, (dict, list)):
+                value = json.loads(value)
+            elif isinstance(default, (int, float)):
+                value = type(default)(value)
+            setattr(cls, name, value)
+
     @classmethod
     def is_tts_enabled(cls) -> bool:
         return bool(cls.FISH_API_KEY and cls.FISH_API_KEY.strip())
+
+    @classmethod
+    def is_embedding_enabled(cls) -> bool:
+        return bool(cls.EMBEDDING_API_KEY and cls.EMBEDDING_API_KEY.strip())
+
+Config.load_env_overrides()
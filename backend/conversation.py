@@ -1,66 +1,269 @@
 import asyncio
-from typing import List
-import uuid
-from datetime import datetime
+import json
+import logging
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from archive_store import ArchiveStore
+from embedding import EmbeddingService
+from llm import LLMService
+from memory_index import VectorIndex
+from text_utils import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# 把移出上下文的对话合并进滚动摘要
+SUMMARY_PROMPT = (
+    "下面是一段对话之前的摘要和随后的新对话。请把新对话中值得记住的信息"
+    "（用户的经历、情绪、偏好、约定和还没聊完的话题）合并进摘要，"
+    "输出新的摘要，不超过{limit}字，只输出摘要本身：\n\n"
+    "之前的摘要：\n{summary}\n\n"
+    "新对话：\n{dialog}"
+)
 
 class ConversationTurn:
+    __slots__ = ("ask", "answer", "tokens", "timestamp")
+
     def __init__(self, ask: str, answer: str):
         self.ask = ask
         self.answer = answer
+        self.tokens = estimate_tokens(ask) + estimate_tokens(answer)
+        self.timestamp = time.time()
 
     def __str__(self):
         return f"user: {self.ask}\nassistant: {self.answer}"
 
 
 class ConversationHistory:
-    def __init__(self, max_turns: int = 20):
+    def __init__(
+        self,
+        max_turns: int = 20,
+        embedding_service: Optional[EmbeddingService] = None,
+        min_similarity: float = 0.0,
+        llm_service: Optional[LLMService] = None,
+        context_tokens: int = 2000,
+        summary_tokens: int = 300,
+        archive_path: Optional[str] = None,
+        max_resident: int = 200,
+        max_indexed: int = 1000,
+        max_stored: int = 2000
+    ):
+        """
+        Args:
+            max_turns (int): 保留在上下文中的最大对话轮数，达到后归档较早的一半
+            embedding_service (EmbeddingService): 向量服务，为 None 时不检索归档记忆
+            min_similarity (float): 记忆检索的最低余弦相似度
+            llm_service (LLMService): 用于生成滚动摘要，为 None 时移出上下文的对话不做摘要
+            context_tokens (int): 原样放进提示词的历史对话的 token 预算
+            summary_tokens (int): 滚动摘要的 token 上限
+            archive_path (str): 归档对话溢出到的 SQLite 文件，为 None 时超出常驻上限的归档对话被丢弃
+            max_resident (int): 内存中最多常驻的归档对话数
+            max_indexed (int): 记忆索引最多保留的归档对话数，超出时最早的对话不再参与检索
+            max_stored (int): SQLite 中最多保留的归档对话数，超出时删除最早的对话
+        """
         self.turns = []
         self.max_turns = max_turns
-        self.memory = {}  # 使用字典作为简单的内存存储
+        self.archive = ArchiveStore(archive_path, max_resident, max_stored)  # 已归档对话的文本
+        self.embedding_service = embedding_service
+        self.min_similarity = min_similarity
+        self.max_indexed = max_indexed
+        self.memory_index = VectorIndex()  # 已归档对话的向量索引，条目为归档记录ID
+        # 向量获取失败的归档对话 (文本, 记录ID)，下次归档或加载时重试
+        self._unindexed: List[Tuple[str, int]] = []
 
-    def add_dialog(self, user_message: str, assistant_message: str):
+        self.llm_service = llm_service
+        self.context_tokens = context_tokens
+        self.summary_tokens = summary_tokens
+        self.summary = ""  # 已移出上下文的对话的滚动摘要
+        # 后台归档任务按顺序执行，保证摘要按对话顺序合并
+        self._archive_lock = asyncio.Lock()
+        self._pending: Set[asyncio.Task] = set()
+
+    async def add_dialog(self, user_message: str, assistant_message: str):
         """添加新对话，并在需要时触发自动归档"""
         turn = ConversationTurn(user_message, assistant_message)
         self.turns.append(turn)
-        
-        # 将对话存储到内存中
-        dialog_id = str(uuid.uuid4())
-        self.memory[dialog_id] = {
-            "timestamp": datetime.now().isoformat(),
-            "user_message": user_message,
-            "assistant_message": assistant_message
-        }
-        
-        # 当对话数量达到最大值时，自动归档一半的对话
-        if len(self.turns) >= self.max_turns:
-            self._auto_archive()
-
-    def _auto_archive(self):
-        """自动归档对话"""
-        # 计算需要归档的对话数量
-        archive_count = len(self.turns) // 2
+
+        # 对话轮数达到上限或超出 token 预算时，自动归档较早的对话
+        if len(self.turns) >= self.max_turns or self._context_size() > self.context_tokens:
+            await self._auto_archive()
+
+    def _context_size(self) -> int:
+        return sum(turn.tokens for turn in self.turns)
+
+    async def _auto_archive(self):
+        """
+        自动归档对话
+
+        较早的对话移出上下文，直到剩余轮数和 token 数都不超过上限的一半，
+        留出余量，避免之后每一轮都触发归档、让历史消息的前缀频繁变化。
+        计算向量和合并摘要需要调用远程服务，放到后台任务中执行，不占用请求时间。
+        """
+        archive_count = 0
+        remaining = self._context_size()
+        while archive_count < len(self.turns) - 1 and (
+            len(self.turns) - archive_count > self.max_turns // 2 or remaining > self.context_tokens // 2
+        ):
+            remaining -= self.turns[archive_count].tokens
+            archive_count += 1
+        if archive_count == 0:
+            return
         archived_dialogs = self.turns[:archive_count]
-        
-        # 将归档的对话存储到内存中
-        for dialog in archived_dialogs:
-            dialog_id = str(uuid.uuid4())
-            self.memory[dialog_id] = {
-                "timestamp": datetime.now().isoformat(),
-                "user_message": dialog.ask,
-                "assistant_message": dialog.answer
-            }
-        
+
+        # 每轮对话只在移出上下文时写入归档存储一次
+        ids = [self.archive.add(turn.ask, turn.answer, turn.timestamp) for turn in archived_dialogs]
+
         # 移除已归档的对话
         self.turns = self.turns[archive_count:]
+
+        task = asyncio.create_task(self._archive(archived_dialogs, ids))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _archive(self, turns: List[ConversationTurn], ids: List[int]) -> None:
+        """后台归档：写入记忆索引，把超出常驻上限的归档对话移到磁盘，并把对话合并进滚动摘要"""
+        async with self._archive_lock:
+            try:
+                # 归档时计算一次向量写入索引，之后检索不再重复计算
+                await self._index_turns([str(turn) for turn in turns], ids)
+                await asyncio.to_thread(self.archive.spill)
+                await self._fold_summary(turns)
+            except Exception as e:
+                logger.error("归档对话出错: %s", e)
+
+    async def _fold_summary(self, turns: List[ConversationTurn]) -> None:
+        """把移出上下文的对话合并进滚动摘要，失败时保留原摘要"""
+        if not self.llm_service:
+            return
+        prompt = SUMMARY_PROMPT.format(
+            limit=self.summary_tokens,
+            summary=self.summary or "无",
+            dialog="\n".join(str(turn) for turn in turns)
+        )
+        try:
+            summary = await self.llm_service.generate_response(prompt, temperature=0.3)
+        except Exception as e:
+            logger.warning("更新对话摘要失败: %s", e)
+            return
+        # 模型没有遵守字数要求时截断，保证摘要的大小有上限（一个字符至多一个 token）
+        if estimate_tokens(summary) > self.summary_tokens:
+            summary = summary[:self.summary_tokens]
+        self.summary = summary.strip()
+
+    async def wait_archived(self) -> None:
+        """等待后台归档任务完成，保存会话状态前调用"""
+        if self._pending:
+            await asyncio.gather(*list(self._pending), return_exceptions=True)
+
+    async def _index_turns(self, texts: List[str], ids: List[int]) -> None:
+        """
+        计算对话向量并写入记忆索引，先重试之前向量获取失败的对话；
+        这次仍然失败的对话留在重试队列中，不会从归档和之后的重建中丢失。
+        超出 max_indexed 时删除最早的条目，索引占用的内存有上限
+        """
+        if not self.embedding_service:
+            return
+        records = self._unindexed + list(zip(texts, ids))
+        if not records:
+            return
+        embeddings = await self.embedding_service.get_embeddings([text for text, _ in records])
+        indexed = []
+        unindexed = []
+        for (text, record_id), emb in zip(records, embeddings):
+            if emb:
+                indexed.append((emb, record_id))
+            else:
+                unindexed.append((text, record_id))
+        # 重试队列同样有上限，只保留最近的对话
+        self._unindexed = unindexed[-self.max_indexed:]
+        if unindexed:
+            logger.warning("%d 条归档对话的向量获取失败，等待下次重试", len(unindexed))
+        if indexed:
+            self.memory_index.add([emb for emb, _ in indexed], [record_id for _, record_id in indexed])
+        self.memory_index.remove_oldest(len(self.memory_index) - self.max_indexed)
         
     def get_context(self) -> str:
         """获取格式化后的对话上下文"""
         return "\n".join(str(turn) for turn in self.turns)
+
+    def get_messages(self) -> List[Dict[str, str]]:
+        """
+        以多轮 user / assistant 消息的形式返回对话上下文
+
+        历史只在末尾追加，作为请求前缀时可以命中服务商的前缀缓存；
+        assistant 消息按输出格式包装成 JSON，避免模型模仿成纯文本回复。
+        只保留 token 预算内最新的若干轮：后台归档还没完成时，超出预算的旧对话也不会被发送。
+        """
+        budget = self.context_tokens
+        start = len(self.turns)
+        while start > 0 and self.turns[start - 1].tokens <= budget:
+            budget -= self.turns[start - 1].tokens
+            start -= 1
+
+        messages = []
+        for turn in self.turns[start:]:
+            messages.append({"role": "user", "content": turn.ask})
+            messages.append({"role": "assistant", "content": json.dumps({"reply": turn.answer}, ensure_ascii=False)})
+        return messages
         
-    def retrieve(self, user_message: str, n_results: int = 3) -> List[str]:
-        """获取与用户消息最相关的历史记忆"""
-        # 简单地返回最近的对话作为模拟的记忆
-        return [turn.answer for turn in self.turns[-n_results:] if turn.answer]
+    def to_dict(self) -> dict:
+        """
+        导出可持久化的状态；归档对话的文本在 SQLite 中，这里只保存索引中和等待重试的记录ID，
+        保存前需要先调用 archive.flush()，向量在加载时重新获取（命中向量缓存）
+        """
+        return {
+            "turns": [[turn.ask, turn.answer] for turn in self.turns],
+            "indexed": self.memory_index.items,
+            "unindexed": [record_id for _, record_id in self._unindexed],
+            "summary": self.summary
+        }
+
+    async def load_dict(self, data: dict) -> None:
+        """从 to_dict 导出的状态恢复，并重建记忆索引"""
+        self.turns = [ConversationTurn(ask, answer) for ask, answer in data.get("turns", [])]
+        self.summary = data.get("summary", "")
+        self.memory_index = VectorIndex()
+        self._unindexed = []
+
+        if "archived" in data:
+            # 旧格式：归档对话的文本直接保存在 history.json 中，迁移到归档存储
+            records = [
+                (self.archive.add(ask, answer), str(ConversationTurn(ask, answer)))
+                for ask, answer in data["archived"]
+            ]
+            await asyncio.to_thread(self.archive.spill)
+        else:
+            # 只读出文本用于计算向量，不放进常驻缓存
+            ids = data.get("indexed", []) + data.get("unindexed", [])
+            archived = await asyncio.to_thread(self.archive.get, ids, False)
+            records = [(record.id, str(record)) for record in archived]
+        await self._index_turns([text for _, text in records], [record_id for record_id, _ in records])
+
+    async def retrieve(self, user_message: str, n_results: int = 3) -> List[str]:
+        """获取与用户消息语义最相关的已归档对话"""
+        if self.embedding_service and len(self.memory_index) > 0:
+            query = await self.embedding_service.embed(user_message)
+            if query:
+                results = self.memory_index.search(query, n_results, self.min_similarity)
+                ids = [record_id for record_id, _ in results]
+                if self.archive.is_resident(ids):
+                    records = self.archive.get(ids)
+                else:
+                    # 命中已移到磁盘的归档对话时，在线程中从 SQLite 读回
+                    records = await asyncio.to_thread(self.archive.get, ids)
+                return [str(record) for record in records]
+
+        # 没有向量服务或索引为空时不补充记忆：最近的对话已经作为历史消息发送，不再重复
+        return []
+
+    def get_stats(self) -> dict:
+        """会话的内存占用：上下文中的对话、常驻的归档对话和记忆索引"""
+        return {
+            "turns": len(self.turns),
+            "indexed": len(self.memory_index),
+            "index_bytes": self.memory_index.nbytes,
+            **self.archive.get_stats()
+        }
 
 
 if __name__ == "__main__":
@@ -73,7 +276,7 @@ if __name__ == "__main__":
         #await conversation_history.archive(1, 1, "电影推荐")
         #await conversation_history.archive(0, 0, "广州有什么好吃的")
         
-        memories = conversation_history.retrieve("广州美食", n_results=1)
+        memories = await conversation_history.retrieve("广州美食", n_results=1)
         print("--------------------------------")
         print(memories)
 
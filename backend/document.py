@@ -0,0 +1,466 @@
+# document.py
+#
+# 文档解析与总结
+#
+# 主要功能包括：
+# 1. 每个文件在独立的解析进程中逐批读取 PDF 页面、Word 段落 (DocumentExtractor)，
+#    解析不占用主进程的 GIL，长文档不会卡住其他聊天请求；纯文本在线程中逐行读取
+# 2. 按 token 预算把文本片段合并成块 (ChunkBuffer / chunk_texts)
+# 3. map-reduce 总结：各块在有限并发下并行总结 (map)，
+#    部分总结超出预算时分组再总结 (reduce)，最后用陪伴者的口吻生成完整总结
+# 整个文档都会被覆盖，不再只取前 4000 个字符；同一时间只有正在总结的块在内存中。
+import asyncio
+import itertools
+import logging
+import multiprocessing
+from typing import AsyncIterator, Iterable, Iterator, List, Optional, Set
+
+try:
+    import resource
+except ImportError:
+    # Windows 没有 resource 模块，解析进程不限制内存
+    resource = None
+
+from docx import Document
+import PyPDF2
+
+from llm import LLMService
+from text_utils import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# 总结时的人设，与聊天回复的口吻保持一致
+CHARACTER_SETTING = "你是一个温柔、乐观、喜欢用比喻和鼓励的话语和用户交流的虚拟助手。"
+
+MAP_PROMPT = (
+    "下面是一份长文档中的一个片段，请用简洁的中文提炼这个片段的要点，"
+    "保留关键事实、数据和结论，不超过200字，不要加入评论：\n{text}"
+)
+
+REDUCE_PROMPT = (
+    "下面是同一份文档若干片段的要点，请把它们合并成一份连贯的要点概述，"
+    "去掉重复内容，不超过400字：\n{text}"
+)
+
+FINAL_PROMPT = (
+    "{character_setting}\n"
+    "请用自然口语、完整段落、不要列表、不要星号、不要编号，像和朋友聊天一样总结以下文档内容。"
+    "表达要富有情感和语气，适当使用强调和重音词汇，让听起来更像真人说话：\n"
+    "{text}"
+)
+
+
+def iter_text_lines(path: str) -> Iterator[str]:
+    """逐行读取纯文本文件"""
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            if line.strip():
+                yield line
+
+
+def _address_space_size() -> int:
+    """当前进程已占用的虚拟地址空间（字节），无法获取时返回 0"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * resource.getpagesize()
+    except (OSError, ValueError):
+        return 0
+
+
+def _init_worker(memory_limit_mb: int) -> None:
+    """
+    解析进程初始化：限制进程的地址空间，异常文档耗尽内存时只影响该进程
+
+    解析进程从主进程 fork 而来，继承了主进程已占用的地址空间，
+    因此上限是在当前占用的基础上再允许增长 memory_limit_mb
+    """
+    if resource is not None and memory_limit_mb > 0:
+        limit = _address_space_size() + memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _iter_pdf_batches(path: str, pages_per_batch: int) -> Iterator[List[str]]:
+    """在解析进程中逐批提取 PDF 页面的文本，整个文件只打开一次"""
+    with open(path, "rb") as f:
+        reader = PyPDF2.PdfReader(f)
+        pages = reader.pages
+        for start in range(0, len(pages), pages_per_batch):
+            batch = []
+            for i in range(start, min(start + pages_per_batch, len(pages))):
+                text = pages[i].extract_text() or ""
+                if text.strip():
+                    batch.append(text)
+            yield batch
+
+
+def _iter_docx_batches(path: str, paragraphs_per_batch: int = 256) -> Iterator[List[str]]:
+    """在解析进程中逐批提取 Word 文档的段落"""
+    doc = Document(path)
+    paragraphs = [para.text + "\n" for para in doc.paragraphs if para.text.strip()]
+    for start in range(0, len(paragraphs), paragraphs_per_batch):
+        yield paragraphs[start:start + paragraphs_per_batch]
+
+
+def _parse_worker(conn, path: str, suffix: str, memory_limit_mb: int, pages_per_batch: int) -> None:
+    """
+    解析进程入口：逐批提取文本并通过管道发回父进程
+
+    消息依次为若干 ("texts", 文本列表)，最后是 ("done", None)；
+    出错时发送 ("memory", None) 或 ("error", 错误说明)。
+    管道写满时解析进程会阻塞，父进程读取多少就解析多少，不会提前把整份文档读进内存
+    """
+    _init_worker(memory_limit_mb)
+    try:
+        batches = _iter_pdf_batches(path, pages_per_batch) if suffix == ".pdf" else _iter_docx_batches(path)
+        for texts in batches:
+            conn.send(("texts", texts))
+        conn.send(("done", None))
+    except MemoryError:
+        conn.send(("memory", None))
+    except Exception as e:
+        conn.send(("error", str(e)))
+    finally:
+        conn.close()
+
+
+class ChunkBuffer:
+    """
+    按 token 预算把文本片段合并成块
+
+    不断 feed 文本片段（页、段落或行），凑满 max_tokens 时返回完整的块；
+    结束时调用 flush 取出最后一块。超长的单个片段会被截成多块。
+    """
+
+    def __init__(self, max_tokens: int = 1500):
+        self.max_tokens = max_tokens
+        self._buffer: List[str] = []
+        self._tokens = 0
+
+    def feed(self, piece: str) -> List[str]:
+        """追加一个文本片段，返回新完成的块列表"""
+        chunks = []
+        tokens = estimate_tokens(piece)
+        if tokens > self.max_tokens:
+            # 单个片段超长时按字符切开，每个字符至多算一个 token，保证每段不超预算
+            sub_pieces = [piece[i:i + self.max_tokens] for i in range(0, len(piece), self.max_tokens)]
+        else:
+            sub_pieces = [piece]
+
+        for sub in sub_pieces:
+            sub_tokens = tokens if len(sub_pieces) == 1 else estimate_tokens(sub)
+            if self._buffer and self._tokens + sub_tokens > self.max_tokens:
+                chunks.append("".join(self._buffer))
+                self._buffer, self._tokens = [], 0
+            self._buffer.append(sub)
+            self._tokens += sub_tokens
+        return chunks
+
+    def flush(self) -> List[str]:
+        """取出缓冲区中剩余的文本"""
+        rest = "".join(self._buffer)
+        self._buffer, self._tokens = [], 0
+        return [rest] if rest else []
+
+
+def chunk_texts(pieces: Iterable[str], max_tokens: int = 1500) -> Iterator[str]:
+    """把文本片段按 token 预算合并成块，每块不超过 max_tokens"""
+    buffer = ChunkBuffer(max_tokens)
+    for piece in pieces:
+        yield from buffer.feed(piece)
+    yield from buffer.flush()
+
+
+class DocumentParseError(Exception):
+    """文档解析失败（超时、超出内存限制或文件损坏）"""
+
+
+class DocumentSummaryError(DocumentParseError):
+    """文档读出了文字，但大部分文档块没有得到总结，上传接口同样按无法处理的文档返回"""
+
+
+class DocumentExtractor:
+    """
+    在独立进程中解析文档
+
+    PyPDF2 和 python-docx 是纯 Python 的 CPU 密集型解析，放在线程里也会因为 GIL
+    拖慢事件循环。DocumentExtractor 为每个文件启动一个解析进程：
+    1. 同时解析的文件数可配置，多个上传可以在多个 CPU 核上并行解析
+    2. PDF 只打开一次，按页分批发回，边解析边总结；解析进程最多领先一个管道缓冲区
+    3. 每个文件有总的解析超时，每个解析进程有内存上限；
+       超时时只结束这个文件自己的解析进程，同时在解析的其他上传不受影响
+    纯文本文件不需要解析库，仍然在线程中逐行读取。
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 2,
+        timeout: float = 120.0,
+        memory_limit_mb: int = 1024,
+        pdf_pages_per_task: int = 16
+    ):
+        """
+        Args:
+            max_workers (int): 同时运行的解析进程数，超出的文件排队等待
+            timeout (float): 单个文件的解析超时时间（秒）
+            memory_limit_mb (int): 每个解析进程可额外使用的内存上限（MB），0 表示不限制
+            pdf_pages_per_task (int): PDF 每批发回的页数
+        """
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.pdf_pages_per_task = pdf_pages_per_task
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._processes: Set[multiprocessing.Process] = set()
+
+        self.files = 0
+        self.failures = 0
+        self.terminated = 0
+
+    def startup(self) -> None:
+        """创建限制同时解析文件数的信号量"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers)
+
+    def shutdown(self) -> None:
+        """结束所有仍在运行的解析进程"""
+        for process in list(self._processes):
+            process.terminate()
+        self._processes.clear()
+
+    @staticmethod
+    def _receive(conn, timeout: float):
+        """在线程中等待解析进程的下一条消息，超时返回 None"""
+        if not conn.poll(timeout):
+            return None
+        return conn.recv()
+
+    async def _iter_process(self, path: str, suffix: str) -> AsyncIterator[str]:
+        """在独立的解析进程中解析 PDF 或 Word 文档，逐段产出文本"""
+        self.startup()
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.timeout
+            context = multiprocessing.get_context()
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(
+                target=_parse_worker,
+                args=(sender, path, suffix, self.memory_limit_mb, self.pdf_pages_per_task),
+                daemon=True
+            )
+            process.start()
+            sender.close()
+            self._processes.add(process)
+            try:
+                while True:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        # 正在运行的解析无法取消，只结束这个文件的进程
+                        process.terminate()
+                        self.terminated += 1
+                        raise DocumentParseError(f"文档解析超时（{self.timeout}秒）")
+                    try:
+                        # 分段等待，请求被取消时后台线程最多再占用 0.5 秒
+                        message = await asyncio.to_thread(self._receive, receiver, min(remaining, 0.5))
+                    except EOFError:
+                        raise DocumentParseError("解析进程异常退出，文档可能过大或已损坏") from None
+                    if message is None:
+                        continue
+                    kind, value = message
+                    if kind == "done":
+                        return
+                    if kind == "memory":
+                        raise DocumentParseError(f"文档解析超出内存限制（{self.memory_limit_mb}MB）")
+                    if kind == "error":
+                        raise DocumentParseError(f"文档解析失败: {value}")
+                    for text in value:
+                        yield text
+            finally:
+                # 提前停止读取（总结出错、客户端断开）时同样结束解析进程
+                if process.is_alive():
+                    process.terminate()
+                self._processes.discard(process)
+                await asyncio.to_thread(process.join, 5)
+                receiver.close()
+
+    @staticmethod
+    async def _iter_text(path: str) -> AsyncIterator[str]:
+        lines = iter_text_lines(path)
+        while True:
+            # 每次在线程中读取一批行，减少线程切换
+            batch = await asyncio.to_thread(lambda: list(itertools.islice(lines, 256)))
+            if not batch:
+                return
+            for line in batch:
+                yield line
+
+    async def iter_chunks(self, path: str, suffix: str, max_tokens: int = 1500) -> AsyncIterator[str]:
+        """
+        异步逐块读取文档
+
+        Args:
+            path (str): 文件路径
+            suffix (str): 文件后缀，决定解析方式
+            max_tokens (int): 每块的最大 token 数
+
+        Yields:
+            str: 不超过 max_tokens 的文本块
+
+        Raises:
+            DocumentParseError: 解析超时、超出内存限制或文件损坏
+        """
+        self.files += 1
+        if suffix in [".pdf", ".doc", ".docx"]:
+            pieces = self._iter_process(path, ".pdf" if suffix == ".pdf" else ".docx")
+        else:
+            pieces = self._iter_text(path)
+
+        buffer = ChunkBuffer(max_tokens)
+        try:
+            async for piece in pieces:
+                for chunk in buffer.feed(piece):
+                    yield chunk
+        except DocumentParseError:
+            self.failures += 1
+            raise
+        except Exception as e:
+            self.failures += 1
+            raise DocumentParseError(f"文档解析失败: {e}") from e
+        finally:
+            # 提前停止读取时结束解析进程
+            await pieces.aclose()
+        for chunk in buffer.flush():
+            yield chunk
+
+    def get_stats(self) -> dict:
+        return {
+            "workers": self.max_workers,
+            "running": len(self._processes),
+            "files": self.files,
+            "failures": self.failures,
+            "terminated": self.terminated
+        }
+
+
+async def _map_chunks(
+    llm_service: LLMService, chunks: AsyncIterator[str], concurrency: int, limits: dict
+) -> List[str]:
+    """
+    并行总结各块，返回按原文顺序排列的部分总结，与文档块一一对应
+
+    先拿到信号量再读取下一块，同一时间最多 concurrency 块在内存中。
+    单块总结失败时该块的总结为空字符串，不影响其余部分，由调用方决定能否接受。
+    """
+    iterator = chunks.__aiter__()
+    first = await anext(iterator, None)
+    if first is None:
+        return []
+    second = await anext(iterator, None)
+    if second is None:
+        # 只有一块时直接使用原文，省掉一次 LLM 调用
+        return [first]
+
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks: List[asyncio.Task] = []
+
+    async def summarize(chunk: str) -> str:
+        try:
+            return await llm_service.generate_response(MAP_PROMPT.format(text=chunk), temperature=0.3, **limits)
+        except Exception as e:
+            logger.warning("文档片段总结失败，跳过该片段: %s", e)
+            return ""
+        finally:
+            semaphore.release()
+
+    async def submit(chunk: str) -> None:
+        await semaphore.acquire()
+        tasks.append(asyncio.create_task(summarize(chunk)))
+
+    try:
+        await submit(first)
+        await submit(second)
+        async for chunk in iterator:
+            await submit(chunk)
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+async def _reduce(
+    llm_service: LLMService, summaries: List[str], max_tokens: int, concurrency: int, limits: dict
+) -> str:
+    """把部分总结分组合并，直到总长度不超过 max_tokens"""
+    while len(summaries) > 1 and estimate_tokens("\n".join(summaries)) > max_tokens:
+        groups: List[List[str]] = [[]]
+        group_tokens = 0
+        for summary in summaries:
+            tokens = estimate_tokens(summary)
+            if groups[-1] and group_tokens + tokens > max_tokens:
+                groups.append([])
+                group_tokens = 0
+            groups[-1].append(summary)
+            group_tokens += tokens
+
+        if len(groups) == len(summaries):
+            # 每组只剩一条时无法继续合并，保留现有结果
+            break
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def merge(group: List[str]) -> str:
+            if len(group) == 1:
+                return group[0]
+            async with semaphore:
+                return await llm_service.generate_response(
+                    REDUCE_PROMPT.format(text="\n".join(group)), temperature=0.3, **limits
+                )
+
+        summaries = list(await asyncio.gather(*(merge(group) for group in groups)))
+
+    return "\n".join(summaries)
+
+
+async def summarize_document(
+    llm_service: LLMService,
+    chunks: AsyncIterator[str],
+    concurrency: int = 4,
+    reduce_tokens: int = 3000,
+    attempt_timeout: Optional[float] = None,
+    deadline: Optional[float] = None,
+    min_summary_ratio: float = 0.5
+) -> str:
+    """
+    map-reduce 总结整份文档
+
+    Args:
+        llm_service (LLMService): LLM 服务
+        chunks: 文档文本块（见 DocumentExtractor.iter_chunks）
+        concurrency (int): 同时进行的 LLM 调用数
+        reduce_tokens (int): 最终总结提示词中要点部分的 token 预算
+        attempt_timeout (float): 每次 LLM 调用单次尝试的超时（秒），为 None 时使用聊天的设置
+        deadline (float): 每次 LLM 调用（包括重试）的总时限（秒），为 None 时使用聊天的设置
+        min_summary_ratio (float): 至少要有这个比例的文档块总结成功，否则不生成总结
+
+    Returns:
+        str: 陪伴者口吻的文档总结
+
+    Raises:
+        DocumentSummaryError: 文档有内容，但总结成功的文档块不足 min_summary_ratio
+    """
+    # 总结提示词比聊天长得多，使用单独的超时，不受聊天的时限约束
+    limits = {"attempt_timeout": attempt_timeout, "deadline": deadline}
+    results = await _map_chunks(llm_service, chunks, concurrency, limits)
+    summaries = [summary for summary in results if summary]
+    # 只总结了一小部分的文档不能当作整份文档的总结返回（也会被写入上传缓存）
+    if results and len(summaries) < len(results) * min_summary_ratio:
+        raise DocumentSummaryError(f"{len(results) - len(summaries)}/{len(results)} 个文档片段总结失败")
+    if not summaries:
+        # 文档中没有文字
+        return await llm_service.generate_response(
+            FINAL_PROMPT.format(character_setting=CHARACTER_SETTING, text=""), **limits
+        )
+    digest = await _reduce(llm_service, summaries, reduce_tokens, concurrency, limits)
+    return await llm_service.generate_response(
+        FINAL_PROMPT.format(character_setting=CHARACTER_SETTING, text=digest), **limits
+    )
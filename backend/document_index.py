@@ -0,0 +1,286 @@
+# document_index.py
+#
+# 上传文档的检索索引
+#
+# 上传的文档在总结之后不再丢弃，而是切成小段写入所属会话的文档索引，
+# 后续聊天时只把与问题最相关的几段放进提示词的 {memory}，
+# 针对长文档提问不需要重新发送全文，也不需要重新总结。
+#
+# 检索采用 BM25 + 向量的混合方式：
+# 1. BM25 擅长精确匹配术语、人名、数字，中文按相邻两字切词，英文按单词切词
+# 2. 向量检索擅长语义相近但用词不同的问题，复用 EmbeddingService 和 VectorIndex
+# 3. 两路结果按倒数排名融合 (RRF)，不需要对两种分数做归一化
+#
+# 上传时由 DocumentWriter 边读取边切片段、在后台计算向量，与总结并行进行，
+# 不需要先收集整份文档；全部完成后 DocumentIndex.commit 一次性把文档换进索引。
+import asyncio
+import math
+import re
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from document import chunk_texts
+from embedding import EmbeddingService
+from memory_index import VectorIndex
+
+# 第一组匹配英文单词和数字，第二组匹配连续的中文
+_WORD_RE = re.compile(r"([a-z0-9]+)|([\u3400-\u4dbf\u4e00-\u9fff]+)")
+
+# BM25 参数
+BM25_K1 = 1.5
+BM25_B = 0.75
+# 倒数排名融合的平滑常数
+RRF_K = 60
+
+
+def tokenize(text: str) -> List[str]:
+    """BM25 切词：英文和数字按单词，中文按相邻两字（单字词保留单字）"""
+    tokens = []
+    for word, cjk in _WORD_RE.findall(text.lower()):
+        if word:
+            tokens.append(word)
+        elif len(cjk) == 1:
+            tokens.append(cjk)
+        else:
+            tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return tokens
+
+
+class DocumentWriter:
+    """
+    流式写入一份文档
+
+    每个文本块到达时立即切成检索片段，凑满一批就在后台请求向量，调用方不需要等待；
+    finish 等待所有向量完成，之后交给 DocumentIndex.commit 写入索引。
+    原始文本块不被保留，内存中只有最终写入索引的片段和向量。
+    """
+
+    def __init__(self, name: str, embedding_service: Optional[EmbeddingService] = None, chunk_tokens: int = 300):
+        """
+        Args:
+            name (str): 文档名
+            embedding_service (EmbeddingService): 向量服务，为 None 时只写入 BM25
+            chunk_tokens (int): 检索片段的最大 token 数
+        """
+        self.name = name
+        self.embedding_service = embedding_service
+        self.chunk_tokens = chunk_tokens
+        self.batch_size = embedding_service.batch_size if embedding_service else 0
+
+        self.chunks: List[str] = []
+        self.embeddings: List[Optional[List[float]]] = []
+        self._unembedded = 0  # 还没有提交计算向量的片段的起始位置
+        self._tasks: List[asyncio.Task] = []
+
+    def add(self, text: str) -> None:
+        """追加一个文本块，切成检索片段，攒满一批时在后台计算向量"""
+        pieces = [
+            chunk for chunk in chunk_texts(text.splitlines(keepends=True), self.chunk_tokens)
+            if chunk.strip()
+        ]
+        self.chunks.extend(pieces)
+        self.embeddings.extend([None] * len(pieces))
+        if self.embedding_service and len(self.chunks) - self._unembedded >= self.batch_size:
+            self._embed_pending()
+
+    def _embed_pending(self) -> None:
+        start, end = self._unembedded, len(self.chunks)
+        if start < end:
+            self._unembedded = end
+            self._tasks.append(asyncio.create_task(self._embed(start, end)))
+
+    async def _embed(self, start: int, end: int) -> None:
+        self.embeddings[start:end] = await self.embedding_service.get_embeddings(self.chunks[start:end])
+
+    async def finish(self) -> None:
+        """提交剩余片段并等待所有向量完成"""
+        if self.embedding_service:
+            self._embed_pending()
+        try:
+            await asyncio.gather(*self._tasks)
+        finally:
+            self._tasks = []
+
+    def cancel(self) -> None:
+        """放弃写入（上传失败时调用），取消后台的向量请求"""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+
+class DocumentIndex:
+    def __init__(
+        self,
+        embedding_service: Optional[EmbeddingService] = None,
+        chunk_tokens: int = 300,
+        max_documents: int = 5,
+        min_similarity: float = 0.0
+    ):
+        """
+        Args:
+            embedding_service (EmbeddingService): 向量服务，为 None 时只使用 BM25
+            chunk_tokens (int): 检索片段的最大 token 数
+            max_documents (int): 最多保留的文档数，超出时丢弃最早上传的文档
+            min_similarity (float): 向量检索的最低余弦相似度
+        """
+        self.embedding_service = embedding_service
+        self.chunk_tokens = chunk_tokens
+        self.max_documents = max_documents
+        self.min_similarity = min_similarity
+
+        # 文档名 -> (片段列表, 片段向量)，向量获取失败的片段为 None
+        self._documents: "OrderedDict[str, Tuple[List[str], List[Optional[List[float]]]]]" = OrderedDict()
+        self._build_index()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def documents(self) -> List[str]:
+        """已索引的文档名，按上传顺序排列"""
+        return list(self._documents)
+
+    def _build_index(self) -> None:
+        """根据当前文档重建 BM25 倒排表和向量索引，删除或替换文档后调用"""
+        self._entries: List[Tuple[str, str]] = []
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._lengths = np.zeros(0, dtype=np.float32)
+        self._vector_index = VectorIndex()
+        for name, (chunks, embeddings) in self._documents.items():
+            self._index_document(name, chunks, embeddings)
+
+    def _index_document(self, name: str, chunks: List[str], embeddings: List[Optional[List[float]]]) -> None:
+        """把一份文档的片段追加到 BM25 倒排表和向量索引"""
+        lengths = []
+        vectors, vector_ids = [], []
+        for chunk, embedding in zip(chunks, embeddings):
+            entry_id = len(self._entries)
+            self._entries.append((name, chunk))
+            counts = Counter(tokenize(chunk))
+            for term, tf in counts.items():
+                self._postings.setdefault(term, []).append((entry_id, tf))
+            lengths.append(sum(counts.values()))
+            if embedding:
+                vectors.append(embedding)
+                vector_ids.append(entry_id)
+
+        self._lengths = np.concatenate([self._lengths, np.asarray(lengths, dtype=np.float32)])
+        self._avg_length = float(self._lengths.mean()) if len(self._lengths) else 0.0
+        if vectors:
+            self._vector_index.add(vectors, vector_ids)
+
+    async def add_document(self, name: str, texts: List[str]) -> int:
+        """
+        把文档切成检索片段、计算向量并写入索引，同名文档会被替换
+
+        Args:
+            name (str): 文档名
+            texts (List[str]): 文档文本（可以是总结时的大块，会再切成检索片段）
+
+        Returns:
+            int: 写入的片段数
+        """
+        writer = self.writer(name)
+        for text in texts:
+            writer.add(text)
+        await writer.finish()
+        return self.commit(writer)
+
+    def writer(self, name: str) -> DocumentWriter:
+        """创建与本索引使用相同切片和向量设置的 DocumentWriter"""
+        return DocumentWriter(name, self.embedding_service, self.chunk_tokens)
+
+    def commit(self, writer: DocumentWriter) -> int:
+        """
+        把 finish 之后的 DocumentWriter 写入索引，同名文档会被替换；
+        不做任何等待，调用方只需在这一步持有会话锁
+
+        Returns:
+            int: 写入的片段数
+        """
+        name, chunks, embeddings = writer.name, writer.chunks, writer.embeddings
+        if not chunks:
+            return 0
+
+        replaced = self._documents.pop(name, None) is not None
+        self._documents[name] = (chunks, embeddings)
+        if replaced or len(self._documents) > self.max_documents:
+            while len(self._documents) > self.max_documents:
+                self._documents.popitem(last=False)
+            self._build_index()
+        else:
+            # 只新增文档时追加到现有索引，不重建已有文档
+            self._index_document(name, chunks, embeddings)
+        return len(chunks)
+
+    def _bm25_scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self._entries), dtype=np.float32)
+        total = len(self._entries)
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            ids = np.fromiter((i for i, _ in postings), dtype=np.int64, count=len(postings))
+            tf = np.fromiter((f for _, f in postings), dtype=np.float32, count=len(postings))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[ids] / self._avg_length)
+            scores[ids] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores
+
+    async def search(self, query: str, k: int = 3) -> List[Tuple[str, str]]:
+        """
+        混合检索与问题最相关的文档片段
+
+        Args:
+            query (str): 用户问题
+            k (int): 返回的最大片段数
+
+        Returns:
+            List[Tuple[str, str]]: (文档名, 片段)，按相关度从高到低排列
+        """
+        if not self._entries or not query.strip():
+            return []
+
+        # 每一路多取几条候选，融合后再截取前 k 条
+        candidates = k * 4
+        fused: Dict[int, float] = {}
+
+        scores = self._bm25_scores(query)
+        hits = np.flatnonzero(scores > 0)
+        if len(hits):
+            ranked = hits[np.argsort(-scores[hits])][:candidates]
+            for rank, entry_id in enumerate(ranked):
+                fused[int(entry_id)] = fused.get(int(entry_id), 0.0) + 1.0 / (RRF_K + rank + 1)
+
+        if self.embedding_service and len(self._vector_index) > 0:
+            query_vector = await self.embedding_service.embed(query)
+            if query_vector:
+                results = self._vector_index.search(query_vector, candidates, self.min_similarity)
+                for rank, (entry_id, _) in enumerate(results):
+                    fused[entry_id] = fused.get(entry_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+
+        top = sorted(fused, key=fused.get, reverse=True)[:k]
+        return [self._entries[entry_id] for entry_id in top]
+
+    def to_dict(self) -> dict:
+        """导出可持久化的状态，只保存片段文本，向量在加载时重新获取（命中向量缓存）"""
+        return {
+            "documents": [
+                {"name": name, "chunks": chunks}
+                for name, (chunks, _) in self._documents.items()
+            ]
+        }
+
+    async def load_dict(self, data: dict) -> None:
+        """从 to_dict 导出的状态恢复，并重建索引"""
+        self._documents.clear()
+        for document in data.get("documents", []):
+            chunks = document.get("chunks", [])
+            if self.embedding_service and chunks:
+                embeddings = await self.embedding_service.get_embeddings(chunks)
+            else:
+                embeddings = [None] * len(chunks)
+            self._documents[document["name"]] = (chunks, embeddings)
+        self._build_index()
@@ -1,14 +1,260 @@
+"""
+EmbeddingService 模块
+
+提供文本向量化服务：
+1. get_embeddings: 异步批量接口，按服务商的单次输入上限分批请求，复用连接池
+2. embed: 异步单条接口，短时间窗口内并发到达的单条请求会被合并成一次批量请求，
+   结果再分发回各自的调用方
+3. get_embedding: 原有的同步单条接口
+4. 可选的持久化向量缓存 (EmbeddingCache)，命中的文本不再请求接口
+
+请求格式根据 API 地址自动选择：DashScope 原生接口 (input.texts / output.embeddings)
+或 OpenAI 兼容接口 (input 列表 / data)。
+"""
+
+import logging
 import httpx
 import asyncio
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 import time
 
+from admission import PrioritySemaphore, TokenBucket
+from embedding_cache import EmbeddingCache
+from metrics import RETRIES
+
+logger = logging.getLogger(__name__)
+
 class EmbeddingService:
-    def __init__(self, api_key: str, api_url: str, model: str, dimension: int):
+    def __init__(
+        self,
+        api_key: str,
+        api_url: str,
+        model: str,
+        dimension: int,
+        batch_size: int = 10,
+        coalesce_window: float = 0.01,
+        timeout: float = 30.0,
+        max_connections: int = 10,
+        max_concurrency: int = 4,
+        cache: Optional[EmbeddingCache] = None,
+        rate_limiter: Optional[TokenBucket] = None
+    ):
+        """
+        Args:
+            api_key (str): API 访问密钥
+            api_url (str): API 端点 URL
+            model (str): 向量模型名称
+            dimension (int): 向量维度
+            batch_size (int): 单次请求的最大文本数（服务商的批量上限）
+            coalesce_window (float): 合并单条请求的等待窗口（秒）
+            timeout (float): 单次请求超时时间（秒）
+            max_connections (int): 连接池最大连接数
+            max_concurrency (int): 同时进行的批量请求数，大文档的几十个批次不会一起发出
+            cache (EmbeddingCache): 持久化向量缓存，为 None 时不缓存
+            rate_limiter (TokenBucket): 服务商的请求速率限制，为 None 时不限制
+        """
         self.api_key = api_key
         self.api_url = api_url
         self.model = model
         self.dimension = dimension
+        self.batch_size = batch_size
+        self.coalesce_window = coalesce_window
+        self.timeout = timeout
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.is_dashscope = "/api/v1/services/" in api_url
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        # 并发名额按优先级分配，上传文档的大量批次排队时聊天的查询向量先发出
+        self._slots = PrioritySemaphore(max_concurrency)
+
+        self._client: Optional[httpx.AsyncClient] = None
+        # 等待合并的单条请求：(文本, future)
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+        # 批量统计
+        self._requests = 0
+        self._texts = 0
+        self._coalesced_calls = 0
+
+    async def startup(self) -> None:
+        """创建共享的 HTTP 客户端"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                verify=False,
+                timeout=self.timeout,
+                limits=self.limits,
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {self.api_key}"
+                }
+            )
+
+    async def shutdown(self) -> None:
+        """关闭共享的 HTTP 客户端"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def warm_connection(self) -> bool:
+        """预先建立到向量服务的连接，只发送一个 HEAD 请求，返回连接是否建立成功"""
+        try:
+            client = await self._get_client()
+            await client.head(self.api_url)
+        except httpx.HTTPError as e:
+            logger.warning("预热向量服务的连接失败: %s", e)
+            return False
+        return True
+
+    async def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            await self.startup()
+        return self._client
+
+    @staticmethod
+    def _clean(text: str) -> str:
+        return text.replace('\r\n', '\n').replace('\r', '\n')
+
+    def _build_request(self, texts: List[str]) -> dict:
+        if self.is_dashscope:
+            return {
+                "model": self.model,
+                "input": {"texts": texts},
+                "parameters": {"dimension": self.dimension}
+            }
+        return {"model": self.model, "input": texts}
+
+    def _parse_response(self, response_data: dict, count: int) -> List[List[float]]:
+        """解析批量响应，按输入顺序返回向量"""
+        if self.is_dashscope:
+            items = response_data.get("output", {}).get("embeddings")
+            index_key = "text_index"
+        else:
+            items = response_data.get("data")
+            index_key = "index"
+        if not items or len(items) != count:
+            raise Exception("Invalid API response format")
+        ordered = sorted(items, key=lambda item: item.get(index_key, 0))
+        return [item["embedding"] for item in ordered]
+
+    async def _request_batch(
+        self,
+        texts: List[str],
+        max_retries: int = 3,
+        retry_delay: float = 1.0
+    ) -> List[Optional[List[float]]]:
+        """发送一次批量请求，全部重试失败时返回与输入等长的 None 列表"""
+        retry_count = 0
+        while retry_count <= max_retries:
+            try:
+                client = await self._get_client()
+                async with self._slots:
+                    # 拿到并发名额后再取令牌，排队期间不占用速率额度
+                    if self.rate_limiter:
+                        await self.rate_limiter.acquire()
+                    self._requests += 1
+                    response = await client.post(self.api_url, json=self._build_request(texts))
+                if response.status_code != 200:
+                    raise Exception(f"Embedding API error: {response.status_code}")
+                return self._parse_response(response.json(), len(texts))
+            except Exception as e:
+                if retry_count == max_retries:
+                    logger.error("Embedding API调用失败, 超过最大重试次数: %s", e)
+                    return [None] * len(texts)
+                retry_count += 1
+                RETRIES.inc(service="embedding")
+                logger.warning("Embedding API调用失败，%s秒后进行第%d次重试...", retry_delay, retry_count)
+                await asyncio.sleep(retry_delay)
+
+    async def get_embeddings(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        批量获取向量
+
+        重复文本只请求一次，空文本直接返回 None，缓存命中的文本直接返回，
+        其余按 batch_size 分批请求，同时进行的请求数不超过 max_concurrency，结果写回缓存。
+        缓存的读写是阻塞的文件操作，放到线程中执行，不阻塞事件循环。
+
+        Args:
+            texts (List[str]): 待向量化的文本
+
+        Returns:
+            List[Optional[List[float]]]: 与输入一一对应的向量，失败或空文本为 None
+        """
+        unique: Dict[str, Optional[List[float]]] = {}
+        for text in texts:
+            if text and text.strip():
+                unique.setdefault(self._clean(text), None)
+
+        keys = list(unique)
+        if self.cache and keys:
+            unique.update(zip(keys, await asyncio.to_thread(self.cache.get_many, keys)))
+            keys = [key for key in keys if unique[key] is None]
+
+        batches = [keys[i:i + self.batch_size] for i in range(0, len(keys), self.batch_size)]
+        results = await asyncio.gather(*(self._request_batch(batch) for batch in batches))
+        for batch, embeddings in zip(batches, results):
+            unique.update(zip(batch, embeddings))
+        if self.cache and keys:
+            await asyncio.to_thread(self.cache.put_many, keys, [unique[key] for key in keys])
+        self._texts += len(keys)
+
+        return [unique.get(self._clean(text)) if text and text.strip() else None for text in texts]
+
+    async def embed(self, text: str) -> Optional[List[float]]:
+        """
+        获取单条文本的向量
+
+        在 coalesce_window 内到达的并发调用会合并成一次批量请求；
+        攒满 batch_size 条时立即发送，不再等待窗口结束。
+        """
+        if not text or not text.strip():
+            return None
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        self._coalesced_calls += 1
+
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.coalesce_window, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        """把等待中的单条请求作为一个批量请求发出"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, []
+        if pending:
+            asyncio.ensure_future(self._dispatch(pending))
+
+    async def _dispatch(self, pending: List[Tuple[str, asyncio.Future]]) -> None:
+        try:
+            embeddings = await self.get_embeddings([text for text, _ in pending])
+        except Exception as e:
+            embeddings = [None] * len(pending)
+            logger.error("合并的向量请求失败: %s", e)
+        for (_, future), embedding in zip(pending, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+    def get_stats(self) -> dict:
+        """批量与合并统计"""
+        stats = {
+            "requests": self._requests,
+            "texts": self._texts,
+            "coalesced_calls": self._coalesced_calls,
+            "avg_batch_size": round(self._texts / self._requests, 2) if self._requests else 0.0,
+            "waiting": self._slots.waiting()
+        }
+        if self.cache:
+            stats["cache"] = self.cache.get_stats()
+        if self.rate_limiter:
+            stats["rate_limit"] = self.rate_limiter.get_stats()
+        return stats
 
     def get_embedding(
         self,
@@ -19,12 +265,12 @@ class EmbeddingService:
         # 如果输入为空，直接返回 None
         if not text or not text.strip():
             return None
-            
+
         retry_count = 0
-        
+
         # 清理输入文本
-        clean_text = text.replace('\r\n', '\n').replace('\r', '\n')
-        
+        clean_text = self._clean(text)
+
         while retry_count <= max_retries:
             try:
                 with httpx.Client(verify=False, timeout=30.0) as client:
@@ -32,34 +278,28 @@ class EmbeddingService:
                         "Content-Type": "application/json",
                         "Authorization": f"Bearer {self.api_key}"
                     }
-                    
-                    data = {
-                        "model": self.model,
-                        "input": clean_text
-                    }
-                    
+
+                    data = self._build_request([clean_text])
+
                     response = client.post(
                         self.api_url,
                         json=data,
                         headers=headers
                     )
-                    
+
                     if response.status_code != 200:
                         raise Exception(f"Embedding API error: {response.status_code}")
-                    
-                    response_data = response.json()
-                    if "data" not in response_data or not response_data["data"]:
-                        raise Exception("Invalid API response format")
-                        
-                    embedding = response_data["data"][0]["embedding"]
-                    print("embedding size:", len(embedding), "embedding:", embedding[0:10])
+
+                    embedding = self._parse_response(response.json(), 1)[0]
+                    logger.debug("embedding size: %d", len(embedding))
                     return embedding
-                    
+
             except Exception as e:
                 if retry_count == max_retries:
-                    print(f"Embedding API调用失败, 超过最大重试次数: {str(e)}")
+                    logger.error("Embedding API调用失败, 超过最大重试次数: %s", e)
                     return None
-                    
+
                 retry_count += 1
-                print(f"Embedding API调用失败，{retry_delay}秒后进行第{retry_count}次重试...")
-                time.sleep(retry_delay) 
\ No newline at end of file
+                RETRIES.inc(service="embedding")
+                logger.warning("Embedding API调用失败，%s秒后进行第%d次重试...", retry_delay, retry_count)
+                time.sleep(retry_delay)
@@ -0,0 +1,192 @@
+# embedding_cache.py
+#
+# 持久化向量缓存
+#
+# 文档分块、用户信息和记忆文本在每次重启、重新上传时都会重新请求向量接口。
+# EmbeddingCache 以 (模型, 维度, sha256(文本)) 为键缓存向量：
+# 1. 向量以 float16/float32 紧凑地存放在内存映射文件 (vectors.bin) 中，按行追加
+# 2. 只追加的索引文件 (index.log) 每行记录一条 "键 行号"，写入新向量时顺带追加，
+#    不会随缓存变大而整体重写；打开缓存时逐行读取重建内存中的索引
+# 3. 内存中只保留最近使用的一部分向量 (LRU)，其余按需从映射文件读取
+# 不同模型或维度使用各自的子目录，换模型后不会读到旧向量。
+# 读写都是阻塞的文件操作，异步代码中应通过 asyncio.to_thread 调用。
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        cache_dir: str,
+        model: str,
+        dimension: int,
+        dtype: str = "float16",
+        max_memory_items: int = 4096
+    ):
+        """
+        Args:
+            cache_dir (str): 缓存根目录
+            model (str): 向量模型名称
+            dimension (int): 向量维度
+            dtype (str): 磁盘存储精度，"float16" 或 "float32"
+            max_memory_items (int): 内存 LRU 中最多保留的向量数
+        """
+        self.model = model
+        self.dimension = dimension
+        self.dtype = np.dtype(dtype)
+        self.max_memory_items = max_memory_items
+
+        safe_model = "".join(c if c.isalnum() or c in "-_." else "_" for c in model)
+        self.cache_dir = os.path.join(cache_dir, f"{safe_model}_{dimension}_{self.dtype.name}")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._vectors_path = os.path.join(self.cache_dir, "vectors.bin")
+        self._index_path = os.path.join(self.cache_dir, "index.log")
+        self._legacy_index_path = os.path.join(self.cache_dir, "index.json")
+
+        self._lock = threading.Lock()
+        self._row_bytes = dimension * self.dtype.itemsize
+        self._file_rows = self._repair_vectors_file()
+        self._index = self._load_index()
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._mmap: Optional[np.memmap] = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, text: str) -> str:
+        raw = f"{self.model}\0{self.dimension}\0{text}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _repair_vectors_file(self) -> int:
+        """截掉异常退出时写了一半的行，返回文件中的完整行数"""
+        if not os.path.exists(self._vectors_path):
+            return 0
+        size = os.path.getsize(self._vectors_path)
+        rows = size // self._row_bytes
+        if size != rows * self._row_bytes:
+            with open(self._vectors_path, "r+b") as f:
+                f.truncate(rows * self._row_bytes)
+        return rows
+
+    def _load_index(self) -> dict:
+        """
+        逐行读取索引文件重建索引，只保留映射文件中确实存在的行；
+        异常退出时写了一半的最后一行被跳过
+        """
+        if not os.path.exists(self._index_path) and os.path.exists(self._legacy_index_path):
+            return self._migrate_legacy_index()
+
+        index = {}
+        try:
+            with open(self._index_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) != 2 or not parts[1].isdigit():
+                        continue
+                    row = int(parts[1])
+                    if row < self._file_rows:
+                        index[parts[0]] = row
+        except FileNotFoundError:
+            pass
+        return index
+
+    def _migrate_legacy_index(self) -> dict:
+        """把旧版整体重写的 index.json 转成只追加的索引文件"""
+        try:
+            with open(self._legacy_index_path, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
+        except ValueError:
+            legacy = {}
+        index = {key: row for key, row in legacy.items() if isinstance(row, int) and row < self._file_rows}
+        self._append_index(index.items())
+        os.remove(self._legacy_index_path)
+        return index
+
+    def _append_index(self, entries) -> None:
+        """在索引文件末尾追加 (键, 行号)，调用方需持有锁"""
+        lines = "".join(f"{key} {row}\n" for key, row in entries)
+        if lines:
+            with open(self._index_path, "a", encoding="utf-8") as f:
+                f.write(lines)
+
+    def _open_mmap(self) -> Optional[np.memmap]:
+        """按当前行数重新映射向量文件，追加写入后需要重新映射"""
+        rows = self._file_rows
+        if rows == 0:
+            return None
+        if self._mmap is None or self._mmap.shape[0] != rows:
+            self._mmap = np.memmap(self._vectors_path, dtype=self.dtype, mode="r", shape=(rows, self.dimension))
+        return self._mmap
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """批量查询，未命中的位置为 None"""
+        results: List[Optional[List[float]]] = []
+        with self._lock:
+            for text in texts:
+                key = self.make_key(text)
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                else:
+                    row = self._index.get(key)
+                    if row is not None:
+                        vector = np.array(self._open_mmap()[row], dtype=np.float32)
+                        self._remember(key, vector)
+                if vector is None:
+                    self.misses += 1
+                    results.append(None)
+                else:
+                    self.hits += 1
+                    results.append(vector.tolist())
+        return results
+
+    def put_many(self, texts: List[str], vectors: List[Optional[List[float]]]) -> None:
+        """批量写入，None 向量和已存在的键会被跳过"""
+        with self._lock:
+            new_rows = []
+            new_keys = []
+            for text, vector in zip(texts, vectors):
+                if vector is None or len(vector) != self.dimension:
+                    continue
+                key = self.make_key(text)
+                if key in self._index:
+                    continue
+                array = np.asarray(vector, dtype=np.float32)
+                # 行号以文件实际行数为准，索引还没追加就退出时残留的行不会被覆盖错位
+                self._index[key] = self._file_rows + len(new_rows)
+                new_keys.append(key)
+                new_rows.append(array)
+                self._remember(key, array)
+
+            if not new_rows:
+                return
+            # 先写向量再追加索引：中途退出时只会多出没有索引的行，不会有指向不存在的行的索引
+            with open(self._vectors_path, "ab") as f:
+                f.write(np.stack(new_rows).astype(self.dtype).tobytes())
+            self._append_index((key, self._index[key]) for key in new_keys)
+            self._file_rows += len(new_rows)
+
+    def _remember(self, key: str, vector: np.ndarray) -> None:
+        """放入内存 LRU，调用方需持有锁"""
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "entries": len(self._index),
+                "memory_entries": len(self._memory),
+                "dtype": self.dtype.name
+            }
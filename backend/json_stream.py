@@ -0,0 +1,250 @@
+# json_stream.py
+#
+# 流式 JSON 字段提取与 LLM 输出的宽容解析
+#
+# LLM 按提示词输出 {"expression": ..., "reply": ..., "user_info": ...} 格式的 JSON，
+# 流式生成时 JSON 要到最后才完整。JsonFieldStream 逐字符扫描已经到达的片段：
+# 1. 把指定字段（默认 reply）的字符串内容增量吐出，用于边生成边切句、合成语音
+# 2. 记录已经完整到达的字符串字段（如 expression），让调用方尽早拿到
+# 3. 字符串中未转义的引号：看到下一个非空白字符后再判断，后面不是 , : } ] 时当作普通字符
+# 代码块标记（```json）等 JSON 外的文本不含引号，扫描时会被自然跳过。
+#
+# parse_json_object 解析完整的输出，原来直接 json.loads，代码块标记、前后多余的文字、
+# 被截断的结尾都会解析失败并导致整个请求重新发送。现在依次尝试：
+# 1. 直接 json.loads
+# 2. 从第一个 { 开始修复：去掉对象之后的文字和多余的逗号，转义字符串中的换行和引号，补全未闭合的字符串和括号
+# 3. 仍然失败时用 JsonFieldStream 逐字段提取，被截断的字符串值保留已经到达的部分
+# 只有输出中完全没有 JSON 对象时才报错。
+import json
+from typing import Any, Dict, List, Optional
+
+from metrics import JSON_REPAIRS
+
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+_WHITESPACE = ' \t\r\n'
+# 字符串结束的引号之后只会出现这些字符
+_AFTER_STRING = ',:}]'
+# 字符串中不能直接出现的控制字符
+_CONTROL_ESCAPES = {'\n': '\\n', '\r': '\\r', '\t': '\\t'}
+
+
+class JsonFieldStream:
+    def __init__(self, stream_field: Optional[str] = "reply"):
+        """
+        Args:
+            stream_field (str): 需要增量输出内容的字段名，为 None 时只提取字段
+        """
+        self.stream_field = stream_field
+        self.fields: Dict[str, str] = {}  # 已完整解析的字符串字段
+
+        self._in_string = False
+        self._escape = None       # 正在处理的转义序列，None 表示不在转义中
+        self._quote = None        # 字符串中遇到的引号及其后的空白，还不确定是否为字符串结尾
+        self._chars: List[str] = []
+        self._last_string = None  # 最近结束的字符串，后面跟冒号时就是键
+        self._key = None          # 当前值所属的键
+        self._expect_value = False
+        self._is_value = False    # 当前字符串是否为某个键的值
+
+    def feed(self, chunk: str) -> str:
+        """
+        输入一段流式文本
+
+        Returns:
+            str: stream_field 字段新增的内容，没有则为空字符串
+        """
+        delta = []
+        for ch in chunk:
+            if self._quote is not None:
+                if ch in _WHITESPACE:
+                    self._quote += ch
+                    continue
+                quote, self._quote = self._quote, None
+                if ch in _AFTER_STRING:
+                    self._end_string()
+                else:
+                    # 字符串中间未转义的引号，当作普通字符
+                    self._append(quote, delta)
+
+            if self._in_string:
+                self._append(self._consume_string_char(ch), delta)
+            elif ch == '"':
+                self._in_string = True
+                self._chars = []
+                self._is_value = self._expect_value
+            elif ch == ':':
+                if self._last_string is not None:
+                    self._key = self._last_string
+                    self._expect_value = True
+                self._last_string = None
+            elif ch in _WHITESPACE:
+                continue
+            else:
+                # 逗号、括号或数字等非字符串值，重置键值状态
+                self._last_string = None
+                self._expect_value = False
+        return "".join(delta)
+
+    def snapshot(self) -> Dict[str, str]:
+        """已完整到达的字段，加上尚未结束的字符串值已经到达的部分（输出被截断时使用）"""
+        fields = dict(self.fields)
+        if self._in_string and self._is_value:
+            fields[self._key] = "".join(self._chars)
+        return fields
+
+    def _append(self, text: str, delta: List[str]) -> None:
+        if not text:
+            return
+        self._chars.append(text)
+        if self._is_value and self._key == self.stream_field:
+            delta.append(text)
+
+    def _end_string(self) -> None:
+        value = "".join(self._chars)
+        self._in_string = False
+        if self._is_value:
+            self.fields[self._key] = value
+            self._key = None
+            self._expect_value = False
+        else:
+            self._last_string = value
+
+    def _consume_string_char(self, ch: str) -> str:
+        """处理字符串内的一个字符，返回解码后新增的文本"""
+        if self._escape is not None:
+            self._escape += ch
+            if self._escape[0] == 'u':
+                if len(self._escape) < 5:
+                    return ""
+                try:
+                    text = chr(int(self._escape[1:], 16))
+                except ValueError:
+                    text = ""
+            else:
+                text = _ESCAPES.get(ch, ch)
+            self._escape = None
+            return text
+
+        if ch == '\\':
+            self._escape = ""
+            return ""
+
+        if ch == '"':
+            # 要看到下一个非空白字符才知道引号是不是字符串的结尾
+            self._quote = ch
+            return ""
+
+        return ch
+
+
+def _closes_string(text: str, index: int) -> bool:
+    """text[index - 1] 处的引号是否为字符串结尾：其后（跳过空白）是 , : } ] 或文本结束"""
+    while index < len(text) and text[index] in _WHITESPACE:
+        index += 1
+    return index == len(text) or text[index] in _AFTER_STRING
+
+
+def _strip_trailing_comma(out: List[str]) -> None:
+    while out and (out[-1] in _WHITESPACE or out[-1] == ','):
+        out.pop()
+
+
+def repair_json(text: str) -> str:
+    """
+    修复从 { 或 [ 开始的 JSON 文本，返回修复后的文本（不保证一定合法）
+
+    - 第一个值结束后的文字（如代码块结尾的 ```、解释说明）被丢弃
+    - 字符串中的换行等控制字符和未转义的引号被转义
+    - 右括号前多余的逗号被去掉，不匹配的右括号被丢弃
+    - 文本被截断时补全字符串和括号，去掉还没有值的键
+    """
+    out: List[str] = []
+    stack: List[str] = []
+    in_string = False
+    escape = False
+    string_start = 0  # 最近一个字符串在 out 中的起始位置
+    for i, ch in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+                out.append(ch)
+            elif ch == '\\':
+                escape = True
+                out.append(ch)
+            elif ch == '"':
+                if _closes_string(text, i + 1):
+                    in_string = False
+                    out.append(ch)
+                else:
+                    out.append('\\"')
+            else:
+                out.append(_CONTROL_ESCAPES.get(ch, ch))
+        elif ch == '"':
+            in_string = True
+            string_start = len(out)
+            out.append(ch)
+        elif ch in '{[':
+            stack.append('}' if ch == '{' else ']')
+            out.append(ch)
+        elif ch in '}]':
+            if not stack or stack[-1] != ch:
+                continue
+            _strip_trailing_comma(out)
+            out.append(stack.pop())
+            if not stack:
+                break
+        else:
+            out.append(ch)
+
+    if in_string:
+        if escape:
+            out.pop()
+        out.append('"')
+    _strip_trailing_comma(out)
+    if out and out[-1] == ':':
+        del out[string_start:]
+    while stack:
+        _strip_trailing_comma(out)
+        out.append(stack.pop())
+    return "".join(out)
+
+
+def has_text(value: Dict[str, Any], field: str) -> bool:
+    """对象中的字段是否为非空白的字符串"""
+    text = value.get(field)
+    return isinstance(text, str) and bool(text.strip())
+
+
+def parse_json_object(text: str) -> Dict[str, Any]:
+    """
+    宽容地解析 LLM 输出的 JSON 对象
+
+    Raises:
+        ValueError: 输出中没有 JSON 对象，或修复后也提取不到任何字段
+    """
+    try:
+        value = json.loads(text)
+        if isinstance(value, dict):
+            return value
+    except ValueError:
+        pass
+
+    start = text.find('{')
+    if start < 0:
+        raise ValueError("响应中没有 JSON 对象")
+
+    try:
+        value = json.loads(repair_json(text[start:]))
+        if isinstance(value, dict) and value:
+            JSON_REPAIRS.inc(method="repair")
+            return value
+    except ValueError:
+        pass
+
+    parser = JsonFieldStream(stream_field=None)
+    parser.feed(text[start:])
+    fields = parser.snapshot()
+    if not fields:
+        raise ValueError("无法从响应中解析出任何字段")
+    JSON_REPAIRS.inc(method="fields")
+    return fields
@@ -7,16 +7,38 @@ LLMService 模块
 2. 处理不同格式的响应（普通文本或 JSON）
 3. 实现重试机制以提高请求的稳定性
 4. 支持解析 JSON 格式的响应内容
+5. 支持流式生成，按增量片段返回模型输出
+6. 复用长连接的 HTTP 连接池（支持 HTTP/2），并统计连接复用情况
+7. 支持多条消息（system / user / assistant）的请求，记录每次请求的 token 用量和前缀缓存命中情况
+8. 尾部延迟控制：每次尝试单独超时、整次生成有总时限，慢请求超过 p95 时发出对冲请求，
+   服务连续失败时熔断，可选切换到另一种风格的备用服务
 
 支持多种风格的 LLM API，包括 OpenAI 风格和 DashScope 风格。
 """
 
+import logging
 import httpx
 import asyncio
-from typing import List, Dict
+import importlib.util
+import time
+from typing import List, Dict, Optional, Sequence, Tuple, AsyncIterator, Union
 import json
 import re
 
+from admission import TokenBucket
+from resilience import CircuitBreaker, CircuitOpenError, HedgeStats, LatencyTracker, backoff_delay, hedge
+from text_utils import estimate_tokens
+from metrics import RETRIES, span
+from json_stream import has_text, parse_json_object
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 依赖可选的 h2 包，未安装时自动退回 HTTP/1.1
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# 请求内容：单条用户消息，或 [{"role": ..., "content": ...}] 形式的多条消息
+Messages = Union[str, List[Dict[str, str]]]
+
 # 模型风格分类
 MODEL_STYLE_OPENAI = ["deepseek-chat", "gpt-3.5-turbo", "gpt-4", "gpt-4-turbo", "gpt-4o"]
 MODEL_STYLE_DASHSCOPE = ["qwen-plus", "qwen-max", "qwen-turbo", "qwen-vl-plus", "qwen-vl-max"]
@@ -42,8 +64,37 @@ def get_model_style(model: str) -> str:
         # 默认使用 OpenAI 风格
         return "openai"
 
+class LLMStatusError(Exception):
+    """LLM API 返回了非 200 的状态码"""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"LLM API error: {status_code}")
+        self.status_code = status_code
+
+    @property
+    def retryable(self) -> bool:
+        """限流和服务端错误说明服务不健康，计入熔断"""
+        return self.status_code == 429 or self.status_code >= 500
+
 class LLMService:
-    def __init__(self, api_key: str, api_url: str, model: str = "deepseek-chat"):
+    def __init__(
+        self,
+        api_key: str,
+        api_url: str,
+        model: str = "deepseek-chat",
+        timeout: float = 120.0,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 60.0,
+        http2: bool = True,
+        attempt_timeout: float = 30.0,
+        deadline: float = 60.0,
+        hedge_enabled: bool = True,
+        breaker_failures: int = 5,
+        breaker_reset: float = 30.0,
+        fallback: Optional["LLMService"] = None,
+        rate_limiter: Optional[TokenBucket] = None
+    ):
         """
         初始化 LLM 服务
         
@@ -51,37 +102,211 @@ class LLMService:
             api_key (str): API 访问密钥
             api_url (str): API 端点 URL
             model (str): 模型名称，默认为 "deepseek-chat"
+            timeout (float): 单次请求超时时间（秒）
+            max_connections (int): 连接池最大连接数
+            max_keepalive_connections (int): 连接池中保持空闲长连接的最大数量
+            keepalive_expiry (float): 空闲长连接的保留时间（秒）
+            http2 (bool): 是否启用 HTTP/2（需要安装 h2）
+            attempt_timeout (float): 单次尝试的超时时间（秒），流式请求为首个片段和相邻片段之间的最长等待
+            deadline (float): 一次生成（包括重试）的总时限（秒）
+            hedge_enabled (bool): 是否在请求慢于 p95 时发出对冲请求（只用于非流式请求）
+            breaker_failures (int): 连续失败多少次后熔断
+            breaker_reset (float): 熔断多久（秒）后放行探测请求
+            fallback (LLMService): 备用服务，本服务失败或熔断时使用，可以是另一种风格的模型
+            rate_limiter (TokenBucket): 服务商的请求速率限制，令牌不够时按请求优先级排队，为 None 时不限制
         """
         self.api_key = api_key
         self.api_url = api_url
         self.model = model
         self.model_style = get_model_style(model)
+
+        self.timeout = timeout
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.http2 = http2 and HTTP2_AVAILABLE
+        if http2 and not HTTP2_AVAILABLE:
+            logger.info("未安装 h2，LLM 连接池退回 HTTP/1.1")
+
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.hedge_enabled = hedge_enabled
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset)
+        self.hedge_stats = HedgeStats()
+        self.fallback = fallback
+        self.rate_limiter = rate_limiter
+
+        # 由服务持有的共享客户端，在 startup 时创建、shutdown 时关闭
+        self._client: Optional[httpx.AsyncClient] = None
+
+        # 连接复用统计
+        self._requests = 0
+        self._new_connections = 0
+
+        # token 用量统计，服务商没有返回用量时按本地估算计入
+        self._prompt_tokens = 0
+        self._completion_tokens = 0
+        self._cached_tokens = 0
+        self._estimated_requests = 0
+
+    async def startup(self) -> None:
+        """创建共享的 HTTP 客户端，随应用启动调用"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                verify=False,
+                timeout=self.timeout,
+                limits=self.limits,
+                http2=self.http2,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json"
+                }
+            )
+
+        if self.fallback:
+            await self.fallback.startup()
+
+    async def shutdown(self) -> None:
+        """关闭共享的 HTTP 客户端，释放连接池，随应用关闭调用"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self.fallback:
+            await self.fallback.shutdown()
+
+    async def warm_connection(self) -> bool:
+        """
+        预先建立到服务的连接（TCP/TLS 握手和 HTTP/2 协商），之后的第一个请求直接复用
+
+        只发送一个 HEAD 请求，不消耗 token，状态码不重要；备用服务也一起预热。
+        预热的连接不计入连接复用统计。
+
+        Returns:
+            bool: 主服务的连接是否建立成功
+        """
+        if self.fallback:
+            await self.fallback.warm_connection()
+        try:
+            client = await self._get_client()
+            await client.head(self.api_url, timeout=self.attempt_timeout)
+        except httpx.HTTPError as e:
+            logger.warning("预热 LLM 服务 %s 的连接失败: %s", self.model, e)
+            return False
+        return True
+
+    async def _get_client(self) -> httpx.AsyncClient:
+        """获取共享客户端，未启动时懒加载创建"""
+        if self._client is None or self._client.is_closed:
+            await self.startup()
+        return self._client
+
+    async def _trace(self, event_name: str, info: dict) -> None:
+        """httpx 的 trace 回调，只在建立新的 TCP 连接时计数"""
+        if event_name == "connection.connect_tcp.complete":
+            self._new_connections += 1
+
+    def get_stats(self) -> dict:
+        """
+        获取连接池统计信息
+
+        Returns:
+            dict: 请求数、新建连接数、复用连接的请求数和复用率
+        """
+        reused = max(self._requests - self._new_connections, 0)
+        stats = {
+            "model": self.model,
+            "http2": self.http2,
+            "requests": self._requests,
+            "new_connections": self._new_connections,
+            "reused_connections": reused,
+            "reuse_rate": round(reused / self._requests, 4) if self._requests else 0.0,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "prompt_tokens": self._prompt_tokens,
+            "completion_tokens": self._completion_tokens,
+            "cached_tokens": self._cached_tokens,
+            "cache_hit_rate": round(self._cached_tokens / self._prompt_tokens, 4) if self._prompt_tokens else 0.0,
+            "estimated_requests": self._estimated_requests,
+            "latency": self.latency.get_stats(),
+            "breaker": self.breaker.get_stats(),
+            **self.hedge_stats.get_stats()
+        }
+        if self.rate_limiter:
+            stats["rate_limit"] = self.rate_limiter.get_stats()
+        if self.fallback:
+            stats["fallback"] = self.fallback.get_stats()
+        return stats
+
+    @staticmethod
+    def _to_messages(message: Messages) -> List[Dict[str, str]]:
+        """把单条消息统一成消息列表"""
+        if isinstance(message, str):
+            return [{"role": "user", "content": message}]
+        return list(message)
+
+    @staticmethod
+    def _parse_usage(usage: Optional[dict]) -> Optional[dict]:
+        """
+        统一不同服务商的用量字段
+
+        OpenAI 风格为 prompt_tokens / completion_tokens，DashScope 为 input_tokens / output_tokens；
+        前缀缓存命中数在 DeepSeek 中是 prompt_cache_hit_tokens，其他服务商在 prompt_tokens_details.cached_tokens
+        """
+        if not usage:
+            return None
+        cached = usage.get("prompt_cache_hit_tokens")
+        if cached is None:
+            cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+        return {
+            "prompt_tokens": usage.get("prompt_tokens", usage.get("input_tokens", 0)),
+            "completion_tokens": usage.get("completion_tokens", usage.get("output_tokens", 0)),
+            "cached_tokens": cached or 0
+        }
+
+    def _record_usage(self, usage: Optional[dict], messages: List[Dict[str, str]], output: str) -> dict:
+        """累计并打印一次请求的 token 用量，服务商没有返回用量时按本地估算"""
+        if usage is None:
+            usage = {
+                "prompt_tokens": sum(estimate_tokens(m["content"]) for m in messages),
+                "completion_tokens": estimate_tokens(output),
+                "cached_tokens": 0,
+                "estimated": True
+            }
+            self._estimated_requests += 1
+        self._prompt_tokens += usage["prompt_tokens"]
+        self._completion_tokens += usage["completion_tokens"]
+        self._cached_tokens += usage["cached_tokens"]
+        logger.debug(
+            "LLM token用量%s: 输入 %d (缓存命中 %d), 输出 %d",
+            "(估算)" if usage.get("estimated") else "",
+            usage["prompt_tokens"], usage["cached_tokens"], usage["completion_tokens"]
+        )
+        return usage
     
-    def _build_openai_request(self, message: str, temperature: float) -> dict:
+    def _build_openai_request(self, message: Messages, temperature: float) -> dict:
         """构建 OpenAI 风格的请求体"""
         return {
             "model": self.model,
-            "messages": [
-                {"role": "user", "content": message}
-            ],
+            "messages": self._to_messages(message),
             "temperature": temperature
         }
     
-    def _build_dashscope_request(self, message: str, temperature: float) -> dict:
+    def _build_dashscope_request(self, message: Messages, temperature: float) -> dict:
         """构建 DashScope 风格的请求体"""
         return {
             "model": self.model,
             "input": {
-                "messages": [
-                    {"role": "user", "content": message}
-                ]
+                "messages": self._to_messages(message)
             },
             "parameters": {
                 "temperature": temperature
             }
         }
     
-    def _build_request(self, message: str, temperature: float) -> dict:
+    def _build_request(self, message: Messages, temperature: float) -> dict:
         """根据模型风格构建请求体"""
         if self.model_style == "openai":
             return self._build_openai_request(message, temperature)
@@ -91,6 +316,31 @@ class LLMService:
             # 默认使用 OpenAI 风格
             return self._build_openai_request(message, temperature)
     
+    def _build_stream_request(self, message: Messages, temperature: float) -> Tuple[dict, dict]:
+        """构建流式请求的请求体和额外请求头"""
+        request_body = self._build_request(message, temperature)
+        if self.model_style == "dashscope":
+            # DashScope 通过请求头开启 SSE，incremental_output 让每个事件只包含新增内容
+            request_body["parameters"]["incremental_output"] = True
+            return request_body, {"X-DashScope-SSE": "enable"}
+        request_body["stream"] = True
+        # 让最后一个事件带上 token 用量
+        request_body["stream_options"] = {"include_usage": True}
+        return request_body, {}
+
+    def _parse_stream_chunk(self, chunk: dict) -> str:
+        """解析流式响应中的单个事件，返回新增的文本"""
+        if "choices" in chunk:
+            if not chunk["choices"]:
+                return ""
+            return chunk["choices"][0].get("delta", {}).get("content") or ""
+        if "output" in chunk:
+            output = chunk["output"]
+            if output.get("choices"):
+                return output["choices"][0].get("message", {}).get("content") or ""
+            return output.get("text") or ""
+        raise ValueError(f"Unexpected stream chunk: {chunk}")
+
     def _parse_openai_response(self, response: dict) -> str:
         """解析 OpenAI 风格的响应"""
         if "choices" in response and len(response["choices"]) > 0:
@@ -117,19 +367,27 @@ class LLMService:
         
     async def generate_response(
         self, 
-        message: str,
+        message: Messages,
         temperature: float = 0.7,
         max_retries: int = 3,
-        is_json: bool = False
+        is_json: bool = False,
+        attempt_timeout: Optional[float] = None,
+        deadline: Optional[float] = None,
+        required_fields: Sequence[str] = ()
     ) -> str:
         """
         异步生成响应。
 
         Args:
-            message (str): 用户输入的消息。
+            message (Messages): 用户输入的消息，或 system / user / assistant 多条消息。
             temperature (float, optional): 温度参数，控制生成文本的随机性。默认为0.7。
             max_retries (int, optional): 最大重试次数。默认为3。
             is_json (bool, optional): 是否返回JSON格式的响应。默认为False。
+            attempt_timeout (float, optional): 覆盖单次尝试的超时（秒），用于文档总结等长提示词；
+                指定时不做对冲，长提示词的耗时和聊天请求的 p95 不可比。
+            deadline (float, optional): 覆盖一次生成（包括重试）的总时限（秒）。
+            required_fields (Sequence[str], optional): is_json 时必须存在且不为空白的文本字段，
+                修复后的 JSON 缺少这些字段时按解析失败处理并重试。
 
         Returns:
             str: 生成的响应文本。
@@ -137,64 +395,248 @@ class LLMService:
         Raises:
             Exception: 如果在重试次数内未能成功生成响应，则抛出异常。
         """
+        loop = asyncio.get_running_loop()
+        end = loop.time() + (deadline or self.deadline)
+        hedging = self.hedge_enabled and attempt_timeout is None
+        timeout = attempt_timeout or self.attempt_timeout
+        request_body = self._build_request(message, temperature)
         retry_count = 0
-        
+
         while retry_count < max_retries:
+            remaining = end - loop.time()
+            if remaining <= 0:
+                break
             try:
-                async with httpx.AsyncClient(verify=False, timeout=120.0) as client:
-                    headers = {
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json"
-                    }
-                    
-                    # 根据模型风格构建请求体
-                    request_body = self._build_request(message, temperature)
-                    
-                    response = await client.post(
-                        self.api_url,
-                        json=request_body,
-                        headers=headers
-                    )
-                    
-                    if response.status_code != 200:
-                        raise Exception(f"LLM API error: {response.status_code}")
-                    
-                    result = response.json()
-                    print("raw_response:", result)
-                    
-                    # 根据模型风格解析响应
-                    raw_response = self._parse_response(result)
-                    print("parsed_response:", raw_response)
-                    
-                    if is_json:
-                        return self._parse_json_response(raw_response)
-                    else:
-                        return raw_response
-                        
+                # 单次尝试有超时，慢于 p95 时再发出一次相同的请求，取先返回的结果
+                result = await hedge(
+                    lambda: self._post(request_body),
+                    self.latency.hedge_delay() if hedging else None,
+                    min(timeout, remaining),
+                    self.hedge_stats
+                )
+                # 根据模型风格解析响应
+                raw_response = self._parse_response(result)
+                logger.debug("parsed_response: %s", raw_response)
+                self._record_usage(self._parse_usage(result.get("usage")), self._to_messages(message), raw_response)
+
+                if is_json:
+                    with span("json_parse"):
+                        return self._parse_json_response(raw_response, required_fields)
+                else:
+                    return raw_response
+
+            except CircuitOpenError:
+                logger.warning("LLM 服务 %s 熔断中，不再请求", self.model)
+                break
             except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    # 超时的请求已被取消，没有在 _post 中记录结果，这里计为一次失败
+                    self.breaker.record_failure()
                 retry_count += 1
-                print(f"LLM Error (attempt {retry_count}/{max_retries}): {str(e)}")
-                if retry_count < max_retries:
-                    await asyncio.sleep(1)
-        
+                RETRIES.inc(service="llm")
+                logger.warning("LLM Error (attempt %d/%d): %s", retry_count, max_retries, str(e) or type(e).__name__)
+                # 退避等待不超过总时限，剩余时间不够时直接放弃
+                delay = backoff_delay(retry_count - 1)
+                if retry_count >= max_retries or end - loop.time() <= delay:
+                    break
+                await asyncio.sleep(delay)
+
+        if self.fallback:
+            logger.warning("LLM 服务 %s 不可用，切换到备用服务 %s", self.model, self.fallback.model)
+            return await self.fallback.generate_response(
+                message, temperature, max_retries, is_json,
+                attempt_timeout=attempt_timeout, deadline=deadline, required_fields=required_fields
+            )
+
         # 如果所有重试都失败了，抛出异常
-        raise Exception(f"Failed to get response from LLM after {max_retries} attempts")
+        raise Exception(f"Failed to get response from LLM after {retry_count} attempts")
+
+    async def _post(self, request_body: dict) -> dict:
+        """
+        发出一次非流式请求并返回响应 JSON，同时记录耗时和熔断器的成功失败
+
+        对冲超时后请求被取消，这里不记录结果，由 generate_response 把超时计为一次失败；
+        先返回的对冲请求胜出后另一个请求也会被取消，同样不应计为失败
+        """
+        probe = self.breaker.check()
+        try:
+            if self.rate_limiter:
+                await self.rate_limiter.acquire()
+        except BaseException:
+            if probe:
+                self.breaker.release_probe()
+            raise
+        client = await self._get_client()
+        self._requests += 1
+        start = time.monotonic()
+        try:
+            response = await client.post(
+                self.api_url,
+                json=request_body,
+                extensions={"trace": self._trace}
+            )
+            if response.status_code != 200:
+                raise LLMStatusError(response.status_code)
+            result = response.json()
+        except Exception as e:
+            # 请求本身有问题 (4xx) 不代表服务不可用，不计入熔断
+            if not isinstance(e, LLMStatusError) or e.retryable:
+                self.breaker.record_failure()
+            raise
+        except BaseException:
+            if probe:
+                self.breaker.release_probe()
+            raise
+        self.breaker.record_success()
+        self.latency.record(time.monotonic() - start)
+        return result
+
+    async def stream_response(
+        self,
+        message: Messages,
+        temperature: float = 0.7,
+        max_retries: int = 3
+    ) -> AsyncIterator[str]:
+        """
+        流式生成响应，逐段返回模型新输出的文本。
+
+        OpenAI 风格和 DashScope 风格的 SSE 流都会被统一成纯文本片段。
+        只有在还没有收到任何内容时失败才会重试，已经输出的内容无法撤回。
+
+        Args:
+            message (Messages): 用户输入的消息，或 system / user / assistant 多条消息。
+            temperature (float, optional): 温度参数。默认为0.7。
+            max_retries (int, optional): 最大重试次数。默认为3。
+
+        Yields:
+            str: 新增的文本片段。
+
+        Raises:
+            Exception: 如果在重试次数内未能建立流式响应，或流在中途断开。
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        retry_count = 0
+
+        while retry_count < max_retries:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            received = False
+            usage = None
+            parts: List[str] = []
+            try:
+                probe = self.breaker.check()
+            except CircuitOpenError:
+                logger.warning("LLM 服务 %s 熔断中，不再请求", self.model)
+                break
+            if self.rate_limiter:
+                # 本地限流的等待与服务商无关，等到总时限也没拿到令牌时放弃，不计入熔断
+                try:
+                    await asyncio.wait_for(self.rate_limiter.acquire(), timeout=remaining)
+                except BaseException as e:
+                    if probe:
+                        self.breaker.release_probe()
+                    if isinstance(e, asyncio.TimeoutError):
+                        break
+                    raise
+            try:
+                client = await self._get_client()
+                request_body, extra_headers = self._build_stream_request(message, temperature)
+                request = client.build_request(
+                    "POST",
+                    self.api_url,
+                    json=request_body,
+                    headers=extra_headers,
+                    extensions={"trace": self._trace}
+                )
+
+                self._requests += 1
+                # 首个片段必须在单次尝试超时和总时限内到达，之后相邻片段的间隔不能超过单次尝试超时
+                first_deadline = loop.time() + min(self.attempt_timeout, remaining)
+                response = await asyncio.wait_for(client.send(request, stream=True), timeout=remaining)
+                try:
+                    if response.status_code != 200:
+                        raise LLMStatusError(response.status_code)
+
+                    lines = response.aiter_lines()
+                    while True:
+                        timeout = self.attempt_timeout if received else first_deadline - loop.time()
+                        try:
+                            line = await asyncio.wait_for(lines.__anext__(), timeout=max(timeout, 0))
+                        except StopAsyncIteration:
+                            break
+                        line = line.strip()
+                        if not line.startswith("data:"):
+                            continue
+                        payload = line[len("data:"):].strip()
+                        if payload == "[DONE]":
+                            break
+                        chunk = json.loads(payload)
+                        # 用量在最后一个事件 (OpenAI) 或每个事件 (DashScope，累计值) 中
+                        usage = self._parse_usage(chunk.get("usage")) or usage
+                        text = self._parse_stream_chunk(chunk)
+                        if text:
+                            received = True
+                            parts.append(text)
+                            yield text
+                finally:
+                    await response.aclose()
+                self.breaker.record_success()
+                self._record_usage(usage, self._to_messages(message), "".join(parts))
+                return
+
+            except Exception as e:
+                if not isinstance(e, LLMStatusError) or e.retryable:
+                    self.breaker.record_failure()
+                if received:
+                    raise
+                retry_count += 1
+                RETRIES.inc(service="llm")
+                logger.warning("LLM Stream Error (attempt %d/%d): %s", retry_count, max_retries, str(e) or type(e).__name__)
+                delay = backoff_delay(retry_count - 1)
+                if retry_count >= max_retries or deadline - loop.time() <= delay:
+                    break
+                await asyncio.sleep(delay)
+            except BaseException:
+                # 调用方断开（取消或关闭生成器）：已经收到内容说明服务正常；
+                # 还没有结果的探测请求交还名额，否则熔断器会一直停在探测状态
+                if received:
+                    self.breaker.record_success()
+                elif probe:
+                    self.breaker.release_probe()
+                raise
+
+        # 还没有输出任何内容，可以完整地切换到备用服务
+        if self.fallback:
+            logger.warning("LLM 服务 %s 不可用，切换到备用服务 %s", self.model, self.fallback.model)
+            async for text in self.fallback.stream_response(message, temperature, max_retries):
+                yield text
+            return
+
+        raise Exception(f"Failed to stream response from LLM after {retry_count} attempts")
 
     @staticmethod
-    def _parse_json_response(raw_response: str) -> Dict:
+    def _parse_json_response(raw_response: str, required_fields: Sequence[str] = ()) -> Dict:
         """
-        解析 JSON 格式的响应
+        解析 JSON 格式的响应，代码块标记、多余的文字和被截断的结尾在本地修复，不重新请求
         
         Args:
             raw_response (str): 原始响应字符串
+            required_fields (Sequence[str]): 必须存在且不为空白的文本字段
             
         Returns:
             Dict: 解析后的 JSON 对象
             
         Raises:
-            ValueError: 当无法解析 JSON 时抛出异常
+            ValueError: 当响应中没有可用的 JSON 对象，或缺少必需的字段时抛出异常
         """
         try:
-            return json.loads(raw_response)
-        except Exception as e:
-            raise ValueError(f"Failed to parse JSON response: {str(e)}")
\ No newline at end of file
+            value = parse_json_object(raw_response)
+        except ValueError as e:
+            raise ValueError(f"Failed to parse JSON response: {str(e)}")
+        # 修复只能补全结构，补不出内容：缺少回复的对象和解析失败一样处理
+        missing = [name for name in required_fields if not has_text(value, name)]
+        if missing:
+            raise ValueError(f"JSON response is missing fields: {', '.join(missing)}")
+        return value
\ No newline at end of file
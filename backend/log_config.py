@@ -0,0 +1,43 @@
+# log_config.py
+#
+# 分级、可采样的日志
+#
+# 各模块通过 logging.getLogger(__name__) 输出日志，原来的 print 换成了对应级别的日志：
+# 调试信息（原始回复、相关记忆等）为 DEBUG，默认不输出；重试和降级为 WARNING；最终失败为 ERROR。
+# 高流量时可以对 WARNING 以下的日志按比例采样，WARNING 及以上的日志总是输出。
+import logging
+import random
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class SamplingFilter(logging.Filter):
+    """WARNING 以下的日志按 rate 的比例随机保留"""
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+
+def setup_logging(level: str = "INFO", sample_rate: float = 1.0) -> None:
+    """
+    配置根日志：输出到标准错误，按级别过滤并对低级别日志采样
+
+    Args:
+        level (str): 日志级别，DEBUG / INFO / WARNING / ERROR
+        sample_rate (float): WARNING 以下的日志的保留比例，1.0 表示全部保留
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(SamplingFilter(sample_rate))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level.upper())
+    # 第三方库的请求日志过于频繁，只保留警告
+    for name in ("httpx", "httpcore"):
+        logging.getLogger(name).setLevel(max(root.level, logging.WARNING))
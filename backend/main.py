@@ -5,30 +5,143 @@
 # 主要功能包括：
 # 1. 提供聊天接口 (/api/chat) - 处理用户聊天请求，生成回复和语音
 # 2. 提供文档上传接口 (/api/upload) - 接收并处理用户上传的文档文件，
-#    支持PDF、Word文档等格式，自动生成内容总结和语音播报
+#    支持PDF、Word文档等格式，在独立的解析进程中逐块读取全文，以map-reduce方式生成内容总结和语音播报，
+#    文档内容写入会话的检索索引，之后的聊天可以针对文档提问；重复上传同一份文档时直接返回缓存结果
 # 3. 集成TTS（文本转语音）服务，为聊天回复和文档总结生成语音片段
-# 4. 支持按句子分割文本并生成对应的语音片段
+# 4. 支持按句子分割文本并生成对应的语音片段，多句语音在线程池中并发合成
 # 5. 处理跨域请求，使前端能够正常访问后端API
+# 6. 提供流式聊天接口 (/api/chat/stream) - 以SSE边生成边推送句子、语音和表情
+# 7. 随应用生命周期管理共享的LLM连接池，并提供运行统计接口 (/api/stats)
+# 8. 语音以二进制传输：回复中只包含语音地址，由 /api/audio/<ID> 返回音频（支持 Range 请求）
+# 9. 记录各阶段耗时和重试、缓存、字节数等指标，以 Prometheus 格式由 /metrics 提供，可选 Server-Timing 响应头
+# 10. 启动后在后台预热：建立服务连接，预先合成各人设常用语句和兜底回复的语音
+# 11. 多人设：聊天请求可以指定人设 (persona)，可用人设由 /api/personas 列出
+# 12. 准入控制：聊天和文档上传分别走交互和批量通道，各自限制并发数并有界排队，繁忙时返回 429；
+#     调用 LLM、向量和 TTS 服务时可按服务商限速，聊天优先
 # 
 # 使用FastAPI框架构建RESTful API，通过CORS中间件解决跨域问题
 # 集成了聊天服务(ChatService)和语音合成服务(TTSService)
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import AsyncIterator, List, Optional, Tuple
+from contextlib import asynccontextmanager
+import asyncio
 import base64
+import hashlib
+import itertools
+import json
+import logging
 import tempfile
 import os
-import re
 
 from chat_service import ChatService
 from tts import TTSService
+from tts_scheduler import TTSScheduler
+from audio_cache import AudioCache
+from audio_store import AUDIO_URL_PREFIX, AudioStore, parse_range
 from config import Config
-from docx import Document
-import PyPDF2
+from text_utils import split_sentences, SentenceBuffer
+from document import (
+    CHARACTER_SETTING, MAP_PROMPT, REDUCE_PROMPT, FINAL_PROMPT,
+    DocumentExtractor, DocumentParseError, summarize_document
+)
+from upload_cache import ChunkSpool, UploadCache
+from document_index import DocumentWriter
+from main_agent import FALLBACK_REPLY
+from persona_registry import PersonaError
+from warmup import Warmup
+from log_config import setup_logging
+from metrics import BYTES, REGISTRY, MetricsMiddleware, span
+from admission import (
+    PRIORITY_BATCH, PRIORITY_INTERACTIVE,
+    AdmissionController, AdmissionLane, AdmissionMiddleware, TokenBucket
+)
+
+setup_logging(Config.LOG_LEVEL, Config.LOG_SAMPLE_RATE)
+logger = logging.getLogger(__name__)
+
+# 只在启用TTS时创建TTS服务，聊天和文档总结共用同一个实例和语音缓存
+tts_service = TTSService(
+    Config.FISH_API_KEY,
+    Config.FISH_REFERENCE_ID,
+    base_url=Config.FISH_API_URL,
+    cache=AudioCache(Config.TTS_CACHE_DIR, Config.TTS_CACHE_MEMORY_BYTES) if Config.TTS_CACHE_ENABLED else None,
+    breaker_failures=Config.BREAKER_FAILURES,
+    breaker_reset=Config.BREAKER_RESET
+) if Config.is_tts_enabled() else None
+chat_service = ChatService(tts_service)
+tts_scheduler = TTSScheduler(
+    tts_service,
+    max_concurrency=Config.TTS_MAX_CONCURRENCY,
+    timeout=Config.TTS_TIMEOUT,
+    attempt_timeout=Config.TTS_ATTEMPT_TIMEOUT,
+    max_attempts=Config.TTS_MAX_ATTEMPTS,
+    hedge_enabled=Config.TTS_HEDGE_ENABLED,
+    rate_limiter=TokenBucket("tts", Config.TTS_RATE_LIMIT, Config.TTS_RATE_BURST) if Config.TTS_RATE_LIMIT > 0 else None
+)
+# 合成好的语音暂存在内存中，回复只返回地址，前端按地址获取二进制音频
+audio_store = AudioStore(Config.AUDIO_STORE_MAX_BYTES, Config.AUDIO_STORE_TTL)
+# PDF/Word 解析在独立进程中进行，不阻塞事件循环
+document_extractor = DocumentExtractor(
+    max_workers=Config.DOC_PARSE_WORKERS,
+    timeout=Config.DOC_PARSE_TIMEOUT,
+    memory_limit_mb=Config.DOC_PARSE_MEMORY_MB,
+    pdf_pages_per_task=Config.DOC_PDF_PAGES_PER_TASK
+)
+# 重复上传同一份文档时直接返回之前的总结和语音
+upload_cache = UploadCache(
+    Config.UPLOAD_CACHE_DIR,
+    Config.UPLOAD_CACHE_MAX_BYTES
+) if Config.UPLOAD_CACHE_ENABLED else None
+
+# 启动后在后台预热，不推迟服务就绪
+warmup = Warmup(
+    chat_service.llm_service,
+    chat_service.embedding_service,
+    tts_service,
+    tts_scheduler,
+    Config.WARMUP_PHRASES,
+    [FALLBACK_REPLY],
+    chat_service.personas,
+    concurrency=Config.WARMUP_CONCURRENCY
+) if Config.WARMUP_ENABLED else None
 
-app = FastAPI()
+# 聊天走交互通道，文档上传走批量通道，上传再多也不占用聊天的名额
+admission = AdmissionController(
+    [
+        AdmissionLane(
+            "interactive", PRIORITY_INTERACTIVE,
+            Config.ADMISSION_CHAT_CONCURRENCY, Config.ADMISSION_CHAT_QUEUE, Config.ADMISSION_CHAT_TIMEOUT
+        ),
+        AdmissionLane(
+            "batch", PRIORITY_BATCH,
+            Config.ADMISSION_UPLOAD_CONCURRENCY, Config.ADMISSION_UPLOAD_QUEUE, Config.ADMISSION_UPLOAD_TIMEOUT
+        )
+    ],
+    {"/api/chat": "interactive", "/api/chat/stream": "interactive", "/api/upload": "batch"}
+) if Config.ADMISSION_ENABLED else None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 启动时建立共享连接池，关闭时释放连接池并结束仍在运行的文档解析进程
+    await chat_service.startup()
+    document_extractor.startup()
+    if warmup:
+        warmup.start()
+    yield
+    if warmup:
+        await warmup.stop()
+    await chat_service.shutdown()
+    tts_scheduler.shutdown()
+    document_extractor.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
+# 准入控制在最内层，被拒绝的请求也带有 CORS 响应头并计入接口指标
+if admission:
+    app.add_middleware(AdmissionMiddleware, controller=admission)
 
 # CORS设置
 app.add_middleware(
@@ -36,130 +149,413 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "Retry-After"],
 )
+# 接口请求数和耗时，并为每个请求记录各阶段的耗时
+app.add_middleware(MetricsMiddleware, timing_header=Config.METRICS_TIMING_HEADER)
+
+# 上传文件每次读取的字节数
+UPLOAD_READ_BLOCK = 1024 * 1024
 
 class ChatRequest(BaseModel):
     message: str
     session_id: Optional[str] = "default"
+    persona: Optional[str] = None  # 人设名称，为空时沿用会话当前的人设
+
+def collect_stats() -> dict:
+    """汇总各组件的运行统计"""
+    stats = {**chat_service.get_stats(), "documents": document_extractor.get_stats()}
+    if upload_cache:
+        stats["upload_cache"] = upload_cache.get_stats()
+    if tts_service:
+        stats["tts"] = tts_scheduler.get_stats()
+    stats["audio_store"] = audio_store.get_stats()
+    if warmup:
+        stats["warmup"] = warmup.get_status()
+    if admission:
+        stats["admission"] = admission.get_stats()
+    return stats
+
+# /metrics 导出时把运行统计中的数值（缓存命中、内存占用等）展开成 gauge
+REGISTRY.register_collector("stats", collect_stats)
 
-chat_service = ChatService()
-tts_service = TTSService(Config.FISH_API_KEY, Config.FISH_REFERENCE_ID)
+@app.get("/api/stats")
+async def stats():
+    return collect_stats()
 
-# Add this helper function
-def split_sentences(text):
-    # Split by common sentence ending punctuation
-    sentences = re.split(r'[。！？\?!]', text)
-    # Filter out empty sentences and strip whitespace
-    sentences = [s.strip() for s in sentences if s.strip()]
-    return sentences
+if Config.METRICS_ENABLED:
+    @app.get("/metrics")
+    async def metrics():
+        return PlainTextResponse(REGISTRY.expose(), media_type="text/plain; version=0.0.4")
+
+@app.get(AUDIO_URL_PREFIX + "{audio_id}")
+async def get_audio(audio_id: str, request: Request):
+    """返回暂存的语音，支持单个字节区间的 Range 请求"""
+    audio = audio_store.get(audio_id)
+    if audio is None:
+        return Response(status_code=404)
+    headers = {
+        "Accept-Ranges": "bytes",
+        # 地址是一次性的随机 ID，有效期内内容不会变化
+        "Cache-Control": f"private, max-age={int(Config.AUDIO_STORE_TTL)}"
+    }
+    byte_range = parse_range(request.headers.get("range"), len(audio))
+    if byte_range is None:
+        BYTES.inc(len(audio), kind="audio_served")
+        return Response(audio, media_type=Config.AUDIO_MEDIA_TYPE, headers=headers)
+    start, end = byte_range
+    BYTES.inc(end + 1 - start, kind="audio_served")
+    headers["Content-Range"] = f"bytes {start}-{end}/{len(audio)}"
+    return Response(audio[start:end + 1], status_code=206, media_type=Config.AUDIO_MEDIA_TYPE, headers=headers)
+
+@app.get("/api/personas")
+async def personas():
+    return {"personas": chat_service.personas.names(), "default": chat_service.personas.default}
+
+def check_persona(request: ChatRequest) -> Optional[JSONResponse]:
+    """请求指定的人设不存在或无法加载时返回 400 响应"""
+    if not request.persona:
+        return None
+    try:
+        chat_service.personas.get(request.persona)
+    except PersonaError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    return None
 
 @app.post("/api/chat")
 async def chat(request: ChatRequest):
+    error = check_persona(request)
+    if error:
+        return error
     return await normal_chat_flow(request)
 
 async def normal_chat_flow(request: ChatRequest):
-    reply, audio_data, expression = await chat_service.generate_reply(
+    # 语音按句合成，这里不需要整段回复的语音
+    reply, _, expression = await chat_service.generate_reply(
         request.message, 
-        request.session_id
+        request.session_id,
+        with_audio=False,
+        persona=request.persona
     )
     
-    print("-- /api/chat --")
-    print("reply:", reply)
-    print("expression:", expression)
+    logger.debug("/api/chat reply: %s expression: %s", reply, expression)
 
     # Split reply into sentences
-    sentences = split_sentences(reply)
+    with span("sentence_split"):
+        sentences = split_sentences(reply)
     
-    # Try to generate audio for each sentence
-    audio_segments = []
-    if Config.is_tts_enabled():
-        for sentence in sentences:
-            sentence_audio = tts_service.generate_audio(sentence)
-            if sentence_audio:
-                audio_segments.append(base64.b64encode(sentence_audio).decode('ascii'))
+    # Generate audio for each sentence concurrently
+    audio_segments = await synthesize_segments(sentences)
     
-    # If we have separate audio segments, return them; otherwise use single audio
-    if audio_segments and len(audio_segments) == len(sentences):
+    # If every sentence has audio, return their URLs; otherwise use single audio
+    if audio_segments:
+        with span("audio_encode"):
+            audio_urls = [audio_store.put(audio) for audio in audio_segments]
         return JSONResponse(
             content={
                 "message": reply,
                 "sentences": sentences,
-                "audio_segments": audio_segments,
+                "audio_urls": audio_urls,
                 "expression": expression
             }
         )
     else:
         # Fallback to single audio file
-        audio_base64 = base64.b64encode(audio_data).decode('ascii') if audio_data else ''
+        audio_data = await tts_scheduler.synthesize(reply) if Config.is_tts_enabled() else b""
         return JSONResponse(
             content={
                 "message": reply,
-                "audio": audio_base64,
+                "audio_url": audio_store.put(audio_data),
                 "expression": expression
             }
         )
 
-@app.post("/api/upload")
-async def upload(file: UploadFile = File(...)):
-    # 保存临时文件
-    suffix = os.path.splitext(file.filename)[-1].lower()
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        content = await file.read()
-        tmp.write(content)
-        tmp_path = tmp.name
-
-    # 读取文本内容
-    text = ""
-    if suffix == ".pdf":
-        with open(tmp_path, "rb") as f:
-            reader = PyPDF2.PdfReader(f)
-            for page in reader.pages:
-                text += page.extract_text() or ""
-    elif suffix in [".doc", ".docx"]:
-        doc = Document(tmp_path)
-        for para in doc.paragraphs:
-            text += para.text + "\n"
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest):
+    error = check_persona(request)
+    if error:
+        return error
+    return StreamingResponse(
+        stream_chat_flow(request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def sse_event(event: str, data: dict) -> str:
+    """格式化一条 SSE 事件"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def synthesize_sentence(sentence: str) -> str:
+    """合成一句语音，返回语音地址（TTS 未启用或失败时为空字符串）"""
+    audio = await tts_scheduler.synthesize(sentence)
+    return audio_store.put(audio)
+
+async def synthesize_segments(sentences: list) -> List[bytes]:
+    """
+    并发合成每句语音，返回与 sentences 一一对应的音频；
+    TTS 未启用或有句子超时、失败时返回空列表，由调用方改为合成整段回复，不返回缺句的逐句语音
+    """
+    if not Config.is_tts_enabled():
+        return []
+    audios = await tts_scheduler.synthesize_all(sentences)
+    if not audios or not all(audios):
+        return []
+    return audios
+
+def encode_audio(audio: Optional[bytes]) -> str:
+    """上传缓存以 JSON 保存在磁盘上，其中的语音使用 base64 编码"""
+    return base64.b64encode(audio).decode('ascii') if audio else ''
+
+def cache_upload(cache_key: str, name: str, spool: ChunkSpool, result: dict, audios: List[Optional[bytes]]) -> None:
+    """
+    写入上传缓存（阻塞）：缓存中保存语音本身而不是地址，命中时重新放进语音存储、生成新的地址
+
+    Args:
+        spool: 上传过程中逐块写好的文本块文件
+        audios: 按句合成时为每句的语音，否则为只有整段语音的列表
+    """
+    response = {key: value for key, value in result.items() if key not in ("audio_urls", "audio_url")}
+    if "audio_urls" in result:
+        response["audio_segments"] = [encode_audio(audio) for audio in audios]
     else:
-        text = content.decode("utf-8", errors="ignore")
+        response["audio"] = encode_audio(audios[0])
+    upload_cache.put(cache_key, {"name": name, "response": response}, spool)
 
-    os.remove(tmp_path)
+def cached_upload_response(response: dict) -> dict:
+    """把上传缓存中 base64 编码的语音放进语音存储，返回只包含语音地址的响应"""
+    result = {key: value for key, value in response.items() if key not in ("audio_segments", "audio")}
+    if "audio_segments" in response:
+        result["audio_urls"] = [
+            audio_store.put(base64.b64decode(audio)) if audio else ''
+            for audio in response["audio_segments"]
+        ]
+    else:
+        audio = response.get("audio")
+        result["audio_url"] = audio_store.put(base64.b64decode(audio)) if audio else ''
+    return result
+
+async def stream_chat_flow(request: ChatRequest):
+    """
+    流式聊天流程
+
+    LLM 每输出一个完整句子就立即提交 TTS 合成，按句子顺序推送事件：
+    - sentence: {"index", "text", "audio_url"}，audio_url 为语音地址（合成失败时为空）
+    - expression: {"expression"}，解析到表情后尽早推送，不必等前面的语音合成完
+    - done: {"message", "sentences", "expression"}
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    expression_future = asyncio.get_running_loop().create_future()
+    tts_tasks = []
+
+    async def produce():
+        # 消费 LLM 流，切句后立即启动 TTS 任务，按顺序放入队列
+        buffer = SentenceBuffer()
+        sentences = []
+        try:
+            async for event, value in chat_service.stream_reply(
+                request.message, request.session_id, persona=request.persona
+            ):
+                if event == "expression":
+                    if not expression_future.done():
+                        expression_future.set_result(value)
+                    await queue.put(("expression", value))
+                    continue
+
+                new_sentences = buffer.feed(value) if event == "text" else buffer.flush()
+                for sentence in new_sentences:
+                    task = asyncio.create_task(synthesize_sentence(sentence))
+                    tts_tasks.append(task)
+                    await queue.put(("sentence", (len(sentences), sentence, task)))
+                    sentences.append(sentence)
+
+                if event == "done":
+                    await queue.put(("done", {
+                        "message": value["reply"],
+                        "sentences": sentences,
+                        "expression": value["expression"]
+                    }))
+        finally:
+            await queue.put(None)
+
+    producer = asyncio.create_task(produce())
+    expression_sent = False
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            event, value = item
+            if event == "sentence":
+                index, sentence, task = value
+                # 等待语音合成时，如果表情先解析出来就先推送表情
+                if not expression_sent:
+                    await asyncio.wait({task, expression_future}, return_when=asyncio.FIRST_COMPLETED)
+                    if expression_future.done():
+                        expression_sent = True
+                        yield sse_event("expression", {"expression": expression_future.result()})
+                try:
+                    audio = await task
+                except Exception as e:
+                    logger.error("流式语音合成出错: %s", e)
+                    audio = ""
+                yield sse_event("sentence", {"index": index, "text": sentence, "audio_url": audio})
+            elif event == "expression":
+                if not expression_sent:
+                    expression_sent = True
+                    yield sse_event("expression", {"expression": value})
+            elif event == "done":
+                logger.debug("/api/chat/stream reply: %s expression: %s", value["message"], value["expression"])
+                yield sse_event("done", value)
+        await producer
+    finally:
+        # 客户端断开时取消尚未完成的生成和合成
+        producer.cancel()
+        for task in tts_tasks:
+            task.cancel()
 
-    # 用 LLM 总结，加入性格设定
-    character_setting = "你是一个温柔、乐观、喜欢用比喻和鼓励的话语和用户交流的虚拟助手。"
-    prompt = (
-        f"{character_setting}\n"
-        "请用自然口语、完整段落、不要列表、不要星号、不要编号，像和朋友聊天一样总结以下文档内容。"
-        "表达要富有情感和语气，适当使用强调和重音词汇，让听起来更像真人说话：\n"
-        f"{text[:4000]}"
+async def save_upload(file: UploadFile, suffix: str) -> Tuple[str, str]:
+    """
+    把上传文件分块写入临时文件，不在内存中保留整个文件
+
+    Returns:
+        Tuple[str, str]: (临时文件路径, 文件内容的 sha256)
+    """
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+        while True:
+            block = await file.read(UPLOAD_READ_BLOCK)
+            if not block:
+                break
+            digest.update(block)
+            tmp.write(block)
+            BYTES.inc(len(block), kind="upload_received")
+        return tmp.name, digest.hexdigest()
+
+def upload_fingerprint() -> str:
+    """影响上传结果的配置指纹：人设和提示词、LLM 模型、切块参数、音色"""
+    return UploadCache.make_fingerprint(
+        CHARACTER_SETTING, MAP_PROMPT, REDUCE_PROMPT, FINAL_PROMPT,
+        Config.LLM_API_URL, Config.LLM_MODEL,
+        Config.DOC_CHUNK_TOKENS, Config.DOC_REDUCE_TOKENS,
+        Config.FISH_REFERENCE_ID if Config.is_tts_enabled() else ""
     )
-    reply = await chat_service.llm_service.generate_response(prompt)
+
+async def tee_chunks(
+    chunks: AsyncIterator[str],
+    writer: DocumentWriter,
+    spool: Optional[ChunkSpool]
+) -> AsyncIterator[str]:
+    """
+    原样转发文档块给总结，同时交给文档索引（后台计算向量，与 map 阶段并行）
+    并写入上传缓存的临时文件，不在内存中保留整份文档
+    """
+    async for chunk in chunks:
+        writer.add(chunk)
+        if spool:
+            await asyncio.to_thread(spool.write, chunk)
+        yield chunk
+
+async def index_cached_chunks(session_id: str, name: str, cache_key: str, cached: dict) -> None:
+    """把上传缓存中的文本块逐批读回并写入会话的文档索引"""
+    writer = chat_service.document_writer(name)
+    chunks = upload_cache.iter_chunks(cache_key, cached)
+    try:
+        while True:
+            batch = await asyncio.to_thread(lambda: list(itertools.islice(chunks, 64)))
+            if not batch:
+                break
+            for chunk in batch:
+                writer.add(chunk)
+        await chat_service.index_document(session_id, writer)
+    except BaseException:
+        writer.cancel()
+        raise
+
+@app.post("/api/upload")
+async def upload(file: UploadFile = File(...), session_id: str = Form("default")):
+    # 保存临时文件，同时计算内容哈希
+    suffix = os.path.splitext(file.filename)[-1].lower()
+    tmp_path, content_hash = await save_upload(file, suffix)
+
+    # 同一份文件在相同配置下上传过时，直接返回缓存的总结和语音
+    cache_key = UploadCache.make_key(content_hash, upload_fingerprint())
+    if upload_cache:
+        cached = await asyncio.to_thread(upload_cache.get, cache_key)
+        if cached:
+            os.remove(tmp_path)
+            await index_cached_chunks(session_id, file.filename, cache_key, cached)
+            with span("audio_encode"):
+                return await asyncio.to_thread(cached_upload_response, cached["response"])
+
+    # 逐块读取全文并 map-reduce 总结，加入性格设定；
+    # 读到的块同时写入文档索引和上传缓存的临时文件，不在内存中攒整份文档
+    writer = chat_service.document_writer(file.filename)
+    spool = await asyncio.to_thread(upload_cache.open_spool) if upload_cache else None
+    try:
+        reply = await summarize_document(
+            chat_service.llm_service,
+            tee_chunks(document_extractor.iter_chunks(tmp_path, suffix, Config.DOC_CHUNK_TOKENS), writer, spool),
+            concurrency=Config.DOC_SUMMARY_CONCURRENCY,
+            reduce_tokens=Config.DOC_REDUCE_TOKENS,
+            attempt_timeout=Config.DOC_LLM_ATTEMPT_TIMEOUT,
+            deadline=Config.DOC_LLM_DEADLINE,
+            min_summary_ratio=Config.DOC_MIN_SUMMARY_RATIO
+        )
+        # 写入会话的文档索引，之后可以在聊天中针对文档内容提问；片段向量在总结期间已经算好
+        await chat_service.index_document(session_id, writer)
+    except BaseException as e:
+        writer.cancel()
+        if spool:
+            await asyncio.to_thread(spool.discard)
+        if not isinstance(e, DocumentParseError):
+            raise
+        logger.warning("上传的文档无法处理: %s", e)
+        return JSONResponse(
+            status_code=422,
+            content={"summary": f"抱歉，这份文档没能读完：{e}", "error": str(e)}
+        )
+    finally:
+        os.remove(tmp_path)
     
     # Split reply into sentences
-    sentences = split_sentences(reply)
+    with span("sentence_split"):
+        sentences = split_sentences(reply)
     
-    # Generate audio for each sentence
-    audio_segments = []
-    if Config.is_tts_enabled():
-        for sentence in sentences:
-            audio_data = tts_service.generate_audio(sentence)
-            if audio_data:
-                audio_segments.append(base64.b64encode(audio_data).decode('ascii'))
+    # Generate audio for each sentence concurrently
+    audio_segments = await synthesize_segments(sentences)
     
-    # If we have separate audio segments, return them; otherwise generate one for the whole text
-    if audio_segments and len(audio_segments) == len(sentences):
-        return {
-            "summary": reply,
-            "sentences": sentences,
-            "audio_segments": audio_segments
-        }
+    # If every sentence has audio, return their URLs; otherwise generate one for the whole text
+    if audio_segments:
+        with span("audio_encode"):
+            result = {
+                "summary": reply,
+                "sentences": sentences,
+                "audio_urls": [audio_store.put(audio) for audio in audio_segments]
+            }
+        complete = True
     else:
         # Fallback to single audio file
         audio_data = None
         if Config.is_tts_enabled():
-            audio_data = tts_service.generate_audio(reply)
-        audio_base64 = base64.b64encode(audio_data).decode('ascii') if audio_data else ''
+            audio_data = await tts_scheduler.synthesize(reply)
         
-        return {
+        result = {
             "summary": reply,
-            "audio": audio_base64
-        }
\ No newline at end of file
+            "audio_url": audio_store.put(audio_data)
+        }
+        complete = bool(audio_data) or not Config.is_tts_enabled()
+
+    # 语音有缺失时不缓存，下次上传重新合成
+    if spool and complete:
+        with span("audio_encode"):
+            await asyncio.to_thread(
+                cache_upload,
+                cache_key,
+                file.filename,
+                spool,
+                result,
+                audio_segments or [audio_data]
+            )
+    elif spool:
+        await asyncio.to_thread(spool.discard)
+    return result
@@ -4,108 +4,304 @@
 # 
 # 主要功能包括：
 # 1. 管理对话历史记录和上下文
-# 2. 构建提示词模板，整合用户消息、历史对话和相关记忆
+# 2. 构建提示词：固定的系统前缀（人设和规则）+ 多轮历史消息 + 本轮输入，便于命中服务商的前缀缓存
 # 3. 调用LLM服务生成智能回复
 # 4. 处理和更新用户个人信息
-# 5. 记录对话日志到文件系统
-# 6. 管理相关记忆检索，增强对话连贯性
+# 5. 记录对话日志到文件系统（JSONL 格式，由后台写入器批量写入）
+# 6. 管理相关记忆检索，增强对话连贯性；检索已上传文档的相关片段，支持针对文档提问
+# 7. 支持流式生成回复，边生成边输出回复文本和表情
+# 8. 可选的回复缓存：重复或几乎相同的短消息直接返回之前的回复，不调用LLM
 # 
 # 该模块是整个聊天系统的核心大脑，协调各个组件完成智能对话功能
+import asyncio
+import logging
 from llm import LLMService
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, AsyncIterator, Any, Optional
+import json
 import os
 from datetime import datetime
 from conversation import ConversationHistory
+from document_index import DocumentIndex
+from background_writer import BackgroundWriter
+from json_stream import JsonFieldStream, has_text, parse_json_object
+from response_cache import ResponseCache
+from metrics import span
+from persona_registry import Persona, PersonaRegistry
+
+logger = logging.getLogger(__name__)
+
+# LLM 没有返回可用回复或生成出错时的兜底回复，启动预热时会预先合成它的语音
+FALLBACK_REPLY = "对不起，我现在有点累了，能稍后再聊吗？"
+FALLBACK_EXPRESSION = "生气"
+
+# 每轮变化的内容放在最后一条用户消息中
+INPUT_TEMPLATE = (
+    "之前对话的摘要：\n{summary}\n\n"
+    "用户的个人信息：\n{user_info}\n\n"
+    "相关记忆：\n{memory}\n\n"
+    "用户的最新问题：\n{user_message}\n\n"
+    "请按输出格式只输出JSON。"
+)
 
 class MainAgent:
-    def __init__(self, llm_service: LLMService, conversation_history: ConversationHistory):
+    def __init__(
+        self,
+        llm_service: LLMService,
+        conversation_history: ConversationHistory,
+        user_info_file: str = 'save/me.txt',
+        log_dir: str = 'save/log',
+        document_index: Optional[DocumentIndex] = None,
+        writer: Optional[BackgroundWriter] = None,
+        response_cache: Optional[ResponseCache] = None,
+        cache_scope: str = "default",
+        personas: Optional[PersonaRegistry] = None,
+        persona: Optional[str] = None
+    ):
         self.conversation_history = conversation_history
+        self.document_index = document_index
+        # 后台写入器，日志和个人信息不在请求路径上写磁盘；为 None 时同步写入
+        self.writer = writer
         self.llm_service = llm_service
-        with open('prompts/reply.txt', 'r', encoding='utf-8') as file:
-            self.prompt_template = file.read()
+        # 人设提示词由注册表加载并在所有会话间共享，每轮按名称取当前版本（支持热更新）
+        self.personas = personas or PersonaRegistry()
+        self.persona_name = persona or self.personas.default
+        self.personas.get(self.persona_name)
+
+        # 回复缓存按会话和人设隔离，人设以系统前缀的哈希表示，修改提示词后旧回复不再命中
+        self.response_cache = response_cache
+        self._cache_scope = cache_scope
             
         # 确保日志和个人信息目录存在
-        self.log_dir = 'save/log'
+        self.log_dir = log_dir
         os.makedirs(self.log_dir, exist_ok=True)
         
         # 读取个人信息文件
-        self.user_info_file = 'save/me.txt'
+        self.user_info_file = user_info_file
+        os.makedirs(os.path.dirname(self.user_info_file) or '.', exist_ok=True)
         self.user_info = self._load_user_info()
 
+    @property
+    def persona(self) -> Persona:
+        return self.personas.get(self.persona_name)
+
+    @property
+    def system_prompt(self) -> str:
+        """人设和规则组成的固定系统前缀"""
+        return self.persona.system_prompt
+
+    @property
+    def cache_scope(self) -> str:
+        return f"{self._cache_scope}:{self.persona.digest}"
+
+    def set_persona(self, name: str) -> None:
+        """切换本会话的人设，人设不存在时抛出 PersonaError"""
+        self.personas.get(name)
+        self.persona_name = name
+
     def _log_conversation(self, role: str, content: str) -> None:
-        """记录对话到日志文件"""
-        current_date = datetime.now().strftime('%Y%m%d')
-        current_time = datetime.now().strftime('%H:%M:%S')
-        log_file = os.path.join(self.log_dir, f'{current_date}.txt')
-        
+        """记录对话到日志文件，每条记录一行 JSON"""
+        record = {"role": role, "content": content}
+        if self.writer:
+            self.writer.log(self.log_dir, record)
+            return
+
+        now = datetime.now()
+        log_file = os.path.join(self.log_dir, f"{now.strftime('%Y%m%d')}.jsonl")
         with open(log_file, 'a', encoding='utf-8') as f:
-            f.write(f'[{current_time}] {role.capitalize()}: {content}\n')
+            f.write(json.dumps({"time": now.isoformat(timespec="milliseconds"), **record}, ensure_ascii=False) + '\n')
         
     async def reply(self, message: str) -> Tuple[str, str]:
         """生成回复"""
         # 记录用户消息
         self._log_conversation('user', message)
-        
-        # 获取相关记忆
-        memory_text = self._get_relevant_memories(message)
-        print("相关记忆:", memory_text)
+
+        # 重复的短消息直接使用缓存的回复，未命中时同时得到相关记忆
+        cached, memory_text = await self._get_cached_reply_or_memories(message)
+        if cached:
+            return cached
+        logger.debug("相关记忆: %s", memory_text)
         
         # 生成回复
         reply_content, expression = await self._generate_reply(message, memory_text)
         
         # 处理回复
         if reply_content:
-            self._handle_successful_reply(message, reply_content)
+            await self._handle_successful_reply(message, reply_content)
             
         return reply_content, expression
 
+    async def _get_cached_reply_or_memories(self, message: str) -> Tuple[Optional[Tuple[str, str]], str]:
+        """
+        查询回复缓存，未命中时检索相关记忆，返回 (缓存的回复和表情, 相关记忆)
+
+        精确匹配在本地完成；近似匹配需要消息向量，和记忆检索并行进行，
+        两者的向量合并在同一次请求中，未命中时的耗时与只检索记忆相同。
+        命中时同样写入日志和对话历史
+        """
+        cache = self.response_cache
+        cached = None
+        memory_text = ""
+        if cache:
+            with span("response_cache"):
+                cached = cache.get(self.cache_scope, message)
+        if not cached and cache and cache.can_match_similar(self.cache_scope, message):
+            async def get_similar() -> Optional[Tuple[str, str]]:
+                with span("response_cache"):
+                    return await cache.get_similar(self.cache_scope, message)
+
+            cached, memory_text = await asyncio.gather(get_similar(), self._get_relevant_memories(message))
+        elif not cached:
+            memory_text = await self._get_relevant_memories(message)
+
+        if cached:
+            logger.debug("回复缓存命中: %s", message)
+            await self._handle_successful_reply(message, cached[0])
+        return cached, memory_text
+
+    async def stream_reply(self, message: str) -> AsyncIterator[Tuple[str, Any]]:
+        """
+        流式生成回复
+
+        依次产出事件：
+        ("text", 回复文本增量)、("expression", 表情，一旦解析到就产出)、
+        ("done", {"reply": 完整回复, "expression": 表情})
+        """
+        self._log_conversation('user', message)
+
+        cached, memory_text = await self._get_cached_reply_or_memories(message)
+        if cached:
+            reply_content, expression = cached
+            yield "text", reply_content
+            yield "expression", expression
+            yield "done", {"reply": reply_content, "expression": expression}
+            return
+        logger.debug("相关记忆: %s", memory_text)
+
+        messages = self._build_messages(message, memory_text)
+        parser = JsonFieldStream("reply")
+        chunks = []
+        expression_sent = False
+
+        with span("llm_stream"):
+            async for chunk in self.llm_service.stream_response(messages):
+                chunks.append(chunk)
+                delta = parser.feed(chunk)
+                if delta:
+                    yield "text", delta
+                if not expression_sent and "expression" in parser.fields:
+                    expression_sent = True
+                    yield "expression", parser.fields["expression"]
+
+        # 流结束后按完整输出解析（格式有误时在本地修复），没有 JSON 对象时使用流式解析出的字段
+        with span("json_parse"):
+            try:
+                reply = parse_json_object("".join(chunks))
+            except ValueError:
+                reply = parser.snapshot()
+
+        if has_text(reply, "reply"):
+            reply_content, expression = self._apply_reply(reply)
+        else:
+            # 没有可用的回复时和生成出错一样使用兜底回复；流式输出无法重试，兜底回复不缓存、不写入历史
+            logger.warning("流式回复中没有 reply 字段，使用兜底回复")
+            reply_content, expression = "", reply.get("expression") or FALLBACK_EXPRESSION
+            yield "text", FALLBACK_REPLY
+        if not expression_sent and expression:
+            yield "expression", expression
+
+        if reply_content and self.response_cache:
+            self.response_cache.put(self.cache_scope, message, reply_content, expression)
+        if reply_content:
+            await self._handle_successful_reply(message, reply_content)
+
+        yield "done", {"reply": reply_content or FALLBACK_REPLY, "expression": expression}
+
+    def _build_messages(self, message: str, memory_text: str) -> List[Dict[str, str]]:
+        """
+        构建多条消息的请求：固定的系统前缀 + 历史对话 + 本轮输入
+
+        前两部分在相邻两轮之间只在末尾追加，服务商可以复用前缀缓存，
+        每轮只有最后一条用户消息（对话摘要、用户信息、相关记忆和问题）是新内容；
+        历史对话有 token 预算，更早的对话以滚动摘要的形式出现，提示词长度不随对话变长
+        """
+        with span("prompt_build"):
+            return [
+                {"role": "system", "content": self.system_prompt},
+                *self.conversation_history.get_messages(),
+                {"role": "user", "content": INPUT_TEMPLATE.format(
+                    summary=self.conversation_history.summary or "暂无",
+                    user_info=self.user_info or "暂无",
+                    memory=memory_text,
+                    user_message=message
+                )}
+            ]
+
+    def _apply_reply(self, reply: Dict) -> Tuple[str, str]:
+        """处理 LLM 返回的 JSON，更新用户信息并返回 (回复, 表情)"""
+        # 检查是否有用户信息更新（修复后的输出中可能缺失或不是文本）
+        if isinstance(reply.get("user_info"), str):
+            self._save_user_info(reply["user_info"])
+            self.user_info = reply["user_info"]
+
+        return reply.get("reply", ""), reply.get("expression", "")
+
     async def _generate_reply(self, message: str, memory_text: str = "无补充信息") -> Tuple[str, str]:
         """生成回复的核心方法"""
-        # 准备prompt
-        context = self.conversation_history.get_context()
-        prompt = self.prompt_template.format(
-            chat_history=context,
-            user_message=message,
-            memory=memory_text,
-            user_info=self.user_info
-        )
+        # 准备多条消息的请求
+        messages = self._build_messages(message, memory_text)
         
         # 获取LLM回复
-        reply = await self.llm_service.generate_response(prompt, is_json=True)
-        if not reply:
-            return "对不起，我现在有点累了，能稍后再聊吗？", "生气"
-        
-        # 检查是否有用户信息更新
-        if "user_info" in reply:
-            self._save_user_info(reply["user_info"])
-            self.user_info = reply["user_info"]
-        
-        return reply.get("reply", ""), reply.get("expression", "")
+        with span("llm"):
+            # 缺少回复文本的 JSON 按解析失败重试，仍然没有时由调用方返回兜底回复
+            reply = await self.llm_service.generate_response(messages, is_json=True, required_fields=("reply",))
+        if not has_text(reply, "reply"):
+            return FALLBACK_REPLY, FALLBACK_EXPRESSION
+
+        reply_content, expression = self._apply_reply(reply)
+        # 只缓存 LLM 正常返回的回复，兜底回复不缓存
+        if reply_content and self.response_cache:
+            self.response_cache.put(self.cache_scope, message, reply_content, expression)
+        return reply_content, expression
 
-    def _get_relevant_memories(self, message: str) -> str:
-        """获取相关记忆"""
-        memories = self.conversation_history.retrieve(message, n_results=2)
+    async def _get_relevant_memories(self, message: str) -> str:
+        """获取相关记忆，以及已上传文档中与问题相关的片段"""
+        with span("memory_retrieval"):
+            if self.document_index and len(self.document_index) > 0:
+                memories, passages = await asyncio.gather(
+                    self.conversation_history.retrieve(message, n_results=2),
+                    self.document_index.search(message, k=3)
+                )
+                memories = memories + [f"文档《{name}》片段：{text.strip()}" for name, text in passages]
+            else:
+                memories = await self.conversation_history.retrieve(message, n_results=2)
         return "\n".join(memories) if memories else "无补充信息"
 
-    def _handle_successful_reply(self, message: str, reply_content: str) -> None:
+    async def _handle_successful_reply(self, message: str, reply_content: str) -> None:
         """处理成功的回复"""
         self._log_conversation('assistant', reply_content)
-        self.conversation_history.add_dialog(message, reply_content)
+        await self.conversation_history.add_dialog(message, reply_content)
 
     def _load_user_info(self) -> str:
         """加载用户个人信息"""
+        # 后台写入器中还没落盘的内容比文件更新
+        pending = self.writer.pending_text(self.user_info_file) if self.writer else None
+        if pending is not None:
+            return pending
         try:
             if os.path.exists(self.user_info_file):
                 with open(self.user_info_file, 'r', encoding='utf-8') as f:
                     return f.read().strip()
         except Exception as e:
-            print(f"读取个人信息文件出错: {e}")
+            logger.warning("读取个人信息文件出错: %s", e)
         return ""
 
     def _save_user_info(self, info: str) -> None:
-        """保存用户个人信息"""
+        """保存用户个人信息，有后台写入器时防抖并原子写入"""
+        if self.writer:
+            self.writer.save_text(self.user_info_file, info)
+            return
         try:
             with open(self.user_info_file, 'w', encoding='utf-8') as f:
                 f.write(info)
         except Exception as e:
-            print(f"保存个人信息文件出错: {e}")
\ No newline at end of file
+            logger.error("保存个人信息文件出错: %s", e)
\ No newline at end of file
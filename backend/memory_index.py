@@ -0,0 +1,111 @@
+# memory_index.py
+#
+# 基于 NumPy 的向量记忆索引
+#
+# 归档的对话在写入时计算一次向量，按行存放在一块连续的 float32 矩阵里，
+# 写入前做 L2 归一化，检索时一次矩阵乘法就得到所有余弦相似度，
+# 再用 argpartition 取 top-k，避免对全部结果排序。
+# 容量按倍数扩展，追加的均摊成本为 O(1)。
+# 可以删除最早写入的条目，配合上限使用，保证索引占用的内存有界。
+from typing import Any, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class VectorIndex:
+    def __init__(self, dimension: Optional[int] = None, initial_capacity: int = 256):
+        """
+        Args:
+            dimension (int): 向量维度，为 None 时由第一次写入的向量决定
+            initial_capacity (int): 矩阵初始行数
+        """
+        self.dimension = dimension
+        self._capacity = initial_capacity
+        self._vectors: Optional[np.ndarray] = None
+        self._items: List[Any] = []
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def items(self) -> List[Any]:
+        """已写入的条目，按写入顺序排列"""
+        return list(self._items)
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _ensure_capacity(self, needed: int) -> None:
+        if self._vectors is None:
+            capacity = max(self._capacity, needed)
+            self._vectors = np.empty((capacity, self.dimension), dtype=np.float32)
+        elif needed > self._vectors.shape[0]:
+            capacity = max(self._vectors.shape[0] * 2, needed)
+            grown = np.empty((capacity, self.dimension), dtype=np.float32)
+            grown[:len(self._items)] = self._vectors[:len(self._items)]
+            self._vectors = grown
+
+    def add(self, vectors: Sequence[Sequence[float]], items: Sequence[Any]) -> None:
+        """
+        批量写入向量和对应的条目
+
+        Args:
+            vectors: 形状为 (n, dimension) 的向量
+            items: 与向量一一对应的条目（检索时原样返回）
+        """
+        if len(items) == 0:
+            return
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(len(items), -1)
+        if self.dimension is None:
+            self.dimension = matrix.shape[1]
+        elif matrix.shape[1] != self.dimension:
+            raise ValueError(f"向量维度不匹配: {matrix.shape[1]} != {self.dimension}")
+
+        start = len(self._items)
+        self._ensure_capacity(start + len(items))
+        self._vectors[start:start + len(items)] = self._normalize(matrix)
+        self._items.extend(items)
+
+    def remove_oldest(self, count: int) -> None:
+        """删除最早写入的 count 条，剩余的行前移，容量不变"""
+        count = min(count, len(self._items))
+        if count <= 0:
+            return
+        remaining = len(self._items) - count
+        self._vectors[:remaining] = self._vectors[count:count + remaining]
+        del self._items[:count]
+
+    @property
+    def nbytes(self) -> int:
+        """向量矩阵占用的字节数（按已分配的容量计算）"""
+        return 0 if self._vectors is None else self._vectors.nbytes
+
+    def search(self, query: Sequence[float], k: int = 3, min_score: float = -1.0) -> List[Tuple[Any, float]]:
+        """
+        余弦相似度 top-k 检索
+
+        Args:
+            query: 查询向量
+            k (int): 返回的最大条数
+            min_score (float): 相似度下限，低于该值的结果会被丢弃
+
+        Returns:
+            List[Tuple[Any, float]]: (条目, 相似度)，按相似度从高到低排列
+        """
+        size = len(self._items)
+        if size == 0 or k <= 0:
+            return []
+
+        q = self._normalize(np.asarray(query, dtype=np.float32).reshape(-1))
+        scores = self._vectors[:size] @ q
+
+        if size > k:
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(size)
+        top = top[np.argsort(-scores[top])]
+
+        return [(self._items[i], float(scores[i])) for i in top if scores[i] >= min_score]
@@ -0,0 +1,262 @@
+# metrics.py
+#
+# 热路径埋点与 Prometheus 指标
+#
+# 原来只能靠 print 观察服务，这里提供轻量的指标，不依赖 prometheus_client：
+# 1. span(stage)：记录一个阶段（记忆检索、提示词构建、LLM 调用、JSON 解析、切句、每次 TTS、语音编码）的耗时，
+#    写入直方图 llm2d_stage_seconds，同时记在当前请求的计时中，可以通过 Server-Timing 响应头返回
+# 2. Counter / Histogram：重试次数、传输字节数、本地修复的 JSON 输出数、准入排队和限流等待、各接口的请求数和耗时
+# 3. 采集函数 (register_collector)：导出时把各组件 get_stats() 返回的数值（缓存命中、内存占用等）转换成 gauge，
+#    不需要在每个缓存里重复计数
+# /metrics 接口返回 Prometheus 文本格式。指标的更新都加锁，TTS 线程池中也可以使用。
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# 阶段耗时直方图的桶（秒），覆盖从本地计算到远程调用的范围
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# 当前请求的阶段计时 [(阶段, 秒)]，为 None 时不在请求中（后台任务等）
+_request_timings: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar(
+    "request_timings", default=None
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # 标签值 -> [各桶计数..., 总和, 总数]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ("le",)
+        with self._lock:
+            for key, counts in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    labels = _format_labels(names, key + (_format_value(bound),))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(counts[-2])}")
+                lines.append(f"{self.name}_count{labels} {counts[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self, prefix: str = "llm2d"):
+        self.prefix = prefix
+        self._metrics: List = []
+        self._collectors: List[Tuple[str, Callable[[], dict]]] = []
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(f"{self.prefix}_{name}", documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), **kwargs) -> Histogram:
+        metric = Histogram(f"{self.prefix}_{name}", documentation, labelnames, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, name: str, collect: Callable[[], dict]) -> None:
+        """
+        注册一个采集函数，导出时把它返回的嵌套字典中的数值展开成 gauge，
+        例如 name="stats" 时 {"tts_cache": {"misses": 3}} 导出为 llm2d_stats_tts_cache_misses 3
+        """
+        self._collectors.append((name, collect))
+
+    def expose(self) -> str:
+        """Prometheus 文本格式"""
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        for name, collect in self._collectors:
+            try:
+                values = collect()
+            except Exception as e:
+                lines.append(f"# 采集 {name} 出错: {type(e).__name__}")
+                continue
+            for key, value in _flatten(f"{self.prefix}_{name}", values):
+                lines.append(f"# TYPE {key} gauge")
+                lines.append(f"{key} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _flatten(prefix: str, values: dict) -> Iterator[Tuple[str, float]]:
+    """展开嵌套字典中的数值（布尔值转成 0/1），跳过字符串和 None"""
+    for key, value in values.items():
+        name = f"{prefix}_{''.join(ch if ch.isalnum() else '_' for ch in str(key))}"
+        if isinstance(value, dict):
+            yield from _flatten(name, value)
+        elif isinstance(value, bool):
+            yield name, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, value
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram("stage_seconds", "各处理阶段的耗时（秒）", ["stage"])
+HTTP_REQUESTS = REGISTRY.counter("http_requests_total", "接口请求数", ["path", "status"])
+HTTP_SECONDS = REGISTRY.histogram("http_request_seconds", "接口耗时（秒），流式接口为返回响应头的时间", ["path"])
+RETRIES = REGISTRY.counter("retries_total", "远程服务的重试次数", ["service"])
+BYTES = REGISTRY.counter("bytes_total", "传输和生成的字节数", ["kind"])
+JSON_REPAIRS = REGISTRY.counter("json_repairs_total", "格式有误、在本地修复的 LLM JSON 输出数", ["method"])
+ADMISSION_WAIT = REGISTRY.histogram("admission_wait_seconds", "请求在准入通道中排队的时间（秒）", ["lane"])
+ADMISSION_REJECTED = REGISTRY.counter("admission_rejected_total", "准入通道拒绝的请求数", ["lane", "reason"])
+RATE_LIMIT_WAIT = REGISTRY.histogram("rate_limit_wait_seconds", "调用服务商前等待令牌的时间（秒）", ["provider"])
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """记录一个阶段的耗时，同步和异步代码中都用 with span("stage"): 包住该阶段"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+def start_request() -> Tuple[List[Tuple[str, float]], contextvars.Token]:
+    """开始记录当前请求的阶段计时，返回计时列表和用于 end_request 的 token"""
+    timings: List[Tuple[str, float]] = []
+    return timings, _request_timings.set(timings)
+
+
+def end_request(token: contextvars.Token) -> None:
+    _request_timings.reset(token)
+
+
+def server_timing(timings: List[Tuple[str, float]]) -> str:
+    """
+    把阶段计时格式化成 Server-Timing 响应头，同名阶段（如每句 TTS）合并为总耗时和次数
+
+    流式接口在返回响应头时只包含已经完成的阶段
+    """
+    totals: Dict[str, List[float]] = {}
+    for stage, elapsed in list(timings):
+        total = totals.setdefault(stage, [0.0, 0])
+        total[0] += elapsed
+        total[1] += 1
+    return ", ".join(
+        f'{stage};dur={total * 1000:.1f}' + (f';desc="x{count}"' if count > 1 else "")
+        for stage, (total, count) in totals.items()
+    )
+
+
+class MetricsMiddleware:
+    """
+    ASGI 中间件：统计各接口的请求数和耗时，并为请求开启阶段计时
+
+    timing_header 为 True 时在响应头中加上 Server-Timing，列出该请求各阶段的耗时。
+    接口按路由模板（如 /api/audio/{audio_id}）统计，避免随机 ID 产生大量标签
+    """
+
+    def __init__(self, app, timing_header: bool = False):
+        self.app = app
+        self.timing_header = timing_header
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        timings, token = start_request()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                path = _route_path(scope)
+                HTTP_REQUESTS.inc(path=path, status=status)
+                HTTP_SECONDS.observe(time.perf_counter() - start, path=path)
+                if self.timing_header and timings:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", server_timing(timings).encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            end_request(token)
+
+
+def _route_path(scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
@@ -0,0 +1,182 @@
+# mock_providers.py
+#
+# 压测用的本地模拟服务
+#
+# 在一个进程里模拟三个远程服务，接口格式与真实服务一致，后端不需要改代码，
+# 只要通过环境变量把地址指向这里（见 benchmark.py）：
+# 1. LLM：OpenAI 兼容的 /v1/chat/completions，支持流式输出。带系统消息的请求（聊天）返回
+#    {"expression", "reply", "user_info"} 格式的 JSON，其余请求（文档总结、对话摘要）返回纯文本
+# 2. 向量：OpenAI 兼容的 /v1/embeddings，由文本哈希生成固定的归一化向量
+# 3. TTS：Fish Audio 的 /v1/tts，按文本长度返回对应大小的假音频
+# 每个服务的延迟为 基础延迟 + 随机抖动，另外可以按比例注入长尾延迟，用来检验对冲和超时。
+# 回复中的句子带有随机编号，避免压测时所有请求都命中语音缓存。
+#
+# 单独运行：python mock_providers.py --port 9100 --llm-latency 0.3
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+
+import numpy as np
+import ormsgpack
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
+
+EXPRESSIONS = ["爱心", "开心", "害羞", "思考"]
+SENTENCES = [
+    "我在这里陪着你呢",
+    "今天过得怎么样",
+    "听起来真不容易",
+    "要记得好好休息哦",
+    "有什么想和我聊的都可以说",
+    "我会一直记得你说的话",
+]
+
+
+class Latency:
+    def __init__(self, base: float, jitter: float, tail_rate: float = 0.0, tail: float = 0.0):
+        """
+        Args:
+            base (float): 基础延迟（秒）
+            jitter (float): 在基础延迟上增加 0~jitter 秒的均匀随机抖动
+            tail_rate (float): 注入长尾延迟的请求比例
+            tail (float): 长尾请求额外增加的延迟（秒）
+        """
+        self.base = base
+        self.jitter = jitter
+        self.tail_rate = tail_rate
+        self.tail = tail
+
+    def sample(self) -> float:
+        delay = self.base + random.uniform(0, self.jitter)
+        if self.tail_rate and random.random() < self.tail_rate:
+            delay += self.tail
+        return delay
+
+    async def wait(self) -> None:
+        await asyncio.sleep(self.sample())
+
+
+def _chat_reply(sentences: int) -> str:
+    reply = "".join(f"{random.choice(SENTENCES)}（{random.randint(0, 99999)}）。" for _ in range(sentences))
+    return json.dumps({
+        "expression": random.choice(EXPRESSIONS),
+        "reply": reply,
+        "user_info": "喜欢聊天"
+    }, ensure_ascii=False)
+
+
+def _plain_reply(sentences: int) -> str:
+    return "".join(f"这段内容的第{i + 1}个要点（{random.randint(0, 99999)}）。" for i in range(sentences))
+
+
+def _embedding(text: str, dimension: int) -> list:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def create_app(
+    llm: Latency,
+    embedding: Latency,
+    tts: Latency,
+    reply_sentences: int = 3,
+    stream_chunk_delay: float = 0.02,
+    dimension: int = 1024,
+    audio_bytes_per_char: int = 2000
+) -> FastAPI:
+    """
+    Args:
+        llm (Latency): LLM 的延迟，流式请求为首个片段的延迟
+        embedding (Latency): 向量接口的延迟
+        tts (Latency): 每次合成的延迟
+        reply_sentences (int): 每条回复的句子数
+        stream_chunk_delay (float): 流式输出相邻片段之间的间隔（秒）
+        dimension (int): 向量维度
+        audio_bytes_per_char (int): 每个字符对应的假音频字节数
+    """
+    app = FastAPI()
+    counters = {"llm": 0, "embedding": 0, "embedding_texts": 0, "tts": 0}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        counters["llm"] += 1
+        messages = body.get("messages", [])
+        is_chat = any(m.get("role") == "system" for m in messages)
+        text = _chat_reply(reply_sentences) if is_chat else _plain_reply(reply_sentences)
+        prompt_tokens = sum(len(m.get("content", "")) for m in messages)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(text)}
+        await llm.wait()
+
+        if not body.get("stream"):
+            return {"choices": [{"message": {"role": "assistant", "content": text}}], "usage": usage}
+
+        async def events():
+            for i in range(0, len(text), 8):
+                if i:
+                    await asyncio.sleep(stream_chunk_delay)
+                chunk = {"choices": [{"delta": {"content": text[i:i + 8]}}]}
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            yield f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        counters["embedding"] += 1
+        counters["embedding_texts"] += len(texts)
+        await embedding.wait()
+        return {"data": [{"index": i, "embedding": _embedding(t, dimension)} for i, t in enumerate(texts)]}
+
+    @app.post("/v1/tts")
+    async def synthesize(request: Request):
+        text = ormsgpack.unpackb(await request.body()).get("text", "")
+        counters["tts"] += 1
+        await tts.wait()
+        return Response(b"\xff\xfb" + bytes(audio_bytes_per_char * max(len(text), 1)), media_type="audio/mpeg")
+
+    @app.get("/stats")
+    async def stats():
+        return counters
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="压测用的本地 LLM、向量和 TTS 模拟服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="LLM 基础延迟（秒）")
+    parser.add_argument("--llm-jitter", type=float, default=0.1, help="LLM 延迟抖动（秒）")
+    parser.add_argument("--llm-tail-rate", type=float, default=0.0, help="LLM 长尾请求比例")
+    parser.add_argument("--llm-tail", type=float, default=2.0, help="LLM 长尾请求额外延迟（秒）")
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--embedding-jitter", type=float, default=0.02)
+    parser.add_argument("--tts-latency", type=float, default=0.2, help="单句合成的基础延迟（秒）")
+    parser.add_argument("--tts-jitter", type=float, default=0.1)
+    parser.add_argument("--tts-tail-rate", type=float, default=0.0)
+    parser.add_argument("--tts-tail", type=float, default=2.0)
+    parser.add_argument("--reply-sentences", type=int, default=3, help="每条回复的句子数")
+    parser.add_argument("--stream-chunk-delay", type=float, default=0.02)
+    parser.add_argument("--dimension", type=int, default=1024)
+    args = parser.parse_args()
+
+    import uvicorn
+    app = create_app(
+        Latency(args.llm_latency, args.llm_jitter, args.llm_tail_rate, args.llm_tail),
+        Latency(args.embedding_latency, args.embedding_jitter),
+        Latency(args.tts_latency, args.tts_jitter, args.tts_tail_rate, args.tts_tail),
+        reply_sentences=args.reply_sentences,
+        stream_chunk_delay=args.stream_chunk_delay,
+        dimension=args.dimension
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
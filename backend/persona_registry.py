@@ -0,0 +1,173 @@
+# persona_registry.py
+#
+# 人设注册表
+#
+# 原来每个 MainAgent 构造时都从相对路径读取一次 prompts/reply.txt，
+# 其他人设文件只能改代码才能使用，每个会话还各自保存一份提示词。PersonaRegistry 负责：
+# 1. prompts/ 下的每个 .txt 文件是一个人设，名称为文件名（不含扩展名），按会话或按请求选择
+# 2. 第一次使用时才读取并校验，预先生成固定的系统提示词和它的哈希，所有会话共享同一个 Persona 对象
+# 3. 热更新：每隔 check_interval 秒检查一次文件的修改时间和大小，变化时重新加载，不需要重启；
+#    新内容校验失败时继续使用旧版本
+# 读文件只发生在第一次使用和文件变化时，请求路径上只有偶尔的一次 stat。
+# 会话加载时在线程中调用 get，检查文件和替换人设在锁内进行，同一个文件变化只会被加载一次。
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 系统提示词中原本填入变量的位置改为指向消息的说明，
+# 这样系统提示词在整个会话中保持不变，可以命中服务商的前缀缓存
+SYSTEM_PLACEHOLDERS = {
+    "user_info": "（见最后一条用户消息中的「用户的个人信息」）",
+    "chat_history": "（见之前的多轮对话消息）",
+    "user_message": "（见最后一条用户消息中的「用户的最新问题」）",
+    "memory": "（见最后一条用户消息中的「相关记忆」）"
+}
+
+PERSONA_NAME_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+class PersonaError(Exception):
+    """人设不存在，或提示词文件无法使用"""
+
+
+class Persona:
+    __slots__ = ("name", "path", "system_prompt", "digest", "signature")
+
+    def __init__(self, name: str, path: str, system_prompt: str, signature: Tuple[float, int]):
+        self.name = name
+        self.path = path
+        self.system_prompt = system_prompt  # 人设和规则组成的固定系统前缀
+        # 系统前缀的哈希，回复缓存按它区分人设，修改提示词后旧回复不再命中
+        self.digest = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:16]
+        self.signature = signature  # 加载时文件的 (修改时间, 大小)
+
+
+def compile_template(template: str) -> str:
+    """
+    校验提示词模板并生成系统提示词
+
+    Raises:
+        PersonaError: 模板为空，或含有 SYSTEM_PLACEHOLDERS 以外的占位符、括号不成对
+    """
+    if not template.strip():
+        raise PersonaError("提示词为空")
+    try:
+        return template.format(**SYSTEM_PLACEHOLDERS)
+    except KeyError as e:
+        raise PersonaError(f"未知的占位符 {e}") from None
+    except (ValueError, IndexError) as e:
+        raise PersonaError(f"提示词格式错误: {e}") from None
+
+
+class PersonaRegistry:
+    def __init__(self, prompt_dir: str = "prompts", default: str = "reply", check_interval: float = 2.0):
+        """
+        Args:
+            prompt_dir (str): 人设提示词所在目录
+            default (str): 没有指定人设时使用的人设
+            check_interval (float): 检查提示词文件是否变化的最短间隔（秒），0 表示每次使用都检查
+        """
+        self.prompt_dir = prompt_dir
+        self.default = default
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._personas: Dict[str, Persona] = {}
+        self._checked: Dict[str, float] = {}  # 人设 -> 上次检查文件的时间
+        self._failed: Dict[str, Tuple[float, int]] = {}  # 人设 -> 重新加载失败的文件版本，文件再次修改前不再尝试
+
+        self.loads = 0
+        self.reloads = 0
+        self.errors = 0
+
+    def _path(self, name: str) -> str:
+        if not PERSONA_NAME_PATTERN.fullmatch(name):
+            raise PersonaError(f"人设名称不合法: {name}")
+        return os.path.join(self.prompt_dir, f"{name}.txt")
+
+    def names(self) -> List[str]:
+        """可用的人设名称"""
+        try:
+            files = os.listdir(self.prompt_dir)
+        except OSError:
+            return []
+        return sorted(
+            name for name, ext in map(os.path.splitext, files)
+            if ext == ".txt" and PERSONA_NAME_PATTERN.fullmatch(name)
+        )
+
+    def exists(self, name: str) -> bool:
+        if name in self._personas:
+            return True
+        return PERSONA_NAME_PATTERN.fullmatch(name) is not None and os.path.isfile(self._path(name))
+
+    def get(self, name: Optional[str] = None) -> Persona:
+        """
+        获取人设，第一次使用时加载，文件变化时重新加载
+
+        Raises:
+            PersonaError: 人设不存在，或第一次加载时校验失败
+        """
+        name = name or self.default
+        persona = self._personas.get(name)
+        if persona is not None and time.monotonic() - self._checked.get(name, 0.0) < self.check_interval:
+            return persona
+        with self._lock:
+            return self._check(name)
+
+    def _check(self, name: str) -> Persona:
+        """检查提示词文件，需要时重新加载，调用方需持有 _lock"""
+        persona = self._personas.get(name)
+        now = time.monotonic()
+        if persona is not None and now - self._checked.get(name, 0.0) < self.check_interval:
+            # 等锁期间其他线程已经检查过
+            return persona
+        self._checked[name] = now
+
+        path = self._path(name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            if persona is not None:
+                # 文件被删除时继续使用已加载的版本
+                return persona
+            raise PersonaError(f"人设不存在: {name}") from None
+        signature = (stat.st_mtime, stat.st_size)
+        if persona is not None and signature in (persona.signature, self._failed.get(name)):
+            return persona
+
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                template = f.read()
+            loaded = Persona(name, path, compile_template(template), signature)
+        except (OSError, UnicodeDecodeError, PersonaError) as e:
+            self.errors += 1
+            if persona is None:
+                raise PersonaError(f"人设 {name} 无法加载: {e}") from None
+            self._failed[name] = signature
+            logger.error("人设 %s 重新加载失败，继续使用旧版本: %s", name, e)
+            return persona
+
+        if persona is None:
+            self.loads += 1
+        else:
+            self.reloads += 1
+            logger.info("人设 %s 已重新加载", name)
+        self._failed.pop(name, None)
+        self._personas[name] = loaded
+        return loaded
+
+    def get_stats(self) -> dict:
+        return {
+            "default": self.default,
+            "loaded": sorted(self._personas),
+            "loads": self.loads,
+            "reloads": self.reloads,
+            "errors": self.errors
+        }
@@ -0,0 +1,210 @@
+# resilience.py
+#
+# 远程服务的延迟控制
+#
+# LLM 和 TTS 服务偶尔会出现很慢的响应，原来的固定间隔重试加上很长的超时，
+# 一次慢响应就可能让请求挂起几分钟。这里提供四种手段，让尾部延迟有上限：
+# 1. LatencyTracker：记录最近若干次成功请求的耗时，给出 p95 等分位数
+# 2. hedge：先发出一次请求，超过 p95 还没返回时再发出一次相同的请求，取先成功的结果，
+#    其余的取消；每次尝试都有自己的超时
+# 3. 重试按指数退避等待 (backoff_delay)，等待时间有上限，并且不超过调用方的总时限
+# 4. CircuitBreaker：连续失败达到阈值后熔断，熔断期间直接失败（或切换到备用服务），
+#    冷却时间过后放行一次探测请求，成功即恢复；超时的尝试同样计为失败，
+#    探测请求被取消、没有结果时放行下一个探测请求，熔断器不会一直卡在探测状态
+# TTS 在线程池中调用，这里的类都可以跨线程使用。
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(Exception):
+    """服务处于熔断状态，请求没有发出"""
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 4.0) -> float:
+    """第 attempt 次失败后的重试等待时间（秒）：指数增长、有上限，并加随机抖动避免同时重试"""
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+class LatencyTracker:
+    def __init__(self, window: int = 100, min_samples: int = 20, percentile: float = 0.95, min_delay: float = 0.2):
+        """
+        Args:
+            window (int): 保留最近多少次请求的耗时
+            min_samples (int): 样本数达到后才给出对冲延迟，样本太少时分位数不可靠
+            percentile (float): 对冲延迟使用的分位数
+            min_delay (float): 对冲延迟的下限（秒），避免很快的服务被重复请求
+        """
+        self.min_samples = min_samples
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self._samples: "deque[float]" = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def hedge_delay(self) -> Optional[float]:
+        """发出对冲请求前的等待时间，样本不足时返回 None（不对冲）"""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+        return max(self.quantile(self.percentile), self.min_delay)
+
+    def get_stats(self) -> dict:
+        p50, p95 = self.quantile(0.5), self.quantile(0.95)
+        return {
+            "samples": len(self._samples),
+            "p50": round(p50, 3) if p50 is not None else None,
+            "p95": round(p95, 3) if p95 is not None else None
+        }
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        Args:
+            failure_threshold (int): 连续失败多少次后熔断
+            reset_timeout (float): 熔断多久（秒）后放行一次探测请求
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        """closed：正常；open：熔断中；half_open：冷却结束，等待探测结果"""
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return "open"
+            return "half_open"
+
+    def check(self) -> bool:
+        """
+        请求前调用，熔断中时抛出 CircuitOpenError；冷却结束后只放行一个探测请求
+
+        Returns:
+            bool: 本次请求是否为探测请求，探测请求被取消时需要调用 release_probe
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if time.monotonic() - self._opened_at >= self.reset_timeout and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+        raise CircuitOpenError("服务熔断中")
+
+    def release_probe(self) -> None:
+        """探测请求被取消（客户端断开等），没有得到结果，放行下一个探测请求"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or (self._opened_at is None and self._failures >= self.failure_threshold):
+                # 探测失败时重新开始冷却
+                if self._opened_at is None:
+                    self.trips += 1
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    def get_stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "trips": self.trips,
+            "rejected": self.rejected
+        }
+
+
+class HedgeStats:
+    """对冲请求的计数"""
+
+    def __init__(self):
+        self.hedged = 0  # 发出的对冲请求数
+        self.hedge_wins = 0  # 对冲请求先于原请求成功的次数
+
+    def get_stats(self) -> dict:
+        return {"hedged": self.hedged, "hedge_wins": self.hedge_wins}
+
+
+async def hedge(
+    call: Callable[[], Awaitable[T]],
+    delay: Optional[float],
+    timeout: float,
+    stats: Optional[HedgeStats] = None
+) -> T:
+    """
+    对冲执行一次请求
+
+    Args:
+        call: 发出一次请求的函数，每次调用都发出一个新请求
+        delay (float): 原请求等待多久（秒）还没返回时发出对冲请求，为 None 时不对冲
+        timeout (float): 本次尝试的总超时（秒），超时后取消所有请求
+        stats (HedgeStats): 对冲计数
+
+    Returns:
+        最先成功的请求的结果
+
+    Raises:
+        asyncio.TimeoutError: 超时仍没有请求成功
+        Exception: 所有请求都失败时，抛出最后一个请求的异常
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    tasks = [asyncio.ensure_future(call())]
+    hedge_task = None
+    error: Optional[BaseException] = None
+    try:
+        while tasks:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            wait = remaining if delay is None or hedge_task is not None else min(delay, remaining)
+            done, _ = await asyncio.wait(tasks, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                tasks.remove(task)
+                if task.exception() is None:
+                    if stats and task is hedge_task:
+                        stats.hedge_wins += 1
+                    return task.result()
+                error = task.exception()
+            # 原请求已经失败时交给调用方重试；仍在进行且超过对冲延迟时再发出一次
+            if not done and hedge_task is None and delay is not None and loop.time() < deadline:
+                hedge_task = asyncio.ensure_future(call())
+                tasks.append(hedge_task)
+                if stats:
+                    stats.hedged += 1
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
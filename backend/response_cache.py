@@ -0,0 +1,230 @@
+# response_cache.py
+#
+# 聊天回复缓存
+#
+# 用户经常发送几乎一样的短消息（"888"、"你好"、"早上好"），每条都要完整地调用一次 LLM。
+# ResponseCache 在 LLM 之前缓存 (回复, 表情)：
+# 1. 精确匹配：键由作用域（会话 + 人设）和规范化后的消息组成，
+#    规范化会统一全角半角、大小写，去掉空白、标点和符号，"你好！" 和 "你好" 命中同一条
+# 2. 近似匹配：精确匹配失败时，用消息向量在同一作用域的缓存条目中找余弦相似度最高的一条，
+#    超过阈值即命中；向量由 EmbeddingService 计算（重复文本命中向量缓存）。
+#    get 只做本地的精确匹配；get_similar 需要计算向量，调用方和记忆检索并行执行，
+#    消息向量与检索用的查询向量合并在同一次向量请求中，未命中时不增加回复延迟
+# 3. 条目有过期时间 (TTL)，总条数和每个作用域的条数都有上限，超出时淘汰最久未使用的条目
+# 只缓存较短的消息：长消息几乎不会重复，缓存它们只会占用内存。
+import asyncio
+import logging
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from embedding import EmbeddingService
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_message(text: str) -> str:
+    """规范化消息：NFKC、转小写，去掉空白、标点和符号"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(ch for ch in text if unicodedata.category(ch)[0] not in "PZSC")
+
+
+class CachedReply:
+    __slots__ = ("scope", "reply", "expression", "expires", "vector")
+
+    def __init__(self, scope: str, reply: str, expression: str, expires: float, vector: Optional[np.ndarray]):
+        self.scope = scope
+        self.reply = reply
+        self.expression = expression
+        self.expires = expires
+        self.vector = vector
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        embedding_service: Optional[EmbeddingService] = None,
+        ttl: float = 600.0,
+        max_entries: int = 10000,
+        max_scope_entries: int = 64,
+        similarity: float = 0.95,
+        max_message_chars: int = 32
+    ):
+        """
+        Args:
+            embedding_service (EmbeddingService): 向量服务，为 None 时只做精确匹配
+            ttl (float): 缓存条目的有效期（秒）
+            max_entries (int): 缓存的最大总条数
+            max_scope_entries (int): 每个作用域（会话 + 人设）的最大条数
+            similarity (float): 近似匹配的最低余弦相似度
+            max_message_chars (int): 只缓存规范化后不超过该长度的消息
+        """
+        self.embedding_service = embedding_service
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_scope_entries = max_scope_entries
+        self.similarity = similarity
+        self.max_message_chars = max_message_chars
+
+        # (作用域, 规范化消息) -> 条目，按最近使用时间从旧到新排列
+        self._entries: "OrderedDict[Tuple[str, str], CachedReply]" = OrderedDict()
+        # 作用域 -> 该作用域下的键，近似匹配只在同一作用域内查找
+        self._scopes: Dict[str, "OrderedDict[Tuple[str, str], None]"] = {}
+        # 计算消息向量的后台任务
+        self._pending: Set[asyncio.Task] = set()
+
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def _cacheable(self, normalized: str) -> bool:
+        return 0 < len(normalized) <= self.max_message_chars
+
+    def _remove(self, key: Tuple[str, str]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self._scopes.get(entry.scope)
+        if keys is not None:
+            keys.pop(key, None)
+            if not keys:
+                del self._scopes[entry.scope]
+
+    def _touch(self, key: Tuple[str, str]) -> None:
+        self._entries.move_to_end(key)
+        self._scopes[key[0]].move_to_end(key)
+
+    async def _embed(self, text: str) -> Optional[np.ndarray]:
+        """计算归一化的消息向量；走单条合并接口，与同时发出的记忆检索查询合并成一次请求"""
+        if not self.embedding_service:
+            return None
+        try:
+            embedding = await self.embedding_service.embed(text)
+        except Exception as e:
+            logger.warning("回复缓存计算向量出错: %s", e)
+            return None
+        if not embedding:
+            return None
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _semantic_match(self, scope: str, vector: np.ndarray, now: float) -> Optional[Tuple[str, str]]:
+        keys = self._scopes.get(scope)
+        if not keys:
+            return None
+        candidates: List[Tuple[Tuple[str, str], np.ndarray]] = []
+        for key in list(keys):
+            entry = self._entries[key]
+            if entry.expires <= now:
+                self._remove(key)
+            elif entry.vector is not None and entry.vector.shape == vector.shape:
+                candidates.append((key, entry.vector))
+        if not candidates:
+            return None
+        scores = np.stack([v for _, v in candidates]) @ vector
+        best = int(np.argmax(scores))
+        return candidates[best][0] if scores[best] >= self.similarity else None
+
+    def get(self, scope: str, message: str) -> Optional[Tuple[str, str]]:
+        """
+        精确匹配查询，不访问网络
+
+        Args:
+            scope (str): 作用域，由会话和人设组成，不同作用域互不命中
+            message (str): 用户消息
+
+        Returns:
+            Optional[Tuple[str, str]]: 命中时返回 (回复, 表情)，否则返回 None；
+            未命中且可以近似匹配（见 can_match_similar）时由 get_similar 计入统计
+        """
+        normalized = normalize_message(message)
+        if not self._cacheable(normalized):
+            return None
+
+        key = (scope, normalized)
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires <= time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is not None:
+            self._touch(key)
+            self.exact_hits += 1
+            return entry.reply, entry.expression
+
+        if not self.can_match_similar(scope, message):
+            self.misses += 1
+        return None
+
+    def can_match_similar(self, scope: str, message: str) -> bool:
+        """消息是否可能近似命中：启用了向量服务、消息足够短且作用域中已有条目"""
+        return (
+            self.embedding_service is not None
+            and scope in self._scopes
+            and self._cacheable(normalize_message(message))
+        )
+
+    async def get_similar(self, scope: str, message: str) -> Optional[Tuple[str, str]]:
+        """
+        近似匹配查询，在 get 未命中之后调用；需要计算消息向量，应与记忆检索并行执行
+
+        Returns:
+            Optional[Tuple[str, str]]: 命中时返回 (回复, 表情)，否则返回 None
+        """
+        if self.can_match_similar(scope, message):
+            vector = await self._embed(normalize_message(message))
+            if vector is not None:
+                matched = self._semantic_match(scope, vector, time.monotonic())
+                if matched is not None:
+                    self._touch(matched)
+                    self.semantic_hits += 1
+                    entry = self._entries[matched]
+                    return entry.reply, entry.expression
+
+        self.misses += 1
+        return None
+
+    def put(self, scope: str, message: str, reply: str, expression: str) -> None:
+        """
+        写入一条 LLM 回复，消息太长或回复为空时不缓存
+
+        条目立即可以精确命中；消息向量在后台任务中计算，完成后才参与近似匹配，不增加回复延迟
+        """
+        normalized = normalize_message(message)
+        if not reply or not self._cacheable(normalized):
+            return
+
+        key = (scope, normalized)
+        self._remove(key)
+        entry = CachedReply(scope, reply, expression, time.monotonic() + self.ttl, None)
+        self._entries[key] = entry
+        keys = self._scopes.setdefault(scope, OrderedDict())
+        keys[key] = None
+
+        while len(keys) > self.max_scope_entries:
+            self._remove(next(iter(keys)))
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+        if self.embedding_service:
+            task = asyncio.create_task(self._fill_vector(entry, normalized))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+
+    async def _fill_vector(self, entry: CachedReply, normalized: str) -> None:
+        entry.vector = await self._embed(normalized)
+
+    def get_stats(self) -> dict:
+        hits = self.exact_hits + self.semantic_hits
+        total = hits + self.misses
+        return {
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            "entries": len(self._entries),
+            "scopes": len(self._scopes)
+        }
@@ -0,0 +1,320 @@
+# session_manager.py
+#
+# 会话管理
+#
+# 每个 session_id 拥有独立的对话历史、记忆索引、用户信息和日志，互不干扰。
+# SessionManager 负责：
+# 1. 按需创建或从磁盘懒加载会话（对话历史和上传文档的检索索引）
+# 2. 每个会话一把 asyncio.Lock：同一会话的请求串行执行，不同会话并行
+# 3. 空闲超时 (idle TTL) 和活跃会话数上限 (LRU) 两种淘汰方式，
+#    淘汰时把会话状态写入 save/sessions/<会话>/history.json，下次访问时再加载
+# 4. 归档对话的文本存放在 save/sessions/<会话>/archive.db，内存中只常驻最近用到的一部分
+# 5. 会话选择的人设随 history.json 一起保存，人设提示词由所有会话共享的 PersonaRegistry 提供
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from background_writer import BackgroundWriter
+from conversation import ConversationHistory
+from document_index import DocumentIndex
+from embedding import EmbeddingService
+from llm import LLMService
+from main_agent import MainAgent
+from persona_registry import PersonaError, PersonaRegistry
+from response_cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    def __init__(
+        self,
+        session_id: str,
+        session_dir: str,
+        history: ConversationHistory,
+        document_index: DocumentIndex,
+        agent: MainAgent
+    ):
+        self.session_id = session_id
+        self.session_dir = session_dir
+        self.conversation_history = history
+        self.document_index = document_index
+        self.main_agent = agent
+        self.lock = asyncio.Lock()
+        self.last_access = time.monotonic()
+
+    @property
+    def history_file(self) -> str:
+        return os.path.join(self.session_dir, "history.json")
+
+    @property
+    def documents_file(self) -> str:
+        return os.path.join(self.session_dir, "documents.json")
+
+
+class SessionManager:
+    def __init__(
+        self,
+        llm_service: LLMService,
+        embedding_service: Optional[EmbeddingService] = None,
+        save_dir: str = "save/sessions",
+        max_turns: int = 20,
+        min_similarity: float = 0.0,
+        context_tokens: int = 2000,
+        summary_tokens: int = 300,
+        max_resident: int = 200,
+        max_indexed: int = 1000,
+        max_stored: int = 2000,
+        max_sessions: int = 100,
+        idle_ttl: float = 1800.0,
+        sweep_interval: float = 60.0,
+        doc_chunk_tokens: int = 300,
+        max_documents: int = 5,
+        doc_min_similarity: float = 0.0,
+        writer: Optional[BackgroundWriter] = None,
+        response_cache: Optional[ResponseCache] = None,
+        personas: Optional[PersonaRegistry] = None
+    ):
+        """
+        Args:
+            llm_service (LLMService): 所有会话共享的 LLM 服务
+            embedding_service (EmbeddingService): 所有会话共享的向量服务
+            save_dir (str): 会话持久化目录
+            max_turns (int): 每个会话的最大对话轮数
+            min_similarity (float): 记忆检索的最低相似度
+            context_tokens (int): 每个会话原样发送的历史对话的 token 预算
+            summary_tokens (int): 每个会话滚动摘要的 token 上限
+            max_resident (int): 每个会话内存中最多常驻的归档对话数，其余的在 SQLite 中
+            max_indexed (int): 每个会话记忆索引最多保留的归档对话数
+            max_stored (int): 每个会话 archive.db 中最多保留的归档对话数
+            max_sessions (int): 内存中最多保留的活跃会话数，超出时淘汰最久未访问的会话
+            idle_ttl (float): 会话空闲多久（秒）后被淘汰
+            sweep_interval (float): 后台检查空闲会话的间隔（秒）
+            doc_chunk_tokens (int): 上传文档检索片段的最大 token 数
+            max_documents (int): 每个会话最多保留的上传文档数
+            doc_min_similarity (float): 文档向量检索的最低相似度
+            writer (BackgroundWriter): 所有会话共享的后台写入器，负责日志和用户信息
+            response_cache (ResponseCache): 所有会话共享的回复缓存，按会话隔离，为 None 时不缓存
+            personas (PersonaRegistry): 所有会话共享的人设注册表
+        """
+        self.llm_service = llm_service
+        self.embedding_service = embedding_service
+        self.save_dir = save_dir
+        self.max_turns = max_turns
+        self.min_similarity = min_similarity
+        self.context_tokens = context_tokens
+        self.summary_tokens = summary_tokens
+        self.max_resident = max_resident
+        self.max_indexed = max_indexed
+        self.max_stored = max_stored
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self.doc_chunk_tokens = doc_chunk_tokens
+        self.max_documents = max_documents
+        self.doc_min_similarity = doc_min_similarity
+        self.writer = writer
+        self.response_cache = response_cache
+        self.personas = personas or PersonaRegistry()
+
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._load_lock = asyncio.Lock()
+        self._sweeper: Optional[asyncio.Task] = None
+
+        self.loads = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _dir_name(session_id: str) -> str:
+        """把会话ID转换成安全的目录名"""
+        if re.fullmatch(r"[A-Za-z0-9_-]{1,64}", session_id):
+            return session_id
+        return hashlib.sha256(session_id.encode("utf-8")).hexdigest()[:32]
+
+    async def get(self, session_id: str) -> Session:
+        """获取会话，不在内存中时从磁盘加载或新建"""
+        session = self._sessions.get(session_id)
+        if session is None:
+            async with self._load_lock:
+                session = self._sessions.get(session_id)
+                if session is None:
+                    session = await self._load(session_id)
+                    self._sessions[session_id] = session
+                    await self._evict_overflow(keep=session_id)
+
+        session.last_access = time.monotonic()
+        self._sessions.move_to_end(session_id)
+        return session
+
+    async def _load(self, session_id: str) -> Session:
+        session_dir = os.path.join(self.save_dir, self._dir_name(session_id))
+        history = ConversationHistory(
+            max_turns=self.max_turns,
+            embedding_service=self.embedding_service,
+            min_similarity=self.min_similarity,
+            llm_service=self.llm_service,
+            context_tokens=self.context_tokens,
+            summary_tokens=self.summary_tokens,
+            archive_path=os.path.join(session_dir, "archive.db"),
+            max_resident=self.max_resident,
+            max_indexed=self.max_indexed,
+            max_stored=self.max_stored
+        )
+        document_index = DocumentIndex(
+            embedding_service=self.embedding_service,
+            chunk_tokens=self.doc_chunk_tokens,
+            max_documents=self.max_documents,
+            min_similarity=self.doc_min_similarity
+        )
+        data = await asyncio.to_thread(self._read_state, os.path.join(session_dir, "history.json"))
+        persona = data.get("persona") if data else None
+        if persona:
+            try:
+                self.personas.get(persona)
+            except PersonaError as e:
+                logger.warning("会话 %s 保存的人设不可用，改用默认人设: %s", session_id, e)
+                persona = None
+        agent = await asyncio.to_thread(
+            MainAgent,
+            self.llm_service,
+            history,
+            user_info_file=os.path.join(session_dir, "me.txt"),
+            log_dir=os.path.join(session_dir, "log"),
+            document_index=document_index,
+            writer=self.writer,
+            response_cache=self.response_cache,
+            cache_scope=session_id,
+            personas=self.personas,
+            persona=persona
+        )
+        session = Session(session_id, session_dir, history, document_index, agent)
+
+        if data:
+            await history.load_dict(data)
+            self.loads += 1
+        documents = await asyncio.to_thread(self._read_state, session.documents_file)
+        if documents:
+            await document_index.load_dict(documents)
+        return session
+
+    @staticmethod
+    def _read_state(path: str) -> Optional[dict]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.error("读取会话状态出错: %s", e)
+            return None
+
+    @staticmethod
+    def _write_state(path: str, data: dict) -> None:
+        """先写临时文件再原子替换"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    async def _persist(self, session: Session) -> None:
+        # 后台归档完成后再保存，摘要和记忆索引不会丢失最近一次归档
+        await session.conversation_history.wait_archived()
+        try:
+            # 归档对话先写入 SQLite，history.json 中只保存记录ID
+            await asyncio.to_thread(session.conversation_history.archive.flush)
+            state = {**session.conversation_history.to_dict(), "persona": session.main_agent.persona_name}
+            await asyncio.to_thread(self._write_state, session.history_file, state)
+            if session.document_index.documents:
+                await asyncio.to_thread(self._write_state, session.documents_file, session.document_index.to_dict())
+        except (OSError, sqlite3.Error) as e:
+            logger.error("保存会话状态出错: %s", e)
+
+    async def _evict(self, session_id: str) -> None:
+        """淘汰会话并写入磁盘，调用方需持有 _load_lock，保证写完之前不会被重新加载"""
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            return
+        await self._persist(session)
+        session.conversation_history.archive.close()
+        self.evictions += 1
+
+    async def _evict_overflow(self, keep: str) -> None:
+        """
+        活跃会话数超出上限时，淘汰最久未访问且没有请求在处理的会话；
+        会话都在处理请求时暂时允许超出上限，等下次加载或空闲清理时再淘汰
+        """
+        overflow = len(self._sessions) - self.max_sessions
+        if overflow <= 0:
+            return
+        candidates = [
+            sid for sid, s in self._sessions.items()
+            if sid != keep and not s.lock.locked()
+        ][:overflow]
+        for session_id in candidates:
+            await self._evict(session_id)
+
+    async def evict_idle(self) -> None:
+        """淘汰空闲超时的会话"""
+        async with self._load_lock:
+            now = time.monotonic()
+            idle = [
+                sid for sid, s in self._sessions.items()
+                if now - s.last_access > self.idle_ttl and not s.lock.locked()
+            ]
+            for session_id in idle:
+                await self._evict(session_id)
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.evict_idle()
+            except Exception as e:
+                logger.error("清理空闲会话出错: %s", e)
+
+    async def startup(self) -> None:
+        """启动后台空闲会话清理任务"""
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def shutdown(self) -> None:
+        """停止清理任务，并把所有活跃会话写入磁盘"""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        async with self._load_lock:
+            for session_id in list(self._sessions):
+                await self._evict(session_id)
+
+    def get_stats(self) -> dict:
+        return {
+            "active_sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "memory": self._memory_stats()
+        }
+
+    def _memory_stats(self) -> dict:
+        """活跃会话的记忆占用合计：常驻的归档对话文本和记忆索引的向量"""
+        archive_bytes = index_bytes = resident = stored = 0
+        for session in self._sessions.values():
+            stats = session.conversation_history.get_stats()
+            archive_bytes += stats["resident_bytes"]
+            index_bytes += stats["index_bytes"]
+            resident += stats["resident"]
+            stored += stats["stored"]
+        return {
+            "resident_archived": resident,
+            "stored_archived": stored,
+            "archive_bytes": archive_bytes,
+            "index_bytes": index_bytes
+        }
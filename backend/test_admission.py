@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+from admission import (
+    PRIORITY_BACKGROUND, PRIORITY_BATCH, PRIORITY_INTERACTIVE, AdmissionLane, AdmissionRejected,
+    PrioritySemaphore, TokenBucket, _priority
+)
+
+
+async def acquire_as(limiter, priority: int, order: list, name: str) -> None:
+    token = _priority.set(priority)
+    try:
+        await limiter.acquire()
+    finally:
+        _priority.reset(token)
+    order.append(name)
+
+
+def test_priority_semaphore_serves_higher_priority_first():
+    async def main():
+        semaphore = PrioritySemaphore(1)
+        await semaphore.acquire()
+        order = []
+        tasks = [
+            asyncio.create_task(acquire_as(semaphore, PRIORITY_BACKGROUND, order, "background")),
+            asyncio.create_task(acquire_as(semaphore, PRIORITY_BATCH, order, "batch1")),
+            asyncio.create_task(acquire_as(semaphore, PRIORITY_BATCH, order, "batch2")),
+            asyncio.create_task(acquire_as(semaphore, PRIORITY_INTERACTIVE, order, "interactive")),
+        ]
+        await asyncio.sleep(0)
+        assert semaphore.waiting() == 4
+        for _ in tasks:
+            semaphore.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(main()) == ["interactive", "batch1", "batch2", "background"]
+
+
+def test_priority_semaphore_cancelled_waiter_does_not_leak():
+    async def main():
+        semaphore = PrioritySemaphore(1)
+        await semaphore.acquire()
+        waiter = asyncio.create_task(semaphore.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert semaphore.waiting() == 0
+        semaphore.release()
+        # 名额回到信号量，下一次获取不需要等待
+        await asyncio.wait_for(semaphore.acquire(), 0.1)
+
+    asyncio.run(main())
+
+
+def test_token_bucket_allows_burst_then_limits_rate():
+    async def main():
+        bucket = TokenBucket("test", rate=50.0, burst=2)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await bucket.acquire()
+        await bucket.acquire()
+        assert loop.time() - start < 0.01
+        await bucket.acquire()
+        await bucket.acquire()
+        # 突发额度用完后每个令牌约 1/50 秒
+        assert loop.time() - start >= 0.03
+        stats = bucket.get_stats()
+        assert stats["acquired"] == 4
+        assert stats["waited"] == 2
+
+    asyncio.run(main())
+
+
+def test_token_bucket_serves_higher_priority_first():
+    async def main():
+        bucket = TokenBucket("test", rate=100.0, burst=1)
+        await bucket.acquire()
+        order = []
+        tasks = [
+            asyncio.create_task(acquire_as(bucket, PRIORITY_BATCH, order, "batch")),
+            asyncio.create_task(acquire_as(bucket, PRIORITY_INTERACTIVE, order, "interactive")),
+        ]
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(main()) == ["interactive", "batch"]
+
+
+def test_admission_lane_queues_and_rejects():
+    async def main():
+        lane = AdmissionLane("chat", PRIORITY_INTERACTIVE, max_concurrency=1, max_queue=1, queue_timeout=1.0)
+        await lane.acquire()
+        queued = asyncio.create_task(lane.acquire())
+        await asyncio.sleep(0)
+        assert lane.get_stats()["waiting"] == 1
+
+        with pytest.raises(AdmissionRejected) as info:
+            await lane.acquire()
+        assert info.value.reason == "queue_full"
+        assert info.value.retry_after >= 1
+
+        # 释放时名额直接转交给排队的请求
+        lane.release(0.1)
+        await asyncio.wait_for(queued, 0.1)
+        assert lane.active == 1
+        lane.release(0.1)
+        assert lane.active == 0
+        stats = lane.get_stats()
+        assert (stats["admitted"], stats["queued"], stats["rejected"]) == (2, 1, 1)
+
+    asyncio.run(main())
+
+
+def test_admission_lane_queue_timeout():
+    async def main():
+        lane = AdmissionLane("upload", PRIORITY_BATCH, max_concurrency=1, max_queue=4, queue_timeout=0.01)
+        await lane.acquire()
+        with pytest.raises(AdmissionRejected) as info:
+            await lane.acquire()
+        assert info.value.reason == "timeout"
+        assert lane.get_stats()["waiting"] == 0
+        assert lane.timeouts == 1
+
+    asyncio.run(main())
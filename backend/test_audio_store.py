@@ -0,0 +1,46 @@
+from audio_store import AUDIO_URL_PREFIX, AudioStore, parse_range
+
+
+def test_parse_range_single_interval():
+    assert parse_range("bytes=0-9", 100) == (0, 9)
+    assert parse_range("bytes=10-", 100) == (10, 99)
+    assert parse_range("bytes=-10", 100) == (90, 99)
+
+
+def test_parse_range_clamps_end_to_size():
+    assert parse_range("bytes=90-200", 100) == (90, 99)
+    assert parse_range("bytes=-200", 100) == (0, 99)
+
+
+def test_parse_range_without_header_or_unsupported():
+    assert parse_range(None, 100) is None
+    assert parse_range("", 100) is None
+    assert parse_range("items=0-9", 100) is None
+    assert parse_range("bytes=0-9,20-29", 100) is None
+
+
+def test_parse_range_ignores_malformed():
+    assert parse_range("bytes=5-3", 100) is None
+    assert parse_range("bytes=-", 100) is None
+    assert parse_range("bytes=a-b", 100) is None
+    assert parse_range("bytes=5", 100) is None
+
+
+def test_parse_range_ignores_unsatisfiable():
+    assert parse_range("bytes=100-", 100) is None
+    assert parse_range("bytes=200-300", 100) is None
+    assert parse_range("bytes=-0", 100) is None
+    assert parse_range("bytes=-5", 0) is None
+
+
+def test_audio_store_put_get_and_evict():
+    store = AudioStore(max_bytes=10)
+    first = store.put(b"123456")
+    assert first.startswith(AUDIO_URL_PREFIX)
+    assert store.get(first[len(AUDIO_URL_PREFIX):]) == b"123456"
+
+    # 超出总字节数时淘汰最早存入的语音
+    second = store.put(b"abcdef")
+    assert store.get(first[len(AUDIO_URL_PREFIX):]) is None
+    assert store.get(second[len(AUDIO_URL_PREFIX):]) == b"abcdef"
+    assert store.put(b"") == ""
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from document import ChunkBuffer, DocumentSummaryError, chunk_texts, summarize_document
+from text_utils import estimate_tokens
+
+
+def test_chunk_buffer_merges_pieces_within_budget():
+    buffer = ChunkBuffer(max_tokens=10)
+    assert buffer.feed("一二三四") == []
+    assert buffer.feed("五六七八") == []
+    # 第三段放不下，前两段作为一块输出
+    assert buffer.feed("九十一二") == ["一二三四五六七八"]
+    assert buffer.flush() == ["九十一二"]
+    assert buffer.flush() == []
+
+
+def test_chunk_buffer_splits_oversized_piece():
+    buffer = ChunkBuffer(max_tokens=4)
+    chunks = buffer.feed("一二三四五六七八九") + buffer.flush()
+    assert chunks == ["一二三四", "五六七八", "九"]
+    assert all(estimate_tokens(chunk) <= 4 for chunk in chunks)
+
+
+def test_chunk_texts_covers_all_text():
+    pieces = ["第一页内容。", "第二页。", "很长的第三页" * 5, ""]
+    chunks = list(chunk_texts(pieces, max_tokens=8))
+    assert "".join(chunks) == "".join(pieces)
+    assert all(estimate_tokens(chunk) <= 8 for chunk in chunks)
+
+
+class StubLLM:
+    """按提示词返回固定的总结，fail(prompt) 为真时抛出异常"""
+
+    def __init__(self, fail):
+        self.fail = fail
+        self.prompts = []
+
+    async def generate_response(self, prompt, temperature=0.7, **kwargs):
+        self.prompts.append(prompt)
+        if self.fail(prompt):
+            raise RuntimeError("LLM 不可用")
+        return "总结"
+
+
+async def iterate(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def test_summarize_document_fails_when_every_chunk_fails():
+    llm = StubLLM(lambda prompt: True)
+    with pytest.raises(DocumentSummaryError):
+        asyncio.run(summarize_document(llm, iterate(["第一块", "第二块", "第三块"])))
+    # 只请求了三块的总结，没有用空的要点请求最终总结
+    assert len(llm.prompts) == 3
+
+
+def test_summarize_document_fails_when_most_chunks_fail():
+    llm = StubLLM(lambda prompt: "第二块" in prompt or "第三块" in prompt)
+    with pytest.raises(DocumentSummaryError):
+        asyncio.run(summarize_document(llm, iterate(["第一块", "第二块", "第三块"]), min_summary_ratio=0.5))
+
+
+def test_summarize_document_skips_a_few_failed_chunks():
+    llm = StubLLM(lambda prompt: "第二块" in prompt)
+    summary = asyncio.run(summarize_document(llm, iterate(["第一块", "第二块", "第三块"]), min_summary_ratio=0.5))
+    assert summary == "总结"
+
+
+def test_summarize_document_empty_document():
+    llm = StubLLM(lambda prompt: False)
+    assert asyncio.run(summarize_document(llm, iterate([]))) == "总结"
@@ -0,0 +1,54 @@
+import pytest
+
+from json_stream import JsonFieldStream, has_text, parse_json_object
+
+
+def test_parse_json_object_plain():
+    assert parse_json_object('{"expression": "开心", "reply": "你好"}') == {"expression": "开心", "reply": "你好"}
+
+
+def test_parse_json_object_without_object():
+    with pytest.raises(ValueError):
+        parse_json_object("只是一段普通的文字")
+    with pytest.raises(ValueError):
+        parse_json_object("")
+
+
+def test_field_stream_yields_reply_incrementally():
+    parser = JsonFieldStream()
+    text = '{"expression": "开心", "reply": "你好，\\n朋友"}'
+    deltas = [parser.feed(text[i:i + 5]) for i in range(0, len(text), 5)]
+    assert "".join(deltas) == "你好，\n朋友"
+    assert parser.snapshot() == {"expression": "开心", "reply": "你好，\n朋友"}
+
+
+def test_parse_json_object_strips_code_fence_and_surrounding_text():
+    text = '好的，回复如下：\n```json\n{"expression": "开心", "reply": "你好"}\n```\n希望你喜欢。'
+    assert parse_json_object(text) == {"expression": "开心", "reply": "你好"}
+
+
+def test_parse_json_object_trailing_commas():
+    assert parse_json_object('{"reply": "你好", "tags": ["a", "b",],}') == {"reply": "你好", "tags": ["a", "b"]}
+
+
+def test_parse_json_object_unescaped_quotes_and_newlines():
+    text = '{"reply": "他说"你好"然后走了\n第二行", "expression": "惊讶"}'
+    assert parse_json_object(text) == {"reply": '他说"你好"然后走了\n第二行', "expression": "惊讶"}
+
+
+def test_parse_json_object_truncated_output():
+    assert parse_json_object('{"expression": "开心", "reply": "今天天气') == {"expression": "开心", "reply": "今天天气"}
+    # 被截断在键之后、值之前时丢掉这个键
+    assert parse_json_object('{"expression": "开心", "reply":') == {"expression": "开心"}
+    assert parse_json_object('{"reply": "转义到一半\\') == {"reply": "转义到一半"}
+
+
+def test_parse_json_object_missing_keys():
+    # 解析只负责修复结构，缺少的键由调用方判断（见 has_text）
+    value = parse_json_object('{"expression": "开心"}')
+    assert value == {"expression": "开心"}
+    assert not has_text(value, "reply")
+    assert not has_text({"reply": "   "}, "reply")
+    assert not has_text({"reply": None}, "reply")
+    assert has_text({"reply": "你好"}, "reply")
+    assert parse_json_object("{}") == {}
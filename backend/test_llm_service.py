@@ -0,0 +1,39 @@
+import asyncio
+
+import pytest
+
+from llm import LLMService
+
+
+def make_service(outputs):
+    """每次请求依次返回 outputs 中的一条文本"""
+    service = LLMService("test", "http://127.0.0.1/v1/chat/completions", hedge_enabled=False, deadline=10.0)
+    calls = []
+
+    async def post(request_body):
+        calls.append(request_body)
+        return {"choices": [{"message": {"content": outputs[len(calls) - 1]}}]}
+
+    service._post = post
+    return service, calls
+
+
+def test_generate_response_repairs_json_without_retrying():
+    service, calls = make_service(['```json\n{"reply": "你好", "expression": "开心",}\n```'])
+    reply = asyncio.run(service.generate_response("hi", is_json=True, required_fields=("reply",)))
+    assert reply == {"reply": "你好", "expression": "开心"}
+    assert len(calls) == 1
+
+
+def test_generate_response_retries_when_required_field_missing():
+    service, calls = make_service(['{"expression": "开心"}', '{"reply": "  "}', '{"reply": "你好"}'])
+    reply = asyncio.run(service.generate_response("hi", is_json=True, required_fields=("reply",)))
+    assert reply == {"reply": "你好"}
+    assert len(calls) == 3
+
+
+def test_generate_response_fails_when_required_field_never_arrives():
+    service, calls = make_service(['{"expression": "开心"}'] * 2)
+    with pytest.raises(Exception):
+        asyncio.run(service.generate_response("hi", max_retries=2, is_json=True, required_fields=("reply",)))
+    assert len(calls) == 2
@@ -0,0 +1,48 @@
+import pytest
+
+from memory_index import VectorIndex
+
+
+def make_index():
+    index = VectorIndex(initial_capacity=2)
+    index.add([[1, 0, 0], [0, 1, 0], [0, 0, 1], [1, 1, 0]], ["x", "y", "z", "xy"])
+    return index
+
+
+def test_search_returns_top_k_by_cosine_similarity():
+    index = make_index()
+    results = index.search([1, 0.2, 0], k=2)
+    assert [item for item, _ in results] == ["x", "xy"]
+    assert results[0][1] > results[1][1]
+    assert results[0][1] == pytest.approx(1 / (1.04 ** 0.5), rel=1e-5)
+
+
+def test_search_k_larger_than_size_and_min_score():
+    index = make_index()
+    assert len(index.search([1, 0, 0], k=10)) == 4
+    assert [item for item, _ in index.search([1, 0, 0], k=10, min_score=0.5)] == ["x", "xy"]
+    assert index.search([1, 0, 0], k=0) == []
+    assert VectorIndex().search([1, 0, 0]) == []
+
+
+def test_add_grows_capacity_and_checks_dimension():
+    index = make_index()
+    assert len(index) == 4
+    assert index.nbytes >= 4 * 3 * 4
+    with pytest.raises(ValueError):
+        index.add([[1, 0]], ["bad"])
+
+
+def test_remove_oldest_keeps_remaining_rows_aligned():
+    index = make_index()
+    index.remove_oldest(2)
+    assert index.items == ["z", "xy"]
+    assert index.search([0, 0, 1], k=1)[0][0] == "z"
+    assert index.search([1, 1, 0], k=1)[0][0] == "xy"
+
+    index.remove_oldest(0)
+    index.remove_oldest(-1)
+    assert len(index) == 2
+    index.remove_oldest(10)
+    assert len(index) == 0
+    assert index.search([1, 0, 0]) == []
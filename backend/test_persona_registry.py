@@ -0,0 +1,66 @@
+import os
+import threading
+
+import pytest
+
+from config import Config
+from persona_registry import PersonaError, PersonaRegistry
+
+
+def write_prompt(path, text: str, mtime: float) -> None:
+    path.write_text(text, encoding="utf-8")
+    os.utime(path, (mtime, mtime))
+
+
+def test_default_persona_dir_does_not_depend_on_cwd():
+    assert os.path.isabs(Config.PERSONA_DIR)
+    assert os.path.isfile(os.path.join(Config.PERSONA_DIR, f"{Config.PERSONA_DEFAULT}.txt"))
+
+
+def test_get_loads_and_reloads_changed_file(tmp_path):
+    prompt = tmp_path / "reply.txt"
+    write_prompt(prompt, "你是小助手。{memory}", 1000)
+    registry = PersonaRegistry(str(tmp_path), check_interval=0)
+
+    persona = registry.get()
+    assert persona.system_prompt.startswith("你是小助手。")
+    assert registry.get() is persona
+
+    write_prompt(prompt, "你是新的小助手。", 2000)
+    assert registry.get().system_prompt == "你是新的小助手。"
+    assert registry.reloads == 1
+
+    # 新内容校验失败时继续使用旧版本
+    write_prompt(prompt, "{unknown}", 3000)
+    assert registry.get().system_prompt == "你是新的小助手。"
+    assert registry.errors == 1
+
+    with pytest.raises(PersonaError):
+        registry.get("missing")
+    with pytest.raises(PersonaError):
+        registry.get("../reply")
+
+
+def test_concurrent_reload_loads_once(tmp_path):
+    prompt = tmp_path / "reply.txt"
+    write_prompt(prompt, "第一版", 1000)
+    registry = PersonaRegistry(str(tmp_path), check_interval=0)
+    registry.get()
+    write_prompt(prompt, "第二版", 2000)
+
+    barrier = threading.Barrier(8)
+    results = []
+
+    def worker():
+        barrier.wait()
+        results.append(registry.get())
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert {persona.system_prompt for persona in results} == {"第二版"}
+    assert len({id(persona) for persona in results}) == 1
+    assert registry.reloads == 1
@@ -0,0 +1,148 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from llm import LLMService
+from resilience import CircuitBreaker, CircuitOpenError, HedgeStats, LatencyTracker, backoff_delay, hedge
+
+
+def test_circuit_breaker_opens_after_threshold_and_probes_once():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.check()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+    time.sleep(0.06)
+    assert breaker.state == "half_open"
+    breaker.check()
+    # 冷却结束后只放行一个探测请求
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.get_stats()["trips"] == 1
+    assert breaker.get_stats()["rejected"] == 2
+
+
+def test_circuit_breaker_failed_probe_reopens():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    breaker.check()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.trips == 1
+
+
+def test_circuit_breaker_cancelled_probe_is_released():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.check() is True
+    # 探测请求被取消、没有结果时，下一个请求可以继续探测
+    breaker.release_probe()
+    assert breaker.check() is True
+    breaker.record_success()
+    assert breaker.check() is False
+
+
+def test_llm_timeouts_trip_breaker_and_timed_out_probe_recovers():
+    state = {"slow": True}
+
+    async def handler(request):
+        if state["slow"]:
+            await asyncio.sleep(1.0)
+        return httpx.Response(200, json={"choices": [{"message": {"content": "你好"}}]})
+
+    async def main():
+        service = LLMService(
+            "test", "http://127.0.0.1/v1/chat/completions", http2=False, hedge_enabled=False,
+            breaker_failures=2, breaker_reset=0.05
+        )
+        service._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        generate = lambda: service.generate_response("hi", max_retries=2, attempt_timeout=0.05, deadline=5.0)
+
+        # 只会超时的服务同样触发熔断
+        with pytest.raises(Exception):
+            await generate()
+        assert service.breaker.state == "open"
+        assert service.breaker.get_stats()["consecutive_failures"] == 2
+
+        # 冷却结束后的探测请求超时：重新熔断，而不是一直停在探测状态
+        await asyncio.sleep(0.06)
+        with pytest.raises(Exception):
+            await generate()
+        assert service.breaker.state == "open"
+
+        # 服务恢复后，下一次探测成功即关闭熔断
+        state["slow"] = False
+        await asyncio.sleep(0.06)
+        assert await generate() == "你好"
+        assert service.breaker.state == "closed"
+        await service.shutdown()
+
+    asyncio.run(main())
+
+
+def test_latency_tracker_hedge_delay():
+    tracker = LatencyTracker(window=10, min_samples=5, min_delay=0.2)
+    for _ in range(4):
+        tracker.record(1.0)
+    assert tracker.hedge_delay() is None
+    for seconds in (0.1, 0.1, 0.1, 0.1, 0.1, 2.0):
+        tracker.record(seconds)
+    assert tracker.hedge_delay() == 2.0
+    assert tracker.quantile(0.0) == 0.1
+
+
+def test_backoff_delay_is_capped():
+    for attempt in range(10):
+        assert 0 < backoff_delay(attempt, base=0.5, cap=4.0) <= 4.0
+
+
+def delayed_calls(delays, results):
+    """第 n 次调用等待 delays[n] 秒后返回 results[n]（为异常时抛出）"""
+    calls = []
+
+    async def call():
+        index = len(calls)
+        calls.append(index)
+        await asyncio.sleep(delays[index])
+        if isinstance(results[index], Exception):
+            raise results[index]
+        return results[index]
+
+    return call, calls
+
+
+def test_hedge_returns_fast_result_without_hedging():
+    call, calls = delayed_calls([0.0], ["first"])
+    stats = HedgeStats()
+    assert asyncio.run(hedge(call, 0.05, 1.0, stats)) == "first"
+    assert calls == [0]
+    assert stats.hedged == 0
+
+
+def test_hedge_second_request_wins():
+    call, calls = delayed_calls([1.0, 0.0], ["slow", "hedged"])
+    stats = HedgeStats()
+    assert asyncio.run(hedge(call, 0.02, 0.5, stats)) == "hedged"
+    assert calls == [0, 1]
+    assert (stats.hedged, stats.hedge_wins) == (1, 1)
+
+
+def test_hedge_timeout_and_error():
+    call, _ = delayed_calls([1.0, 1.0], ["slow", "slow"])
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(hedge(call, 0.01, 0.05))
+
+    call, calls = delayed_calls([0.0], [RuntimeError("boom")])
+    with pytest.raises(RuntimeError):
+        asyncio.run(hedge(call, None, 1.0))
+    assert calls == [0]
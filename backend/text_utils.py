@@ -0,0 +1,63 @@
+# text_utils.py
+#
+# 文本处理工具
+#
+# 主要功能包括：
+# 1. 按句末标点把完整文本切分成句子 (split_sentences)
+# 2. 在流式输出中增量切句 (SentenceBuffer)，句末标点一到就吐出完整句子，
+#    让 TTS 可以在 LLM 还在生成时就开始合成
+# 3. 估算文本的 token 数 (estimate_tokens)，用于按 token 预算切分文档、控制提示词长度
+import re
+from typing import List
+
+# 句末标点，切句时会被去掉
+SENTENCE_TERMINATORS = "。！？?!"
+_SENTENCE_SPLIT_RE = re.compile(f"[{re.escape(SENTENCE_TERMINATORS)}]")
+# 中日韩文字和全角符号，主流模型的分词器里基本一字一个 token
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算文本的 token 数
+
+    不依赖具体模型的分词器：中日韩字符按一字一个 token 计算，
+    其余字符按约 4 个字符一个 token 计算，结果略偏保守。
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def split_sentences(text: str) -> List[str]:
+    """按句末标点切分文本，去掉空句和首尾空白"""
+    sentences = _SENTENCE_SPLIT_RE.split(text)
+    return [s.strip() for s in sentences if s.strip()]
+
+
+class SentenceBuffer:
+    """
+    增量切句缓冲区
+
+    不断 feed 流式文本片段，每遇到句末标点就返回已完整的句子；
+    流结束时调用 flush 取出最后一段没有标点结尾的文本。
+    切分结果与 split_sentences 对同一段完整文本的结果一致。
+    """
+
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        """追加文本片段，返回新完成的句子列表"""
+        self._buffer += text
+        parts = _SENTENCE_SPLIT_RE.split(self._buffer)
+        # 最后一段还没有遇到句末标点，留在缓冲区里
+        self._buffer = parts.pop()
+        return [s.strip() for s in parts if s.strip()]
+
+    def flush(self) -> List[str]:
+        """取出缓冲区中剩余的文本"""
+        rest = self._buffer.strip()
+        self._buffer = ""
+        return [rest] if rest else []
@@ -1,29 +1,72 @@
+import logging
 from fish_audio_sdk import Session, TTSRequest
 from typing import Optional
 import time
 
+from audio_cache import AudioCache
+from metrics import BYTES
+from resilience import CircuitBreaker, LatencyTracker
+
+logger = logging.getLogger(__name__)
+
 class TTSService:
-    def __init__(self, api_key: str, reference_id: str):
+    def __init__(
+        self,
+        api_key: str,
+        reference_id: str,
+        base_url: str = "https://api.fish.audio",
+        cache: Optional[AudioCache] = None,
+        breaker_failures: int = 5,
+        breaker_reset: float = 30.0
+    ):
         self.api_key = api_key
         self.reference_id = reference_id
-        self.session = Session(api_key)
-    
+        self.session = Session(api_key, base_url=base_url)
+        self.cache = cache  # 语音缓存，为 None 时每次都远程合成
+        # 远程合成的耗时（用于对冲）和熔断状态，合成在线程池中执行，两者都是线程安全的
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset)
+
+    def synthesize(self, text: str) -> bytes:
+        """
+        合成一句语音（阻塞），只请求一次，命中缓存时直接返回
+
+        失败时抛出异常，服务熔断时立即抛出 CircuitOpenError；
+        重试、超时和对冲由 TTSScheduler 在事件循环中处理，这里不会阻塞等待
+        """
+        if self.cache:
+            cached = self.cache.get(self.reference_id, text)
+            if cached:
+                return cached
+
+        self.breaker.check()
+        start = time.monotonic()
+        try:
+            audio_data = b"".join(self.session.tts(TTSRequest(
+                reference_id=self.reference_id,
+                text=text
+            )))
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        self.latency.record(time.monotonic() - start)
+        BYTES.inc(len(audio_data), kind="tts_synthesized")
+
+        if self.cache:
+            self.cache.put(self.reference_id, text, audio_data)
+        return audio_data
+
     def generate_audio(self, text: str) -> bytes:
-        max_retries = 3
-        retry_delay = 1  # 初始延迟1秒
-        
-        for attempt in range(max_retries):
-            try:
-                audio_data = b"".join(self.session.tts(TTSRequest(
-                    reference_id=self.reference_id,
-                    text=text
-                )))
-                return audio_data
-            except Exception as e:
-                if attempt < max_retries - 1:  # 如果不是最后一次尝试
-                    print(f"TTS Error on attempt {attempt + 1}: {str(e)}")
-                    time.sleep(retry_delay)
-                    retry_delay *= 2  # 指数退避，每次失败后等待时间翻倍
-                else:
-                    print(f"TTS Error: All {max_retries} attempts failed. Last error: {str(e)}")
-                    return b""  # 所有重试都失败后返回空音频数据
\ No newline at end of file
+        """合成一句语音（阻塞），失败或熔断时返回空音频"""
+        try:
+            return self.synthesize(text)
+        except Exception as e:
+            logger.warning("TTS Error: %s", e)
+            return b""
+
+    def get_stats(self) -> dict:
+        return {
+            "latency": self.latency.get_stats(),
+            "breaker": self.breaker.get_stats()
+        }
@@ -0,0 +1,119 @@
+# tts_scheduler.py
+#
+# TTS 并发调度器
+#
+# TTSService.generate_audio 是阻塞调用（Fish Audio SDK 同步接口），直接在 async 路由里
+# 逐句调用会卡住事件循环，并让多句语音串行等待。TTSScheduler 负责：
+# 1. 在线程池中执行合成，不阻塞事件循环
+# 2. 用信号量限制同时进行的合成数量
+# 3. 每句有总时限，时限内每次尝试单独超时，慢于 p95 时发出对冲请求，失败后退避重试；
+#    超时、失败或服务熔断时该句返回空音频，不拖慢整段回复
+# 4. 批量合成时保持与输入句子相同的顺序
+# 5. 并发名额按请求优先级分配，聊天的句子先于文档总结和预热的句子合成；可选的速率限制
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from admission import PrioritySemaphore, TokenBucket
+from metrics import RETRIES, span
+from resilience import CircuitOpenError, HedgeStats, backoff_delay, hedge
+from tts import TTSService
+
+logger = logging.getLogger(__name__)
+
+
+class TTSScheduler:
+    def __init__(
+        self,
+        tts_service: Optional[TTSService],
+        max_concurrency: int = 4,
+        timeout: float = 20.0,
+        attempt_timeout: float = 8.0,
+        max_attempts: int = 3,
+        hedge_enabled: bool = True,
+        rate_limiter: Optional[TokenBucket] = None
+    ):
+        """
+        Args:
+            tts_service (TTSService): 语音合成服务，为 None 时所有合成都返回空音频
+            max_concurrency (int): 同时进行的最大合成数
+            timeout (float): 单句合成的总时限（秒），包括重试
+            attempt_timeout (float): 单次尝试的超时时间（秒）
+            max_attempts (int): 单句最多尝试次数
+            hedge_enabled (bool): 是否在合成慢于 p95 时发出对冲请求
+            rate_limiter (TokenBucket): TTS 服务的请求速率限制，为 None 时不限制
+        """
+        self.tts_service = tts_service
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.attempt_timeout = attempt_timeout
+        self.max_attempts = max_attempts
+        self.hedge_enabled = hedge_enabled
+        self.hedge_stats = HedgeStats()
+        self.rate_limiter = rate_limiter
+        self._semaphore = PrioritySemaphore(max_concurrency)
+        # 超时或被对冲取消的合成无法中断，仍会占用线程直到返回，因此线程数留出余量
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency * 3, thread_name_prefix="tts")
+
+    async def synthesize(self, text: str) -> bytes:
+        """合成一句语音，超时或失败时返回空音频"""
+        if self.tts_service is None or not text.strip():
+            return b""
+        with span("tts"):
+            return await self._synthesize(text)
+
+    async def _synthesize(self, text: str) -> bytes:
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.timeout
+            for attempt in range(self.max_attempts):
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    return await hedge(
+                        lambda: self._request(text),
+                        self.tts_service.latency.hedge_delay() if self.hedge_enabled else None,
+                        min(self.attempt_timeout, remaining),
+                        self.hedge_stats
+                    )
+                except CircuitOpenError:
+                    logger.warning("TTS 服务熔断中，跳过该句: %s", text[:20])
+                    return b""
+                except asyncio.TimeoutError:
+                    logger.warning("TTS 合成超时（第%d次）: %s", attempt + 1, text[:20])
+                except Exception as e:
+                    logger.warning("TTS 合成出错（第%d次）: %s", attempt + 1, e)
+                # 退避等待在事件循环中进行，不占用线程；剩余时间不够时直接放弃
+                delay = backoff_delay(attempt)
+                if attempt + 1 >= self.max_attempts or deadline - loop.time() <= delay:
+                    break
+                RETRIES.inc(service="tts")
+                await asyncio.sleep(delay)
+        logger.error("TTS 合成失败，跳过该句: %s", text[:20])
+        return b""
+
+    async def _request(self, text: str) -> bytes:
+        """发出一次合成请求（对冲请求也是一次）"""
+        if self.rate_limiter:
+            await self.rate_limiter.acquire()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.tts_service.synthesize, text)
+
+    async def synthesize_all(self, sentences: List[str]) -> List[bytes]:
+        """并发合成多句语音，结果顺序与输入一致"""
+        return list(await asyncio.gather(*(self.synthesize(s) for s in sentences)))
+
+    def get_stats(self) -> dict:
+        stats = self.hedge_stats.get_stats()
+        stats["waiting"] = self._semaphore.waiting()
+        if self.rate_limiter:
+            stats["rate_limit"] = self.rate_limiter.get_stats()
+        if self.tts_service:
+            stats.update(self.tts_service.get_stats())
+        return stats
+
+    def shutdown(self) -> None:
+        """关闭线程池，取消尚未开始的合成"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,209 @@
+# upload_cache.py
+#
+# 上传文档的结果缓存
+#
+# 用户经常重复上传同一份文档，每次都重新解析、调用 LLM 总结、逐句合成语音。
+# UploadCache 以 (文件内容哈希, 配置指纹) 为键，把一次上传的全部产物保存在磁盘上：
+# 提取出的文本块、总结、切好的句子和语音片段。再次上传同一份文件时直接返回，不再调用任何远程服务。
+# 1. 配置指纹包含人设、提示词和模型配置，任一项改变后旧结果自然失效，不会返回过期的总结
+# 2. 磁盘总大小有上限，超出时按最近访问时间淘汰（访问时更新文件时间，重启后仍然有效）
+# 3. 文本块的向量由 EmbeddingCache 按文本哈希缓存，这里不重复保存
+# 4. 文本块在上传过程中由 ChunkSpool 逐块写入旁边的 .chunks.jsonl 文件，命中时逐行读回，
+#    写入和读取缓存时都不需要把整份文档放在内存中
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Iterator, Optional
+
+CHUNKS_SUFFIX = ".chunks.jsonl"
+
+
+class ChunkSpool:
+    """把上传过程中的文本块逐个追加到临时文件，上传成功后由 UploadCache.put 随缓存条目一起保存"""
+
+    def __init__(self, cache_dir: str):
+        fd, self.path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        self._file = os.fdopen(fd, "w", encoding="utf-8")
+
+    def write(self, chunk: str) -> None:
+        self._file.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+
+    def discard(self) -> None:
+        """上传失败或不缓存时删除临时文件"""
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+logger = logging.getLogger(__name__)
+
+
+class UploadCache:
+    def __init__(self, cache_dir: str = "save/upload_cache", max_bytes: int = 256 * 1024 * 1024):
+        """
+        Args:
+            cache_dir (str): 缓存目录
+            max_bytes (int): 缓存文件的最大总字节数
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # 键 -> 文件大小，按最近访问时间从旧到新排列
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        self._scan()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(content_hash: str, fingerprint: str) -> str:
+        """根据文件内容哈希和配置指纹生成缓存键"""
+        return hashlib.sha256(f"{content_hash}\0{fingerprint}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def make_fingerprint(*parts) -> str:
+        """把影响上传结果的配置（人设、提示词、模型等）合成一个指纹"""
+        raw = json.dumps([str(part) for part in parts], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _chunks_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}{CHUNKS_SUFFIX}")
+
+    def _scan(self) -> None:
+        """启动时扫描缓存目录，按文件修改时间恢复访问顺序，清理异常退出时残留的临时文件"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".tmp"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            if not name.endswith(".json"):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            key = name[:-len(".json")]
+            size = stat.st_size
+            try:
+                size += os.path.getsize(self._chunks_path(key))
+            except OSError:
+                pass
+            entries.append((stat.st_mtime, key, size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._bytes += size
+
+    def get(self, key: str) -> Optional[dict]:
+        """查询缓存，未命中返回 None"""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                artifact = json.load(f)
+            if "chunks" not in artifact and not os.path.exists(self._chunks_path(key)):
+                # 文本块文件丢失时当作未命中，重新处理一遍
+                raise FileNotFoundError(self._chunks_path(key))
+            os.utime(path)
+        except FileNotFoundError:
+            artifact = None
+        except (OSError, ValueError) as e:
+            logger.warning("读取上传缓存出错: %s", e)
+            artifact = None
+
+        with self._lock:
+            if artifact is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return artifact
+
+    def open_spool(self) -> ChunkSpool:
+        """创建一个文本块临时文件，上传过程中逐块写入"""
+        return ChunkSpool(self.cache_dir)
+
+    def iter_chunks(self, key: str, artifact: dict) -> Iterator[str]:
+        """逐块读取缓存条目的文本块（阻塞），兼容把文本块直接存在条目中的旧格式"""
+        if "chunks" in artifact:
+            yield from artifact["chunks"]
+            return
+        try:
+            with open(self._chunks_path(key), "r", encoding="utf-8") as f:
+                for line in f:
+                    yield json.loads(line)
+        except (OSError, ValueError) as e:
+            logger.warning("读取上传缓存的文本块出错: %s", e)
+
+    def put(self, key: str, artifact: dict, spool: Optional[ChunkSpool] = None) -> None:
+        """写入缓存，spool 为上传过程中写好的文本块，超出总大小时淘汰最久未访问的条目"""
+        data = json.dumps(artifact, ensure_ascii=False).encode("utf-8")
+        size = len(data)
+        if spool is not None:
+            spool.close()
+            size += os.path.getsize(spool.path)
+        if size > self.max_bytes:
+            if spool is not None:
+                spool.discard()
+            return
+        path = self._path(key)
+        try:
+            # 先写临时文件再原子替换，避免并发读到写了一半的文件；文本块先于条目就位
+            if spool is not None:
+                os.replace(spool.path, self._chunks_path(key))
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("写入上传缓存出错: %s", e)
+            if spool is not None:
+                spool.discard()
+            return
+
+        with self._lock:
+            self._bytes -= self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._bytes += size
+            evicted = []
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, size = self._entries.popitem(last=False)
+                self._bytes -= size
+                evicted.append(old_key)
+
+        for old_key in evicted:
+            for old_path in (self._path(old_key), self._chunks_path(old_key)):
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes
+            }
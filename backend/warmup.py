@@ -0,0 +1,156 @@
+# warmup.py
+#
+# 启动预热
+#
+# 新部署或新人设的第一个用户总是最慢的：连接还没建立，常用语句的语音也还没合成。
+# 兜底回复更糟，它恰好在服务出问题时才会用到，这时再去合成语音很可能也会失败。
+# Warmup 在应用启动后于后台执行，不推迟服务就绪：
+# 1. 预先建立到 LLM（以及备用 LLM）和向量服务的连接
+# 2. 按人设预先合成一组常用语句（问候、安慰、兜底回复等）的语音，写入语音缓存；
+#    语句按句切分后逐句合成，与回复按句合成时的缓存键一致，已缓存的语句只读入内存
+# 3. 合成并发数很低，尽量不占用用户请求的 TTS 并发
+# 进度和结果见 get_status()，由 /api/stats 的 warmup 返回。
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional
+
+from embedding import EmbeddingService
+from llm import LLMService
+from persona_registry import PersonaRegistry
+from text_utils import split_sentences
+from tts import TTSService
+from tts_scheduler import TTSScheduler
+
+logger = logging.getLogger(__name__)
+
+
+class Warmup:
+    def __init__(
+        self,
+        llm_service: LLMService,
+        embedding_service: Optional[EmbeddingService],
+        tts_service: Optional[TTSService],
+        tts_scheduler: TTSScheduler,
+        phrases: Dict[str, List[str]],
+        common_phrases: List[str],
+        personas: PersonaRegistry,
+        concurrency: int = 1
+    ):
+        """
+        Args:
+            llm_service (LLMService): 预热连接的 LLM 服务
+            embedding_service (EmbeddingService): 预热连接的向量服务，为 None 时跳过
+            tts_service (TTSService): 语音服务，为 None 或没有语音缓存时不预先合成
+            tts_scheduler (TTSScheduler): 执行合成的调度器（带超时、重试和熔断）
+            phrases (Dict[str, List[str]]): 人设名称 -> 该人设的常用语句，不存在的人设跳过
+            common_phrases (List[str]): 所有人设共用的语句，例如兜底回复
+            personas (PersonaRegistry): 人设注册表，用来判断人设是否存在
+            concurrency (int): 同时合成的最大句数
+        """
+        self.llm_service = llm_service
+        self.embedding_service = embedding_service
+        self.tts_service = tts_service
+        self.tts_scheduler = tts_scheduler
+        self.phrases = phrases
+        self.common_phrases = common_phrases
+        self.persona_registry = personas
+        self.concurrency = concurrency
+
+        self._task: Optional[asyncio.Task] = None
+        self.state = "pending"  # pending / running / done / failed / cancelled（应用在预热完成前关闭）
+        self.personas: List[str] = []
+        self.connections: Dict[str, bool] = {}
+        self.sentences = 0
+        self.cached = 0
+        self.synthesized = 0
+        self.failed = 0
+        self.duration: Optional[float] = None
+
+    def start(self) -> None:
+        """在后台开始预热，立即返回"""
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """取消尚未完成的预热"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def _collect_sentences(self) -> List[str]:
+        """收集要合成的句子：共用语句和存在的人设的语句，按句切分并去重"""
+        texts = list(self.common_phrases)
+        for persona, phrases in self.phrases.items():
+            if self.persona_registry.exists(persona):
+                self.personas.append(persona)
+                texts.extend(phrases)
+            else:
+                logger.info("人设 %s 不存在，跳过预热", persona)
+        sentences: Dict[str, None] = {}
+        for text in texts:
+            for sentence in split_sentences(text):
+                sentences[sentence] = None
+        return list(sentences)
+
+    async def run(self) -> None:
+        self.state = "running"
+        start = time.monotonic()
+        try:
+            await self._warm_connections()
+            if self.tts_service is not None and self.tts_service.cache is not None:
+                await self._warm_audio()
+            self.state = "done"
+        except asyncio.CancelledError:
+            self.state = "cancelled"
+            raise
+        except Exception as e:
+            logger.error("启动预热出错: %s", e)
+            self.state = "failed"
+        finally:
+            self.duration = round(time.monotonic() - start, 3)
+        logger.info(
+            "启动预热完成: %d 句语音（已缓存 %d，新合成 %d，失败 %d），用时 %.1f 秒",
+            self.sentences, self.cached, self.synthesized, self.failed, self.duration
+        )
+
+    async def _warm_connections(self) -> None:
+        checks = {"llm": self.llm_service.warm_connection()}
+        if self.embedding_service:
+            checks["embedding"] = self.embedding_service.warm_connection()
+        results = await asyncio.gather(*checks.values())
+        self.connections = dict(zip(checks, results))
+
+    async def _warm_audio(self) -> None:
+        sentences = self._collect_sentences()
+        self.sentences = len(sentences)
+        cache = self.tts_service.cache
+        reference_id = self.tts_service.reference_id
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def warm(sentence: str) -> None:
+            async with semaphore:
+                # 已缓存的语句从磁盘读入内存，第一次使用时不用再读盘
+                if await asyncio.to_thread(cache.get, reference_id, sentence):
+                    self.cached += 1
+                elif await self.tts_scheduler.synthesize(sentence):
+                    self.synthesized += 1
+                else:
+                    self.failed += 1
+
+        await asyncio.gather(*(warm(sentence) for sentence in sentences))
+
+    def get_status(self) -> dict:
+        return {
+            "state": self.state,
+            "personas": self.personas,
+            "connections": self.connections,
+            "sentences": self.sentences,
+            "cached": self.cached,
+            "synthesized": self.synthesized,
+            "failed": self.failed,
+            "duration": self.duration
+        }
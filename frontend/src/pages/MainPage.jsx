@@ -53,6 +53,18 @@ export default function MainPage() {
     }
   };
 
+  // 语音地址（/api/audio/...）直接交给 Audio 播放，以二进制获取；旧格式的 base64 先转成 Blob
+  const toAudioSource = (audio) => {
+    if (audio.startsWith('/api/')) {
+      return { url: `http://localhost:8000${audio}`, revoke: false };
+    }
+    const audioBlob = new Blob(
+      [Uint8Array.from(atob(audio), c => c.charCodeAt(0))],
+      { type: 'audio/mpeg' }
+    );
+    return { url: URL.createObjectURL(audioBlob), revoke: true };
+  };
+
   // 播放每一句语音并切换字幕
   const playSentences = async (sentences, audioBase64, audioSegments = null) => {
     setSubtitleSentences(sentences);
@@ -66,12 +78,8 @@ export default function MainPage() {
         
         if (audioSegment && audioSegment.length > 0) {
           try {
-            const audioBlob = new Blob(
-              [Uint8Array.from(atob(audioSegment), c => c.charCodeAt(0))],
-              { type: 'audio/mpeg' }
-            );
-            const audioUrl = URL.createObjectURL(audioBlob);
-            const audio = new Audio(audioUrl);
+            const source = toAudioSource(audioSegment);
+            const audio = new Audio(source.url);
             
             audio.onerror = (e) => {
               console.error('Audio playback error:', e);
@@ -85,7 +93,7 @@ export default function MainPage() {
               audio.onerror = () => resolve();
             });
             
-            URL.revokeObjectURL(audioUrl);
+            if (source.revoke) URL.revokeObjectURL(source.url);
           } catch (audioError) {
             console.error('Audio processing error:', audioError);
             // Wait for a default time if audio fails
@@ -99,12 +107,8 @@ export default function MainPage() {
     } else if (audioBase64 && audioBase64.length > 0) {
       // Fallback to the old method with single audio file
       try {
-        const audioBlob = new Blob(
-          [Uint8Array.from(atob(audioBase64), c => c.charCodeAt(0))],
-          { type: 'audio/mpeg' }
-        );
-        const audioUrl = URL.createObjectURL(audioBlob);
-        const audio = new Audio(audioUrl);
+        const source = toAudioSource(audioBase64);
+        const audio = new Audio(source.url);
         
         audio.onerror = (e) => {
           console.error('Audio playback error:', e);
@@ -137,7 +141,7 @@ export default function MainPage() {
           };
         });
         
-        URL.revokeObjectURL(audioUrl);
+        if (source.revoke) URL.revokeObjectURL(source.url);
       } catch (audioError) {
         console.error('Audio processing error:', audioError);
         // Fallback to sequential display if audio fails
@@ -198,6 +202,9 @@ export default function MainPage() {
           session_id: 'default' 
         }),
       });
+      if (response.status === 429) {
+        throw new Error(`服务繁忙，请 ${response.headers.get('Retry-After') || 1} 秒后再试`);
+      }
       
       const data = await response.json();
       
@@ -237,12 +244,15 @@ export default function MainPage() {
       ]);
       
       // Play sentences with audio through subtitle system
-      if (parsedData.audio_segments && parsedData.sentences) {
+      // audio_urls / audio_url 为语音地址，audio_segments / audio 为旧格式的 base64
+      const audioSegments = parsedData.audio_urls || parsedData.audio_segments;
+      const singleAudio = parsedData.audio_url || parsedData.audio;
+      if (audioSegments && parsedData.sentences) {
         // New format with separate audio segments
-        await playSentences(parsedData.sentences, null, parsedData.audio_segments);
-      } else if (parsedData.audio && parsedData.audio.length > 0) {
+        await playSentences(parsedData.sentences, null, audioSegments);
+      } else if (singleAudio && singleAudio.length > 0) {
         // Old format with single audio file
-        await playSentences(sentences, parsedData.audio);
+        await playSentences(sentences, singleAudio);
       } else {
         // No audio, just display subtitles
         setSubtitleSentences(sentences);
@@ -281,6 +291,9 @@ export default function MainPage() {
         method: 'POST',
         body: formData,
       });
+      if (response.status === 429) {
+        throw new Error(`服务繁忙，请 ${response.headers.get('Retry-After') || 1} 秒后再试`);
+      }
       const data = await response.json();
       
       // 解析可能包含在代码块中的JSON响应
@@ -306,12 +319,15 @@ export default function MainPage() {
       const sentences = splitSentences(parsedData.summary);
       
       // Play sentences with audio through subtitle system
-      if (parsedData.audio_segments && parsedData.sentences) {
+      // audio_urls / audio_url 为语音地址，audio_segments / audio 为旧格式的 base64
+      const audioSegments = parsedData.audio_urls || parsedData.audio_segments;
+      const singleAudio = parsedData.audio_url || parsedData.audio;
+      if (audioSegments && parsedData.sentences) {
         // New format with separate audio segments
-        await playSentences(parsedData.sentences, null, parsedData.audio_segments);
-      } else if (parsedData.audio && parsedData.audio.length > 0) {
+        await playSentences(parsedData.sentences, null, audioSegments);
+      } else if (singleAudio && singleAudio.length > 0) {
         // Old format with single audio file
-        await playSentences(sentences, parsedData.audio);
+        await playSentences(sentences, singleAudio);
       } else {
         // No audio, just display subtitles
         setSubtitleSentences(sentences);